@@ -0,0 +1,35 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from rest_framework.utils import json, encoders
+
+from .models import Activity
+from .serializers import ActivitySerializer
+
+
+def publish(verb, recipients, actor=None, offer=None, object_id=None, data=None, request=None):
+    """
+    Пишет событие в ленту каждому получателю (кроме самого инициатора) в текущей транзакции
+    и после коммита отправляет его в персональный сокет получателя (группа messages-<id>).
+    """
+    actor_id = actor.id if actor is not None else None
+    recipients = {user_id for user_id in recipients if user_id is not None and user_id != actor_id}
+    if offer is not None:
+        data = dict(data or {}, offer_title=offer.title)
+    activities = Activity.objects.bulk_create([
+        Activity(user_id=user_id, verb=verb, actor=actor, offer=offer, object_id=object_id, data=data or {})
+        for user_id in recipients
+    ])
+    if activities:
+        transaction.on_commit(lambda: push(activities, request))
+    return activities
+
+
+def push(activities, request=None):
+    channel_layer = get_channel_layer()
+    for activity in activities:
+        data = ActivitySerializer(activity, context={'request': request}).data
+        text_data = json.dumps({'activity': data}, cls=encoders.JSONEncoder, ensure_ascii=False)
+        async_to_sync(channel_layer.group_send)(
+            f'messages-{activity.user_id}', {'type': 'new_activity', 'message': text_data}
+        )
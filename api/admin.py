@@ -1,4 +1,6 @@
 from django.contrib import admin
+from django.utils.text import smart_split
+from django.utils.text import unescape_string_literal
 
 from .models import User
 from .models import Car
@@ -11,6 +13,47 @@ from .models import Subscription
 from .models import SubscriptionFreeze
 from .models import SubscriptionPlan
 from .models import SubscriptionAction
+from .models import RepairOffer
+from .models import Grade
+from .models import Message
+from .models import Comment
+
+from .aggregations import annotate_subscriptions_is_freeze
+from .paginations import EstimatedCountPaginator
+
+from .exports import export_ndjson
+from .exports import export_csv
+from .exports import OFFER_EXPORT_FIELDS
+from .exports import GRADE_EXPORT_FIELDS
+from .exports import SUBSCRIPTION_EXPORT_FIELDS
+from .exports import MESSAGE_EXPORT_FIELDS
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    # для таблиц на миллионы строк: без полного COUNT(*) на каждой странице списка
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    search_lookups = {'^': 'istartswith', '=': 'iexact', '@': 'search'}
+
+    def construct_search(self, field_name):
+        if field_name[0] in self.search_lookups:
+            return f'{field_name[1:]}__{self.search_lookups[field_name[0]]}'
+        return f'{field_name}__icontains'
+
+    def get_search_results(self, request, queryset, search_term):
+        # OR по полям разных таблиц не дает Postgres использовать их индексы: каждое поле ищется
+        # отдельным запросом, совпадения объединяются через UNION по pk, поэтому дубликатов нет
+        search_fields = self.get_search_fields(request)
+        if not search_fields or not search_term:
+            return queryset, False
+        orm_lookups = [self.construct_search(str(field_name)) for field_name in search_fields]
+        for bit in smart_split(search_term):
+            if bit.startswith(('"', "'")) and bit[0] == bit[-1]:
+                bit = unescape_string_literal(bit)
+            matches = [self.model._default_manager.filter(**{lookup: bit}).order_by().values('pk')
+                       for lookup in orm_lookups]
+            queryset = queryset.filter(pk__in=matches[0].union(*matches[1:]))
+        return queryset, False
 
 
 class SubscriptionFreezeInline(admin.StackedInline):
@@ -18,16 +61,25 @@ class SubscriptionFreezeInline(admin.StackedInline):
     fk_name = 'subscription'
     extra = 0
 
+    def get_queryset(self, request):
+        return super(SubscriptionFreezeInline, self).get_queryset(request).select_related('subscription__user')
+
 
-class SubscriptionAdmin(admin.ModelAdmin):
+class SubscriptionAdmin(LargeTableAdmin):
+    @admin.display(description='Заморожена', ordering='is_freeze_now')
     def is_freeze(self, obj):
-        if obj.is_freeze:
+        if obj.is_freeze_now:
             return 'ДА'
         return 'НЕТ'
 
+    def get_queryset(self, request):
+        return annotate_subscriptions_is_freeze(super(SubscriptionAdmin, self).get_queryset(request))
+
     model = Subscription
     list_display = ("user", 'plan', 'start', 'expiration_date', 'value', 'active', 'is_freeze', 'payment_id')
+    list_select_related = ('user', 'plan')
     list_filter = ("plan", "active",)
+    raw_id_fields = ('user',)
     fieldsets = (
         (None, {
             'fields': (('user', 'plan',), ('start', 'expiration_date',), 'active',),
@@ -38,9 +90,13 @@ class SubscriptionAdmin(admin.ModelAdmin):
             'fields': (('user', 'plan',), ('start', 'expiration_date',), 'active',),
         }),
     )
-    search_fields = ("user__name", "plan__name", "plan__description")
-    ordering = ("user", 'plan', 'start', 'expiration_date', 'value', 'active', 'payment_id')
+    # точные совпадения и префиксы: идут по индексам на UPPER(email), UPPER(payment_id) и UPPER(name),
+    # планов единицы, подписки плана находятся по индексу внешнего ключа
+    search_fields = ('=user__email', '=payment_id', '^user__name', '^plan__name')
+    ordering = ('-id',)
     inlines = (SubscriptionFreezeInline,)
+    actions = (export_ndjson, export_csv)
+    export_fields = SUBSCRIPTION_EXPORT_FIELDS
 
 
 class SubscriptionPlanAdmin(admin.ModelAdmin):
@@ -74,11 +130,69 @@ class SubscriptionActionAdmin(admin.ModelAdmin):
     ordering = ('name', 'value', 'code', 'description',)
 
 
+class RepairOfferAdmin(LargeTableAdmin):
+    model = RepairOffer
+    list_display = ('id', 'title', 'owner', 'master', 'private', 'created')
+    list_select_related = ('owner', 'master')
+    list_filter = ('private',)
+    search_fields = ('=owner__email', '=master__email')
+    ordering = ('-id',)
+    raw_id_fields = ('owner', 'master', 'owner_grade', 'master_grade', 'views', 'canceled_masters')
+    actions = (export_ndjson, export_csv)
+    export_fields = OFFER_EXPORT_FIELDS
+
+
+class GradeAdmin(LargeTableAdmin):
+    model = Grade
+    list_display = ('id', '__str__', 'created')
+    list_select_related = ('rating_user', 'valued_user')
+    list_filter = ('grade',)
+    search_fields = ('=rating_user__email', '=valued_user__email')
+    ordering = ('-id',)
+    raw_id_fields = ('rating_user', 'valued_user', 'offer')
+    actions = (export_ndjson, export_csv)
+    export_fields = GRADE_EXPORT_FIELDS
+
+
+class MessageAdmin(LargeTableAdmin):
+    model = Message
+    list_display = ('id', 'chat', 'user', 'created', 'deleted', 'tech')
+    list_select_related = ('chat', 'user')
+    list_filter = ('deleted', 'tech')
+    search_fields = ('=user__email',)
+    ordering = ('-id',)
+    raw_id_fields = ('user', 'reply', 'chat', 'have_read')
+    actions = (export_ndjson, export_csv)
+    export_fields = MESSAGE_EXPORT_FIELDS
+
+
+class CommentAdmin(LargeTableAdmin):
+    model = Comment
+    list_display = ('id', '__str__', 'offer', 'created')
+    list_select_related = ('user', 'offer')
+    search_fields = ('=user__email',)
+    raw_id_fields = ('offer', 'reply', 'user', 'users_liked')
+    ordering = ('-id',)
+
+
+class UserAdmin(LargeTableAdmin):
+    model = User
+    list_display = ('email', 'name', 'role', 'is_active', 'is_staff')
+    list_filter = ('role', 'is_active', 'is_staff')
+    search_fields = ('=email',)
+    raw_id_fields = ('trusted_masters',)
+    ordering = ('-id',)
+
+
 admin.site.register(Subscription, SubscriptionAdmin)
 admin.site.register(SubscriptionPlan, SubscriptionPlanAdmin)
 admin.site.register(SubscriptionAction, SubscriptionActionAdmin)
+admin.site.register(RepairOffer, RepairOfferAdmin)
+admin.site.register(Grade, GradeAdmin)
+admin.site.register(Message, MessageAdmin)
+admin.site.register(Comment, CommentAdmin)
 
-admin.site.register(User)
+admin.site.register(User, UserAdmin)
 admin.site.register(Car)
 admin.site.register(CarBrand)
 admin.site.register(RepairCategory)
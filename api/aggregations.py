@@ -11,15 +11,24 @@ from django.db.models import OuterRef
 from django.db.models import Subquery
 from django.db.models import Q
 from django.db.models import F
+from django.db.models.functions import Coalesce
 from django.utils import timezone
+from .models import Comment
 from .models import Message
 from .models import Subscription
-from .models import SubscriptionPlan
-from .models import SubscriptionAction
+from .models import SubscriptionFreeze
+from .catalog import subscription_catalog
 
 
 def annotate_comments_likes_count(queryset):
-    return queryset.annotate(users_liked_count=Count('users_liked', output_field=IntegerField()))
+    # счетчик ведется в Comment.like/unlike, аннотация оставлена для сортировки ?ordering=users_liked_count
+    return queryset.annotate(users_liked_count=F('likes_count'))
+
+
+def annotate_comments_replies_count(queryset):
+    replies = Comment.objects.filter(reply=OuterRef('pk')).order_by().values('reply').annotate(
+        count=Count('pk')).values('count')
+    return queryset.annotate(replies_count=Coalesce(Subquery(replies), 0, output_field=IntegerField()))
 
 
 def annotate_repair_offers_views_count(queryset):
@@ -52,6 +61,11 @@ def annotate_repair_offers_my_my_accept_free(queryset, user_id):
     )
 
 
+def annotate_subscriptions_is_freeze(queryset):
+    freezes = SubscriptionFreeze.objects.filter(subscription=OuterRef('pk'), period__contains=timezone.now().date())
+    return queryset.annotate(is_freeze_now=Exists(freezes))
+
+
 def annotate_repair_offers_completed(queryset):
     return queryset.annotate(completed=Case(
         When(Q(owner_grade__isnull=False, master_grade__isnull=False), then=Value(True, BooleanField())),
@@ -86,29 +100,27 @@ def annotate_masters_is_trusted(queryset, user):
     return queryset.annotate(is_trusted=Exists(user.trusted_masters.filter(pk=OuterRef('pk'))))
 
 
-def annotate_comment_is_liked(queryset, user):
-    return queryset.annotate(is_liked=Exists(user.liked_comments.filter(pk=OuterRef('pk'))))
-
-
 def annotate_user_subscription_action_permitted(queryset, action_code):
     now = timezone.now().date()
-    if not SubscriptionAction.objects.filter(code=action_code).exists():
+    if not subscription_catalog.action_exists(action_code):
         return queryset
     user_sub = Subscription.objects.filter(
         user=OuterRef('pk'),
         active=True,
-        start__lte=now,
-        expiration_date__gt=now
+        period__contains=now
     ).order_by('-start')
+    permitted_plans = subscription_catalog.get_plans_with_action(action_code)
     return queryset.annotate(
         active_subscription_exist=Exists(user_sub),
         current_plan_id=Case(
             When(Q(active_subscription_exist=True), then=Subquery(user_sub.values('plan__id')[:1])),
-            default=SubscriptionPlan.objects.get(default=True).id,
+            default=subscription_catalog.get_default_plan().id,
             output_field=IntegerField()
         )
     ).annotate(**{
-        action_code + '__permitted': Exists(
-            SubscriptionAction.objects.filter(code=action_code, subscriptionplan=OuterRef('current_plan_id'))
+        action_code + '__permitted': Case(
+            When(Q(current_plan_id__in=permitted_plans), then=Value(True)),
+            default=Value(False),
+            output_field=BooleanField()
         )
     })
@@ -1,6 +1,11 @@
 from django.apps import AppConfig
+from django.db.models.signals import pre_migrate
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from .signals import create_postgres_extensions
+        pre_migrate.connect(create_postgres_extensions, sender=self)
@@ -0,0 +1,248 @@
+import hashlib
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.cache import caches
+from django.db.models import Count
+from django.db.models import Max
+from django.http import HttpResponse
+from django.http import HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_datetime
+from django.utils import timezone
+from django.utils.http import http_date
+from django.utils.http import parse_etags
+from django.utils.http import parse_http_date_safe
+from rest_framework.filters import OrderingFilter
+from rest_framework.response import Response
+
+from .exceptions import BadRequest
+
+
+def get_datetime_param(request, name):
+    # ISO 8601 из query string; '+' смещения в незакодированном URL приходит пробелом
+    value = request.query_params.get(name)
+    if not value:
+        return None
+    try:
+        parsed = parse_datetime(value.replace(' ', '+'))
+    except ValueError:
+        parsed = None
+    if parsed is None:
+        raise BadRequest(f'Параметр {name} должен быть датой и временем в формате ISO 8601')
+    return parsed
+
+
+def get_version_key(model):
+    return f'model_version:{model._meta.label_lower}'
+
+
+class SharedVersions:
+    """
+    Версии в общем для всех процессов кэше и их копия в памяти процесса: общий кэш по ключу
+    читается не чаще, чем раз в interval_setting секунд.
+    Своя запись видна в процессе сразу, чужая - в пределах интервала.
+    """
+
+    def __init__(self, interval_setting):
+        self.interval_setting = interval_setting
+        self._local = {}
+
+    def get_many(self, keys):
+        now = time.monotonic()
+        interval = getattr(settings, self.interval_setting)
+        stale = [key for key in keys if key not in self._local or now - self._local[key][1] >= interval]
+        if stale:
+            shared = caches['shared']
+            versions = shared.get_many(stale)
+            for key in stale:
+                if key not in versions:
+                    # версии еще нет или она вытеснена: add не перетрет значение, записанное другим процессом
+                    shared.add(key, time.time_ns(), timeout=None)
+                    versions[key] = shared.get(key)
+                self._local[key] = (versions[key], now)
+        return [self._local[key][0] for key in keys]
+
+    def get(self, key):
+        return self.get_many([key])[0]
+
+    def bump(self, key):
+        # новое значение записывается целиком: incr в DatabaseCache - это get и set,
+        # и параллельные увеличения склеились бы в одну версию
+        version = time.time_ns()
+        caches['shared'].set(key, version, timeout=None)
+        self._local[key] = (version, time.monotonic())
+        return version
+
+
+# версии моделей - в общем кэше, чтобы изменение в одном процессе сбрасывало ответы во всех;
+# сами ответы лежат в локальном кэше процесса под ключом, в который входят версии
+model_versions = SharedVersions('RESPONSE_CACHE_VERSION_CHECK_INTERVAL')
+
+
+def bump_model_version(model):
+    model_versions.bump(get_version_key(model))
+
+
+def get_model_versions(models):
+    return model_versions.get_many([get_version_key(model) for model in models])
+
+
+class VersionedCacheMixin:
+    # модели, от которых зависит ответ: их сохранение или удаление сбрасывает кэш
+    cache_models = list()
+
+    def get_cache_models(self):
+        return self.cache_models
+
+    def get_cache_key(self, request):
+        versions = get_model_versions(self.get_cache_models())
+        raw = ':'.join([
+            self.__class__.__name__, self.action, request.accepted_renderer.format, request.build_absolute_uri(),
+            *[str(v) for v in versions], *self.get_cache_key_extra(request)
+        ])
+        return 'response:' + hashlib.md5(raw.encode()).hexdigest()
+
+    def get_cache_key_extra(self, request):
+        return []
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.accepted_renderer.format != 'json':
+            return handler(request, *args, **kwargs)
+
+        key = self.get_cache_key(request)
+        etag = f'"{key.split(":")[1]}"'
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            response = HttpResponse(status=304)
+            response['ETag'] = etag
+            return response
+
+        cached = cache.get(key)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+            response['ETag'] = etag
+            return response
+
+        response = handler(request, *args, **kwargs)
+        if isinstance(response, Response) and response.status_code == 200:
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            response.render()
+            cache.set(key, (response.content, response['Content-Type']), timeout=settings.RESPONSE_CACHE_TIMEOUT)
+            response['ETag'] = etag
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super(VersionedCacheMixin, self).list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super(VersionedCacheMixin, self).retrieve, request, *args, **kwargs)
+
+
+def get_deleted_key(model):
+    return f'model_deleted:{model._meta.label_lower}'
+
+
+def record_model_delete(model):
+    # удаление не оставляет строки с updated, поэтому его время хранится отдельно
+    caches['shared'].set(get_deleted_key(model), timezone.now(), timeout=None)
+
+
+def get_model_deleted(model):
+    return caches['shared'].get(get_deleted_key(model))
+
+
+class ChangeTrackingMixin:
+    """
+    Условные GET по полю updated модели: ETag и Last-Modified у списка и объекта,
+    304 отдается до сериализации. Фильтр ?updated_since=<ISO 8601> - только изменившиеся записи.
+    Состояние для ETag: у списка - max(updated) и число строк после фильтров, у объекта - его updated.
+    If-Modified-Since проверяется, только если нет If-None-Match. Last-Modified списка - последнее изменение
+    или удаление любой записи модели: строка, ушедшая из-под фильтра, не меняет max(updated) остальных.
+    """
+    updated_field = 'updated'
+
+    def get_conditional_queryset(self):
+        # queryset без тяжелых аннотаций: по нему считается только состояние для ETag
+        return self.get_queryset()
+
+    def filter_queryset(self, queryset):
+        queryset = super(ChangeTrackingMixin, self).filter_queryset(queryset)
+        updated_since = get_datetime_param(self.request, 'updated_since')
+        if updated_since is not None:
+            queryset = queryset.filter(**{f'{self.updated_field}__gt': updated_since})
+        return queryset
+
+    def get_list_state(self):
+        # сортировка на состояние не влияет, а по аннотациям без них не построится
+        backends = self.filter_backends
+        self.filter_backends = [backend for backend in backends if not issubclass(backend, OrderingFilter)]
+        try:
+            queryset = self.filter_queryset(self.get_conditional_queryset())
+        finally:
+            self.filter_backends = backends
+        state = queryset.order_by().aggregate(last_modified=Max(self.updated_field), count=Count('pk'))
+        return state['last_modified'], state['count']
+
+    def get_list_last_modified(self):
+        model = self.get_conditional_queryset().model
+        updated = model._default_manager.order_by().aggregate(value=Max(self.updated_field))['value']
+        return max([value for value in (updated, get_model_deleted(model)) if value is not None], default=None)
+
+    def get_object_state(self):
+        lookup = self.lookup_url_kwarg or self.lookup_field
+        queryset = self.get_conditional_queryset().filter(**{self.lookup_field: self.kwargs[lookup]})
+        last_modified = queryset.values_list(self.updated_field, flat=True).first()
+        return last_modified, int(last_modified is not None)
+
+    @staticmethod
+    def get_http_timestamp(last_modified):
+        # Last-Modified точен до секунды: отдаем его, только когда секунда изменения прошла, и округляем вверх.
+        # тогда любое следующее изменение позже заголовка, и правка в ту же секунду не даст 304 на старые данные
+        if last_modified is None:
+            return None
+        timestamp = math.ceil(last_modified.timestamp())
+        return timestamp if timestamp < time.time() else None
+
+    def conditional_response(self, handler, state, get_last_modified, request, *args, **kwargs):
+        last_modified, count = state
+        # ответ зависит от пользователя (my, free и т.п.), поэтому он входит в ETag
+        raw = ':'.join([self.__class__.__name__, self.action, request.build_absolute_uri(), str(request.user.pk),
+                        last_modified.isoformat() if last_modified else '', str(count)])
+        etag = f'"{hashlib.md5(raw.encode()).hexdigest()}"'
+
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        timestamp = None
+        if if_none_match is not None:
+            not_modified = if_none_match.strip() == '*' or etag in parse_etags(if_none_match)
+        else:
+            timestamp = self.get_http_timestamp(get_last_modified())
+            since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+            not_modified = timestamp is not None and since is not None and timestamp <= since
+
+        if not_modified:
+            response = HttpResponseNotModified()
+        else:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if if_none_match is not None:
+                timestamp = self.get_http_timestamp(get_last_modified())
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+        response['ETag'] = etag
+        patch_vary_headers(response, ['Authorization'])
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super(ChangeTrackingMixin, self).list, self.get_list_state(),
+                                         self.get_list_last_modified, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        state = self.get_object_state()
+        return self.conditional_response(super(ChangeTrackingMixin, self).retrieve, state, lambda: state[0],
+                                         request, *args, **kwargs)
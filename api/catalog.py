@@ -0,0 +1,103 @@
+import threading
+import time
+import uuid
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import caches
+from django.utils import timezone
+
+
+class CatalogState:
+    # снимок каталога; после сборки не меняется, читатели видят его целиком или не видят вовсе
+    def __init__(self, version, plans, actions):
+        affecting_codes = [action.code for action in actions if not action.not_affect]
+        self.version = version
+        self.plans = plans
+        self.default_plan_id = next((plan.id for plan in plans.values() if plan.default), None)
+        self.action_codes = frozenset(action.code for action in actions)
+        self.plan_action_codes = {
+            plan.id: frozenset(action.code for action in plan.actions.all()) for plan in plans.values()
+        }
+        self.permissions = {
+            plan_id: {code: code in codes for code in affecting_codes}
+            for plan_id, codes in self.plan_action_codes.items()
+        }
+
+
+# планы подписок, их функционал и карты разрешений в памяти процесса.
+# каталог перечитывается, когда в общем для всех процессов кэше меняется его версия;
+# версия сверяется не чаще SUBSCRIPTION_CATALOG_CHECK_INTERVAL секунд
+class SubscriptionCatalog:
+    version_key = 'subscription_catalog_version'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = None
+        self._checked = float('-inf')
+
+    def _get_shared_version(self):
+        return caches['shared'].get_or_set(self.version_key, uuid.uuid4().hex, timeout=None)
+
+    @staticmethod
+    def _load(version):
+        SubscriptionPlan = apps.get_model('api', 'SubscriptionPlan')
+        SubscriptionAction = apps.get_model('api', 'SubscriptionAction')
+
+        plans = {plan.id: plan for plan in SubscriptionPlan.objects.prefetch_related('actions')}
+        return CatalogState(version, plans, list(SubscriptionAction.objects.all()))
+
+    def _ensure_loaded(self):
+        state = self._state
+        if state is not None and time.monotonic() - self._checked < settings.SUBSCRIPTION_CATALOG_CHECK_INTERVAL:
+            return state
+        version = self._get_shared_version()
+        with self._lock:
+            if self._state is None or self._state.version != version:
+                self._state = self._load(version)
+            self._checked = time.monotonic()
+            return self._state
+
+    def invalidate(self):
+        caches['shared'].set(self.version_key, uuid.uuid4().hex, timeout=None)
+        # свой процесс перечитывает каталог сразу, не дожидаясь сверки версии
+        with self._lock:
+            self._state = None
+
+    @staticmethod
+    def is_plan_available(plan, date=None):
+        date = date or timezone.now().date()
+        if plan.active_date_start and plan.active_date_start > date:
+            return False
+        if plan.active_date_end and plan.active_date_end < date:
+            return False
+        return True
+
+    def get_plan(self, plan_id):
+        try:
+            return self._ensure_loaded().plans[plan_id]
+        except KeyError:
+            raise apps.get_model('api', 'SubscriptionPlan').DoesNotExist
+
+    def get_default_plan(self, available_only=False):
+        state = self._ensure_loaded()
+        plan = state.plans.get(state.default_plan_id)
+        if plan is None or (available_only and not self.is_plan_available(plan)):
+            raise apps.get_model('api', 'SubscriptionPlan').DoesNotExist
+        return plan
+
+    def action_exists(self, action_code: str):
+        return action_code in self._ensure_loaded().action_codes
+
+    def plan_has_action(self, plan_id, action_code: str):
+        return action_code in self._ensure_loaded().plan_action_codes.get(plan_id, ())
+
+    def get_plans_with_action(self, action_code: str):
+        plan_action_codes = self._ensure_loaded().plan_action_codes
+        return [plan_id for plan_id, codes in plan_action_codes.items() if action_code in codes]
+
+    def get_permissions(self, plan_id):
+        return dict(self._ensure_loaded().permissions.get(plan_id, {}))
+
+
+subscription_catalog = SubscriptionCatalog()
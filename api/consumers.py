@@ -1,45 +1,166 @@
+import asyncio
+import collections
+import time
+
 from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
+from channels.layers import get_channel_layer
 from rest_framework.utils import json, encoders
 
+from django.conf import settings
 from django.core.files.base import ContentFile
 
 # локальные импорты
-from .models import Chat
 from .models import Message
+from .models import Subscription
+from .offer_feed import category_group
+from .presence import presence
+from .membership import chat_membership
 from .serializers import MessageSerializer
 
+from fixithere import metrics
+
 from base64 import b64decode
 
 
-class ChatConsumer(WebsocketConsumer):
+class InstrumentedWebsocketConsumer(WebsocketConsumer):
+    room_group_name = None
+    accepted = False
+
+    def accept(self, subprotocol=None):
+        super(InstrumentedWebsocketConsumer, self).accept(subprotocol)
+        self.accepted = True
+        metrics.websocket_connections.inc(consumer=self.__class__.__name__)
+
+    def disconnect(self, close_code):
+        if self.room_group_name:
+            async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
+        if self.accepted:
+            self.accepted = False
+            metrics.websocket_connections.dec(consumer=self.__class__.__name__)
+
+    def send_event(self, event):
+        if 'sent_at' in event:
+            metrics.websocket_delivery_latency.observe(
+                time.time() - event['sent_at'], consumer=self.__class__.__name__
+            )
+        self.send(text_data=event["message"])
+
+
+def parse_client_event(text_data):
+    # сообщения клиента: {"type": "heartbeat" | "typing" | "presence"}
+    try:
+        event = json.loads(text_data or '')
+    except ValueError:
+        return None
+    return event.get('type') if isinstance(event, dict) else None
+
+
+def chat_event(event_type, data):
+    return {'type': event_type, 'message': json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False)}
+
+
+def chat_group(chat_id):
+    return f'chat-{chat_id}'
+
+
+# рассылки присутствия, которые не вызваны сообщением клиента, идут задачами в цикле событий ASGI:
+# отложенный до конца окна typing и выход участника по PRESENCE_TTL
+async def flush_typing_later(chat_id, delay):
+    await asyncio.sleep(delay)
+    users = presence.flush_typing(chat_id)
+    if users is not None:
+        await get_channel_layer().group_send(
+            chat_group(chat_id), chat_event('chat_typing', {'type': 'typing', 'chat': chat_id, 'users': users}))
+
+
+async def sweep_presence():
+    while True:
+        await asyncio.sleep(presence.sweep_interval)
+        for chat_id, online in presence.sweep().items():
+            event = chat_event('chat_presence', {'type': 'presence', 'chat': chat_id, 'online': online})
+            await get_channel_layer().group_send(chat_group(chat_id), event)
+
+
+# на задачу без ссылок цикл событий хранит только слабую ссылку: держим их до завершения
+presence_tasks = set()
+presence_sweeper = None
+
+
+async def start_presence_task(coroutine):
+    task = asyncio.ensure_future(coroutine)
+    presence_tasks.add(task)
+    task.add_done_callback(presence_tasks.discard)
+
+
+async def ensure_presence_sweeper():
+    # один обход на процесс; упавший перезапускается следующим подключением
+    global presence_sweeper
+    if presence_sweeper is None or presence_sweeper.done():
+        presence_sweeper = asyncio.ensure_future(sweep_presence())
+
+
+class ChatConsumer(InstrumentedWebsocketConsumer):
+    """
+    Сообщения чата. Клиент шлет {"type": "heartbeat"} чаще PRESENCE_TTL и {"type": "typing"}, пока печатает;
+    в чат рассылаются {"type": "presence", "online": [...]} при входе и выходе участника (в том числе по PRESENCE_TTL)
+    и {"type": "typing", "users": [...]} не чаще PRESENCE_TYPING_RATE раз в секунду, события внутри окна - в его конце.
+    """
+
     def connect(self):
-        if not self.scope['user'].is_active:
+        user = self.scope['user']
+        if not user.is_active:
             return self.close()
-        try:
-            chat = Chat.objects.get(id=self.scope['url_route']['kwargs']['pk'])
-            self.chat = chat
-            self.room_name = str(chat.id)
-            self.room_group_name = 'chat-' + self.room_name
-            async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
-            self.accept()
-        except Chat.DoesNotExist:
-            self.close()
+        # только участники; проверка по участникам в памяти процесса, без join по participants
+        self.chat_id = self.scope['url_route']['kwargs']['pk']
+        if not chat_membership.is_participant(user.id, self.chat_id):
+            return self.close()
+        self.room_name = str(self.chat_id)
+        self.room_group_name = chat_group(self.chat_id)
+        async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
+        self.accept()
+        async_to_sync(ensure_presence_sweeper)()
+        if presence.join(self.channel_name, user.id, self.chat_id):
+            self.send_presence()
 
     def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)()
+        left = presence.leave(self.channel_name)
+        super(ChatConsumer, self).disconnect(close_code)
+        if left:
+            self.send_presence()
 
     def receive(self, text_data=None, bytes_data=None):
-        pass
+        user_id = self.scope['user'].id
+        if not presence.heartbeat(self.channel_name) and presence.join(self.channel_name, user_id, self.chat_id):
+            self.send_presence()
+        if parse_client_event(text_data) == 'typing':
+            users, flush_in = presence.typing(self.chat_id, user_id)
+            if users is not None:
+                self.send_to_chat('chat_typing', {'type': 'typing', 'chat': self.chat_id, 'users': users})
+            elif flush_in is not None:
+                async_to_sync(start_presence_task)(flush_typing_later(self.chat_id, flush_in))
+
+    def send_presence(self):
+        online = presence.chat_online(self.chat_id)
+        self.send_to_chat('chat_presence', {'type': 'presence', 'chat': self.chat_id, 'online': online})
+
+    def send_to_chat(self, event_type, data):
+        async_to_sync(self.channel_layer.group_send)(self.room_group_name, chat_event(event_type, data))
 
     def chat_message(self, event):
-        self.send(text_data=event["message"])
+        self.send_event(event)
 
     def read_messages(self, event):
-        self.send(text_data=event["message"])
+        self.send_event(event)
 
+    def chat_presence(self, event):
+        self.send_event(event)
 
-class UserMessagesConsumer(WebsocketConsumer):
+    def chat_typing(self, event):
+        self.send_event(event)
+
+
+class UserMessagesConsumer(InstrumentedWebsocketConsumer):
     def connect(self):
         user = self.scope['user']
         if user.is_anonymous or not user.is_active:
@@ -48,15 +169,43 @@ class UserMessagesConsumer(WebsocketConsumer):
         self.room_group_name = 'messages-' + self.room_name
         async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
         self.accept()
+        presence.join(self.channel_name, user.id)
 
     def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)()
+        presence.leave(self.channel_name)
+        super(UserMessagesConsumer, self).disconnect(close_code)
+
+    @staticmethod
+    def load_inbox(user_id):
+        # собеседники по чатам пользователя из кэша участников: {chat_id: [user_id, ...]}
+        participants = chat_membership.get_participants_many(chat_membership.get_user_chats(user_id))
+        return {chat_id: [u for u in members if u != user_id] for chat_id, members in participants.items()}
+
+    def receive(self, text_data=None, bytes_data=None):
+        # {"type": "heartbeat"} держит пользователя в сети, {"type": "presence"} - кто в сети среди собеседников
+        user_id = self.scope['user'].id
+        if not presence.heartbeat(self.channel_name):
+            presence.join(self.channel_name, user_id)
+        if parse_client_event(text_data) == 'presence':
+            self.send(text_data=json.dumps(self.get_inbox_presence()))
+
+    def get_inbox_presence(self):
+        inbox = self.load_inbox(self.scope['user'].id)
+        online = presence.online({user_id for members in inbox.values() for user_id in members})
+        return {
+            'type': 'presence',
+            'online': sorted(online),
+            'chats': {chat_id: [u for u in members if u in online] for chat_id, members in inbox.items()},
+        }
 
     def new_message(self, event):
-        self.send(text_data=event["message"])
+        self.send_event(event)
 
+    def new_activity(self, event):
+        self.send_event(event)
 
-class SubscriptionPermissionsConsumer(WebsocketConsumer):
+
+class SubscriptionPermissionsConsumer(InstrumentedWebsocketConsumer):
     def connect(self):
         if not self.scope['user'].is_active:
             return self.close()
@@ -65,8 +214,48 @@ class SubscriptionPermissionsConsumer(WebsocketConsumer):
         async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
         self.accept()
 
+    def change_permissions(self, event):
+        self.send_event(event)
+
+
+class OfferFeedConsumer(InstrumentedWebsocketConsumer):
+    """
+    Новые публичные офферы для мастера по его категориям ремонта.
+    Соединение состоит в группе offers-category-<id> каждой своей категории.
+    Категории берутся в момент подключения: после их смены нужно переподключиться.
+    """
+    seen_offers_limit = 200
+
+    def connect(self):
+        user = self.scope['user']
+        if user.is_anonymous or not user.is_active or user.role != 'master':
+            return self.close()
+        if not Subscription.check_action(user, 'can_take_offers', raise_exception=False):
+            return self.close()
+        self.permission_checked_at = time.monotonic()
+        self.seen_offers = collections.deque(maxlen=self.seen_offers_limit)
+        self.groups_joined = [category_group(c) for c in user.repair_categories.values_list('id', flat=True)]
+        for group in self.groups_joined:
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
+        self.accept()
+
     def disconnect(self, close_code):
-        async_to_sync(self.channel_layer.group_discard)()
+        for group in getattr(self, 'groups_joined', []):
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
+        super(OfferFeedConsumer, self).disconnect(close_code)
 
-    def change_permissions(self, event):
-        self.send(text_data=event["message"])
+    def has_permission(self):
+        # подписка могла закончиться во время соединения: перепроверяем не чаще раза в OFFER_FEED_PERMISSION_TTL
+        if time.monotonic() - self.permission_checked_at > settings.OFFER_FEED_PERMISSION_TTL:
+            self.permission_checked_at = time.monotonic()
+            if not Subscription.check_action(self.scope['user'], 'can_take_offers', raise_exception=False):
+                self.close()
+                return False
+        return True
+
+    def new_offer(self, event):
+        if event['offer_id'] in self.seen_offers or event['owner_id'] == self.scope['user'].id:
+            return
+        self.seen_offers.append(event['offer_id'])
+        if self.has_permission():
+            self.send_event(event)
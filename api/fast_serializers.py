@@ -0,0 +1,213 @@
+import threading
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Count
+from django.db.models import F
+from django.db.models import FileField as ModelFileField
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField
+from rest_framework.relations import PrimaryKeyRelatedField
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+PARENT_KEY = '_fast_parent'
+
+
+class UnsupportedField(Exception):
+    pass
+
+
+def get_ordering(model, prefix=''):
+    ordering = model._meta.ordering or [model._meta.pk.name]
+    return [f'-{prefix}{o[1:]}' if o.startswith('-') else prefix + o for o in ordering]
+
+
+def get_related_source(relation):
+    # откуда читать связанные строки: (модель, поле родителя, префикс колонок, сортировка).
+    # m2m читаем из промежуточной таблицы, чтобы не было лишнего join-а для колонок родителя.
+    # relation.all() порядок не задает, поэтому сортируем по Meta.ordering связанной модели или pk
+    if relation.many_to_many:
+        if relation.auto_created:
+            through, parent_fk, target_fk = relation.through, relation.field.m2m_reverse_field_name(), \
+                relation.field.m2m_field_name()
+        else:
+            through, parent_fk, target_fk = relation.remote_field.through, relation.m2m_field_name(), \
+                relation.m2m_reverse_field_name()
+        prefix = target_fk + '__'
+        return through, parent_fk, prefix, get_ordering(relation.related_model, prefix)
+    return relation.related_model, relation.field.name, '', get_ordering(relation.related_model)
+
+
+def get_related_queryset(relation, ids):
+    model, parent_fk, prefix, ordering = get_related_source(relation)
+    return model.objects.filter(**{f'{parent_fk}__in': ids}).annotate(**{PARENT_KEY: F(parent_fk)}).order_by(*ordering)
+
+
+class Projection:
+    """
+    Дерево полей сериализатора, скомпилированное в проекцию values() и построитель словарей.
+    Представления значений берутся из полей DRF, поэтому JSON совпадает с обычным сериализатором.
+    """
+
+    def __init__(self, serializer, model, annotations=(), prefix=''):
+        self.model = model
+        self.columns = []
+        self.prefetches = []
+        self.getters = self.compile(serializer, model, prefix, set(annotations))
+
+    def add_column(self, column):
+        if column not in self.columns:
+            self.columns.append(column)
+        return column
+
+    def compile(self, serializer, model, prefix, annotations):
+        getters = []
+        counts = getattr(serializer, 'fast_counts', {})
+        pk_column = self.add_column(prefix + model._meta.pk.name)
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            source = field.source.replace('.', '__')
+
+            if isinstance(field, serializers.ListSerializer):
+                relation = model._meta.get_field(source)
+                child = Projection(field.child, relation.related_model, prefix=get_related_source(relation)[2])
+                getters.append((name, self.add_prefetch(pk_column, 'nested', relation, child)))
+            elif isinstance(field, serializers.BaseSerializer):
+                relation = model._meta.get_field(source)
+                null_column = self.add_column(prefix + source)
+                nested = self.compile(field, relation.related_model, f'{prefix}{source}__', set())
+                getters.append((name, self.nested_getter(null_column, nested)))
+            elif isinstance(field, serializers.SerializerMethodField):
+                if name not in counts:
+                    raise UnsupportedField(name)
+                relation = model._meta.get_field(counts[name])
+                getters.append((name, self.add_prefetch(pk_column, 'count', relation)))
+            elif isinstance(field, ManyRelatedField):
+                relation = model._meta.get_field(source)
+                getters.append((name, self.add_prefetch(pk_column, 'pks', relation)))
+            elif isinstance(field, PrimaryKeyRelatedField):
+                column = self.add_column(prefix + source)
+                getters.append((name, lambda row, ctx, column=column: row[column]))
+            else:
+                getter = self.compile_value(field, model, prefix, source, annotations)
+                if getter is not None:
+                    getters.append((name, getter))
+        return getters
+
+    def compile_value(self, field, model, prefix, source, annotations):
+        try:
+            model_field = model._meta.get_field(source)
+        except FieldDoesNotExist:
+            if source in annotations:
+                column = self.add_column(source)
+                return self.value_getter(column, field.to_representation)
+            if hasattr(model, source):
+                raise UnsupportedField(source)
+            # атрибута нет у объекта - DRF пропускает такое read-only поле
+            return None
+        if model_field.is_relation:
+            raise UnsupportedField(source)
+        column = self.add_column(prefix + source)
+        if isinstance(model_field, ModelFileField) and isinstance(field, serializers.FileField):
+            return self.file_getter(column, model_field.storage, getattr(field, 'use_url', None))
+        return self.value_getter(column, field.to_representation)
+
+    def add_prefetch(self, pk_column, kind, relation, child=None):
+        index = len(self.prefetches)
+        self.prefetches.append((pk_column, kind, relation, child))
+        return lambda row, ctx: ctx[self][index].get(row[pk_column], [] if kind != 'count' else 0)
+
+    @staticmethod
+    def value_getter(column, to_representation):
+        def getter(row, ctx):
+            value = row[column]
+            return None if value is None else to_representation(value)
+        return getter
+
+    @staticmethod
+    def file_getter(column, storage, use_url):
+        use_url = api_settings.UPLOADED_FILES_USE_URL if use_url is None else use_url
+
+        def getter(row, ctx):
+            name = row[column]
+            if not name:
+                return None
+            if not use_url:
+                return name
+            url = storage.url(name)
+            return ctx['request'].build_absolute_uri(url) if ctx['request'] is not None else url
+        return getter
+
+    @staticmethod
+    def nested_getter(null_column, getters):
+        def getter(row, ctx):
+            if row[null_column] is None:
+                return None
+            return {name: get(row, ctx) for name, get in getters}
+        return getter
+
+    def fetch_related(self, rows, ctx):
+        results = []
+        for pk_column, kind, relation, child in self.prefetches:
+            ids = {row[pk_column] for row in rows if row[pk_column] is not None}
+            grouped = {}
+            if ids:
+                queryset = get_related_queryset(relation, ids)
+                if kind == 'count':
+                    queryset = queryset.order_by().values(PARENT_KEY).annotate(c=Count('pk'))
+                    grouped = {row[PARENT_KEY]: row['c'] for row in queryset}
+                elif kind == 'pks':
+                    target_pk = get_related_source(relation)[2] + relation.related_model._meta.pk.name
+                    for parent, pk in queryset.values_list(PARENT_KEY, target_pk):
+                        grouped.setdefault(parent, []).append(pk)
+                else:
+                    child_rows = list(queryset.values(PARENT_KEY, *child.columns))
+                    for parent, data in zip([row[PARENT_KEY] for row in child_rows], child.serialize(child_rows, ctx)):
+                        grouped.setdefault(parent, []).append(data)
+            results.append(grouped)
+        ctx[self] = results
+
+    def serialize(self, rows, ctx):
+        self.fetch_related(rows, ctx)
+        getters = self.getters
+        return [{name: get(row, ctx) for name, get in getters} for row in rows]
+
+
+_projections = {}
+_projections_lock = threading.Lock()
+
+
+def get_projection(serializer, queryset):
+    annotations = tuple(sorted(queryset.query.annotations))
+    key = (serializer.__class__, annotations)
+    projection = _projections.get(key)
+    if projection is None:
+        with _projections_lock:
+            projection = _projections.get(key)
+            if projection is None:
+                projection = Projection(serializer, queryset.model, annotations)
+                _projections[key] = projection
+    return projection
+
+
+class FastListMixin:
+    # включает для list выборку через values() вместо создания моделей и ModelSerializer
+    fast_list = False
+
+    def list(self, request, *args, **kwargs):
+        if not (self.fast_list and settings.FAST_LIST_SERIALIZERS):
+            return super(FastListMixin, self).list(request, *args, **kwargs)
+        queryset = self.filter_queryset(self.get_queryset())
+        try:
+            projection = get_projection(self.get_serializer(), queryset)
+        except UnsupportedField:
+            return super(FastListMixin, self).list(request, *args, **kwargs)
+
+        rows = queryset.values(*projection.columns)
+        ctx = {'request': request}
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(projection.serialize(list(page), ctx))
+        return Response(projection.serialize(list(rows), ctx))
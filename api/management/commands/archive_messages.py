@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+
+from api.partitions import add_months
+from api.partitions import archive_partition
+from api.partitions import archived_months
+from api.partitions import is_partitioned
+from api.partitions import list_partitions
+from api.partitions import month_start
+from api.partitions import parse_month
+from api.partitions import restore_partition
+
+
+class Command(BaseCommand):
+    help = ('Выгружает месячные партиции сообщений старше --months месяцев в архив (CSV.gz в MESSAGE_ARCHIVE_DIR) '
+            'и удаляет их из базы. --restore ГГГГ-ММ возвращает месяц из архива обратно в базу')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=settings.MESSAGE_ARCHIVE_AFTER_MONTHS)
+        parser.add_argument('--restore', metavar='ГГГГ-ММ')
+        parser.add_argument('--list', action='store_true', help='Показать партиции в базе и в архиве')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            if not is_partitioned(cursor):
+                raise CommandError('Таблица сообщений не секционирована, сначала выполните partition_messages')
+            partitions = list_partitions(cursor)
+
+        if options['list']:
+            self.stdout.write('В базе: ' + ', '.join(f'{month:%Y-%m}' for month in sorted(partitions)))
+            self.stdout.write('В архиве: ' + ', '.join(f'{month:%Y-%m}' for month in archived_months()))
+            return
+
+        if options['restore']:
+            month = parse_month(options['restore'])
+            if month is None:
+                raise CommandError('Месяц указывается в формате ГГГГ-ММ')
+            if month not in archived_months():
+                raise CommandError(f'Архива за {options["restore"]} нет')
+            if not options['dry_run']:
+                restore_partition(month)
+            self.stdout.write(f'Восстановлен месяц {month:%Y-%m}')
+            return
+
+        if options['months'] < 1:
+            raise CommandError('Текущий месяц не архивируется: --months должен быть не меньше 1')
+        border = add_months(month_start(timezone.now()), -options['months'])
+        for month in sorted(month for month in partitions if month < border):
+            if options['dry_run']:
+                self.stdout.write(f'{month:%Y-%m}: будет выгружен')
+                continue
+            counts = archive_partition(month)
+            self.stdout.write(f'{month:%Y-%m}: ' + ', '.join(f'{key} {count}' for key, count in counts.items()))
@@ -0,0 +1,45 @@
+from django.contrib.postgres.fields import DateRangeField
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Func
+from django.db.models import Value
+
+from api.models import Subscription
+from api.models import SubscriptionFreeze
+
+
+def daterange(start, end, bounds):
+    return Func(F(start), F(end), Value(bounds), function='daterange', output_field=DateRangeField())
+
+
+class Command(BaseCommand):
+    help = ('Заполняет period у подписок и заморозок, созданных до появления поля. '
+            'Запускать после миграции, добавившей period: без него активные подписки не находятся')
+
+    def handle(self, *args, **options):
+        self.backfill(Subscription.objects.filter(period=None, start__isnull=False),
+                      daterange('start', 'expiration_date', '[)'), 'Подписок')
+        self.backfill(SubscriptionFreeze.objects.filter(period=None),
+                      daterange('start', 'end', '[]'), 'Заморозок')
+
+    def backfill(self, queryset, period, label):
+        try:
+            with transaction.atomic():
+                self.stdout.write(f'{label} заполнено: {queryset.update(period=period)}')
+                return
+        except IntegrityError:
+            pass
+        # старые пересекающиеся записи не проходят ограничение: заполняем по одной и перечисляем пропущенные
+        updated, skipped = 0, []
+        for pk in queryset.order_by('pk').values_list('pk', flat=True):
+            try:
+                with transaction.atomic():
+                    updated += queryset.filter(pk=pk).update(period=period)
+            except IntegrityError:
+                skipped.append(pk)
+        self.stdout.write(f'{label} заполнено: {updated}')
+        if skipped:
+            self.stdout.write(self.style.WARNING(
+                f'{label} пересекаются с другими и оставлены без периода: {", ".join(map(str, skipped))}'))
@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.test import Client
+from django.test import override_settings
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.models import User
+from api.models import RepairOffer
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает побайтно ответы списков в быстром режиме и через обычные сериализаторы'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=str, default=None, help='Email пользователя, от имени которого идут запросы')
+        parser.add_argument('--pages', type=int, default=5)
+
+    def get_urls(self, user, pages):
+        offer = RepairOffer.objects.filter(private=False).exclude(master=None).order_by('id').first()
+        urls = []
+        for page in range(1, pages + 1):
+            urls += [
+                f'/api/offers/?page={page}&ordering=created',
+                f'/api/offers/?page={page}&page_size=10&ordering=-created',
+                f'/api/masters/?page={page}',
+                f'/api/grades/?page={page}&ordering=created',
+            ]
+        if offer:
+            urls += [
+                f'/api/public_offers/?master={offer.master_id}&ordering=created',
+                f'/api/grades/?valued_user={offer.master_id}&ordering=created',
+                f'/api/offers/?categories={offer.categories.values_list("id", flat=True).first()}&ordering=created',
+            ]
+        return urls
+
+    @staticmethod
+    def same(expected, actual):
+        # вложенные списки в быстром режиме упорядочены так же, как relation.all(), поэтому сравниваем точно
+        return expected.status_code == actual.status_code and expected.content == actual.content
+
+    def handle(self, *args, **options):
+        users = User.objects.filter(email=options['user']) if options['user'] else User.objects.order_by('id')
+        user = users.first()
+        if user is None:
+            raise CommandError('Пользователь не найден')
+        token = str(RefreshToken.for_user(user).access_token)
+        client = Client(SERVER_NAME='localhost', HTTP_AUTHORIZATION=f'Bearer {token}', HTTP_ACCEPT='application/json')
+
+        failed = 0
+        for url in self.get_urls(user, options['pages']):
+            with override_settings(FAST_LIST_SERIALIZERS=False):
+                expected = client.get(url)
+            with override_settings(FAST_LIST_SERIALIZERS=True):
+                actual = client.get(url)
+            if not self.same(expected, actual):
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'{url}: ответы отличаются'))
+                self.stdout.write(f'  обычный: {expected.content[:500]}')
+                self.stdout.write(f'  быстрый: {actual.content[:500]}')
+            else:
+                self.stdout.write(f'{url}: OK')
+        if failed:
+            raise CommandError(f'Отличающихся ответов: {failed}')
+        self.stdout.write(self.style.SUCCESS('Ответы совпадают'))
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import random
+import time
+
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.utils import timezone
+
+from api.offer_feed import category_group
+from api.offer_feed import offer_event
+from api.offer_feed import send_to_categories
+
+from .run_benchmark import percentile
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный тест рассылки офферов по группам категорий: подписчики - каналы слоя каналов '
+            '(как у OfferFeedConsumer), замеряются время group_send и задержка доставки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--subscribers', type=int, default=20000, help='Количество подключенных мастеров')
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--master-categories', type=int, default=3, help='Категорий у одного мастера')
+        parser.add_argument('--offer-categories', type=int, default=2, help='Категорий у одного оффера')
+        parser.add_argument('--offers', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', type=str, default='offer_broadcast_loadtest.json')
+
+    def handle(self, *args, **options):
+        if options['subscribers'] < 1 or options['offers'] < 1:
+            raise CommandError('Количество подписчиков и офферов должно быть положительным')
+        if max(options['master_categories'], options['offer_categories']) > options['categories']:
+            raise CommandError('Категорий у мастера или оффера не может быть больше, чем категорий всего')
+        report = asyncio.run(self.run(options))
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
+
+    async def run(self, options):
+        rnd = random.Random(options['seed'])
+        layer = get_channel_layer()
+        categories = list(range(1, options['categories'] + 1))
+        members = {category_id: [] for category_id in categories}
+
+        started = time.perf_counter()
+        for _ in range(options['subscribers']):
+            channel = await layer.new_channel()
+            for category_id in rnd.sample(categories, options['master_categories']):
+                await layer.group_add(category_group(category_id), channel)
+                members[category_id].append(channel)
+        subscribe_seconds = time.perf_counter() - started
+        self.stdout.write(f'Подписчиков: {options["subscribers"]}, подписка за {subscribe_seconds:.2f} с')
+
+        send_ms, latencies_ms, deliveries, recipients = [], [], [], []
+        try:
+            for offer_id in range(1, options['offers'] + 1):
+                category_ids = rnd.sample(categories, options['offer_categories'])
+                event = offer_event(offer_id, None, {'id': offer_id, 'title': f'Оффер {offer_id}'})
+                sent_at = time.time()
+                send_started = time.perf_counter()
+                await send_to_categories(layer, category_ids, event)
+                send_ms.append((time.perf_counter() - send_started) * 1000)
+
+                expected = [channel for category_id in category_ids for channel in members[category_id]]
+                for channel in expected:
+                    message = await layer.receive(channel)
+                    latencies_ms.append((time.time() - message.get('sent_at', sent_at)) * 1000)
+                deliveries.append(len(expected))
+                recipients.append(len(set(expected)))
+        finally:
+            for category_id, channels in members.items():
+                for channel in channels:
+                    await layer.group_discard(category_group(category_id), channel)
+
+        report = {
+            'created': timezone.now().isoformat(),
+            'layer': type(layer).__name__,
+            'subscribers': options['subscribers'],
+            'categories': options['categories'],
+            'master_categories': options['master_categories'],
+            'offer_categories': options['offer_categories'],
+            'offers': options['offers'],
+            'subscribe_seconds': subscribe_seconds,
+            'deliveries_avg': sum(deliveries) / len(deliveries),
+            # доля подписчиков, до которых дошел оффер: рассылка всем мастерам дала бы 1.0
+            'fanout_ratio': sum(deliveries) / len(deliveries) / options['subscribers'],
+            'duplicates_avg': (sum(deliveries) - sum(recipients)) / len(deliveries),
+            'send_p50_ms': percentile(send_ms, 50),
+            'send_p99_ms': percentile(send_ms, 99),
+            'delivery_p50_ms': percentile(latencies_ms, 50),
+            'delivery_p99_ms': percentile(latencies_ms, 99),
+            'per_delivery_us': sum(send_ms) * 1000 / sum(deliveries) if sum(deliveries) else None,
+        }
+        self.stdout.write(
+            f'доставок на оффер: {report["deliveries_avg"]:.0f} ({report["fanout_ratio"]:.1%} подписчиков), '
+            f'повторов: {report["duplicates_avg"]:.0f}, group_send p50={report["send_p50_ms"]:.1f}ms '
+            f'p99={report["send_p99_ms"]:.1f}ms, доставка p50={report["delivery_p50_ms"]:.1f}ms '
+            f'p99={report["delivery_p99_ms"]:.1f}ms'
+        )
+        return report
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db import transaction
+
+from api.partitions import ensure_partitions
+from api.partitions import is_partitioned
+from api.partitions import partition_table
+
+
+class Command(BaseCommand):
+    help = ('Секционирует таблицу сообщений по месяцам (первый запуск) и создает партиции на месяцы вперед. '
+            'Запускать по расписанию, например раз в сутки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ahead', type=int, default=settings.MESSAGE_PARTITIONS_AHEAD)
+
+    def handle(self, *args, **options):
+        with connection.cursor() as cursor:
+            partitioned = is_partitioned(cursor)
+        if not partitioned:
+            partition_table(options['ahead'])
+            self.stdout.write('Таблица сообщений секционирована по месяцам')
+            return
+        with transaction.atomic(), connection.cursor() as cursor:
+            created = ensure_partitions(cursor, options['ahead'])
+        self.stdout.write(f'Создано партиций: {len(created)}' + (f' ({", ".join(created)})' if created else ''))
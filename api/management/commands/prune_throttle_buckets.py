@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.throttling import prune_shared_buckets
+
+
+class Command(BaseCommand):
+    help = 'Удаляет из базы полные корзины лимитов записи. Запускать периодически, например раз в час'
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'Удалено корзин: {prune_shared_buckets()}')
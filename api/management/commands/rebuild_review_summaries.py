@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Grade
+from api.models import ReviewSummary
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сводки отзывов по всем оцененным пользователям (после добавления сводок или ручных правок)'
+
+    def handle(self, *args, **options):
+        user_ids = Grade.objects.exclude(valued_user=None).order_by().values_list('valued_user_id', flat=True).distinct()
+        count = 0
+        for user_id in user_ids.iterator():
+            ReviewSummary.rebuild(user_id)
+            count += 1
+        self.stdout.write(f'Пересчитано сводок: {count}')
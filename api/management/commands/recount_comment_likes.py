@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Comment
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает Comment.likes_count по таблице лайков (после добавления поля или ручных правок)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        last_id, total = 0, 0
+        while True:
+            ids = list(Comment.objects.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[
+                       :options['batch']])
+            if not ids:
+                break
+            total += Comment.recount_likes(ids)
+            last_id = ids[-1]
+        self.stdout.write(f'Пересчитано комментариев: {total}')
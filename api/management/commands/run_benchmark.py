@@ -0,0 +1,111 @@
+import json
+import math
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from rest_framework_simplejwt.tokens import RefreshToken
+
+from api.models import User
+from api.models import Comment
+
+from .seed_benchmark import BENCHMARK_EMAIL_DOMAIN
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+class Command(BaseCommand):
+    help = 'Замеряет задержки, пропускную способность и число SQL запросов основных эндпоинтов API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Количество запросов на эндпоинт')
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--user', type=str, default=None, help='Email пользователя, от имени которого идут запросы')
+        parser.add_argument('--output', type=str, default='benchmark.json')
+
+    def get_user(self, email):
+        users = User.objects.all()
+        if email:
+            users = users.filter(email=email)
+        else:
+            users = users.filter(email__endswith='@' + BENCHMARK_EMAIL_DOMAIN, chats__object_type='benchmark')
+        user = users.order_by('id').first()
+        if user is None:
+            raise CommandError('Пользователь не найден. Запустите seed_benchmark')
+        return user
+
+    def get_endpoints(self, user):
+        chat = user.chats.exclude(object_type='helpdesk').order_by('id').first()
+        comment = Comment.objects.filter(offer__private=False).order_by('id').first()
+        return {
+            'offers': '/api/offers/',
+            'masters': '/api/masters/',
+            'messages': f'/api/messages/?chat={chat.id if chat else ""}',
+            'chats': '/api/chats/',
+            'comments': f'/api/comments/?offer={comment.offer_id if comment else ""}',
+            'subscription_permissions': '/api/subscription/subscription_permissions/',
+        }
+
+    def measure(self, client, url, requests, warmup):
+        for _ in range(warmup):
+            client.get(url)
+        latencies, queries, errors = [], [], 0
+        started = time.perf_counter()
+        for _ in range(requests):
+            with CaptureQueriesContext(connection) as context:
+                request_started = time.perf_counter()
+                response = client.get(url)
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            queries.append(len(context.captured_queries))
+            if response.status_code >= 400:
+                errors += 1
+        elapsed = time.perf_counter() - started
+        return {
+            'url': url,
+            'requests': requests,
+            'errors': errors,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'mean_ms': sum(latencies) / len(latencies) if latencies else None,
+            'throughput_rps': requests / elapsed if elapsed else None,
+            'queries_avg': sum(queries) / len(queries) if queries else None,
+            'queries_max': max(queries, default=None),
+        }
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('Количество запросов должно быть положительным')
+        user = self.get_user(options['user'])
+        token = str(RefreshToken.for_user(user).access_token)
+        client = Client(SERVER_NAME='localhost', HTTP_AUTHORIZATION=f'Bearer {token}')
+
+        results = {}
+        for name, url in self.get_endpoints(user).items():
+            results[name] = self.measure(client, url, options['requests'], options['warmup'])
+            self.stdout.write(
+                f'{name}: p50={results[name]["p50_ms"]:.1f}ms p95={results[name]["p95_ms"]:.1f}ms '
+                f'p99={results[name]["p99_ms"]:.1f}ms rps={results[name]["throughput_rps"]:.1f} '
+                f'queries={results[name]["queries_avg"]:.1f} errors={results[name]["errors"]}'
+            )
+
+        report = {
+            'created': timezone.now().isoformat(),
+            'user': user.email,
+            'requests': options['requests'],
+            'warmup': options['warmup'],
+            'endpoints': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        self.stdout.write(self.style.SUCCESS(f'Результаты сохранены в {options["output"]}'))
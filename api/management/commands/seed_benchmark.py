@@ -0,0 +1,196 @@
+import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from psycopg2.extras import DateRange
+
+from api.models import User
+from api.models import RepairCategory
+from api.models import RepairOffer
+from api.models import Comment
+from api.models import Chat
+from api.models import Message
+from api.models import Grade
+from api.models import ReviewSummary
+from api.models import SubscriptionPlan
+from api.models import Subscription
+
+BENCHMARK_EMAIL_DOMAIN = 'benchmark.local'
+BENCHMARK_PASSWORD = 'Benchmark-1'
+
+
+class Command(BaseCommand):
+    help = 'Заполняет локальную БД тестовыми данными для нагрузочных замеров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--masters', type=int, default=200)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--offers', type=int, default=5000)
+        parser.add_argument('--comments', type=int, default=20000)
+        parser.add_argument('--chats', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=50000)
+        parser.add_argument('--grades', type=int, default=3000)
+        parser.add_argument('--subscriptions', type=int, default=500)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clear', action='store_true', help='Удалить ранее созданные тестовые данные')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        self.batch_size = options['batch_size']
+        if options['clear']:
+            self.clear()
+        with transaction.atomic():
+            categories = self.seed_categories(options['categories'])
+            users = self.seed_users(options['users'], options['masters'], categories)
+            masters = [u for u in users if u.role == 'master']
+            offers = self.seed_offers(options['offers'], users, masters, categories)
+            self.seed_comments(options['comments'], users, offers)
+            self.seed_chats(options['chats'], options['messages'], users)
+            self.seed_grades(options['grades'], offers)
+            self.seed_subscriptions(options['subscriptions'], users)
+        self.stdout.write(self.style.SUCCESS('Тестовые данные созданы'))
+
+    def clear(self):
+        users = User.objects.filter(email__endswith='@' + BENCHMARK_EMAIL_DOMAIN)
+        Chat.objects.filter(created_user__in=users).delete()
+        Grade.objects.filter(rating_user__in=users).delete()
+        Subscription.objects.filter(user__in=users).delete()
+        users.delete()
+        self.stdout.write('Ранее созданные тестовые данные удалены')
+
+    def bulk_create(self, model, objects):
+        return model.objects.bulk_create(objects, batch_size=self.batch_size)
+
+    def seed_categories(self, count):
+        existing = list(RepairCategory.objects.all())
+        missing = count - len(existing)
+        if missing > 0:
+            existing += self.bulk_create(RepairCategory, [
+                RepairCategory(name=f'benchmark-{i}', color='#%06x' % random.randint(0, 0xFFFFFF))
+                for i in range(len(existing), len(existing) + missing)
+            ])
+        return existing[:count]
+
+    def seed_users(self, count, masters_count, categories):
+        password = make_password(BENCHMARK_PASSWORD)
+        start = User.objects.filter(email__endswith='@' + BENCHMARK_EMAIL_DOMAIN).count()
+        users = self.bulk_create(User, [
+            User(
+                email=f'user-{i}@{BENCHMARK_EMAIL_DOMAIN}',
+                password=password,
+                name=f'Benchmark {i}',
+                role='master' if i - start < masters_count else 'driver',
+                approve_email=True
+            )
+            for i in range(start, start + count)
+        ])
+        through = User.repair_categories.through
+        self.bulk_create(through, [
+            through(user_id=u.id, repaircategory_id=c.id)
+            for u in users if u.role == 'master'
+            for c in random.sample(categories, min(len(categories), random.randint(1, 4)))
+        ])
+        self.stdout.write(f'Пользователей: {len(users)}')
+        return users
+
+    @staticmethod
+    def pick_master(owner, masters):
+        if not masters or random.random() > 0.3:
+            return None
+        master = random.choice(masters)
+        return None if master.id == owner.id else master
+
+    def seed_offers(self, count, users, masters, categories):
+        offers = self.bulk_create(RepairOffer, [
+            RepairOffer(
+                owner=owner,
+                master=self.pick_master(owner, masters),
+                title=f'Оффер {i}',
+                description='Описание ' * random.randint(1, 30),
+                private=random.random() < 0.1
+            )
+            for i, owner in enumerate(random.choice(users) for _ in range(count))
+        ])
+        through = RepairOffer.categories.through
+        self.bulk_create(through, [
+            through(repairoffer_id=o.id, repaircategory_id=c.id)
+            for o in offers
+            for c in random.sample(categories, min(len(categories), random.randint(1, 3)))
+        ])
+        self.stdout.write(f'Офферов: {len(offers)}')
+        return offers
+
+    def seed_comments(self, count, users, offers):
+        public_offers = [o for o in offers if not o.private]
+        if not public_offers:
+            return
+        comments = self.bulk_create(Comment, [
+            Comment(offer=random.choice(public_offers), user=random.choice(users), text=f'Комментарий {i}')
+            for i in range(count)
+        ])
+        through = Comment.users_liked.through
+        self.bulk_create(through, [
+            through(comment_id=c.id, user_id=u.id)
+            for c in comments
+            for u in random.sample(users, min(len(users), random.randint(0, 3)))
+        ])
+        Comment.recount_likes([c.id for c in comments])
+        self.stdout.write(f'Комментариев: {len(comments)}')
+
+    def seed_chats(self, chats_count, messages_count, users):
+        if not chats_count:
+            return
+        pairs = [(users[i % len(users)], users[(i + 1) % len(users)]) for i in range(chats_count)]
+        chats = self.bulk_create(Chat, [
+            Chat(object_id=str(a.id), object_type='benchmark', created_user=a, private=True) for a, _ in pairs
+        ])
+        through = Chat.participants.through
+        self.bulk_create(through, [
+            through(chat_id=chat.id, user_id=u.id) for chat, pair in zip(chats, pairs) for u in pair
+        ])
+        participants = dict(zip([c.id for c in chats], pairs))
+        messages = []
+        for i in range(messages_count):
+            chat = random.choice(chats)
+            messages.append(Message(chat=chat, user=random.choice(participants[chat.id]), text=f'Сообщение {i}'))
+        self.bulk_create(Message, messages)
+        self.stdout.write(f'Чатов: {len(chats)}, сообщений: {len(messages)}')
+
+    def seed_grades(self, count, offers):
+        assigned = [o for o in offers if o.master_id]
+        grades = []
+        for offer in random.sample(assigned, min(len(assigned), count)):
+            grades.append(Grade(
+                grade=random.randint(1, 5), comment='Отзыв', rating_user_id=offer.owner_id,
+                valued_user_id=offer.master_id, offer=offer
+            ))
+        grades = self.bulk_create(Grade, grades)
+        for grade in grades:
+            grade.offer.owner_grade = grade
+        RepairOffer.objects.bulk_update([g.offer for g in grades], ['owner_grade'], batch_size=self.batch_size)
+        for user_id in {g.valued_user_id for g in grades}:
+            ReviewSummary.rebuild(user_id)
+        self.stdout.write(f'Отзывов: {len(grades)}')
+
+    def seed_subscriptions(self, count, users):
+        plan = SubscriptionPlan.objects.filter(default=False).first() or SubscriptionPlan.objects.first()
+        if plan is None:
+            plan = SubscriptionPlan.objects.create(name='Benchmark', code='benchmark', cost=0, currency='RUB')
+        today = timezone.now().date()
+        subscriptions = []
+        for i in range(count):
+            # подписки одного пользователя идут друг за другом и не пересекаются
+            start = today + datetime.timedelta(days=30 * (i // len(users)))
+            end = start + datetime.timedelta(days=30)
+            subscriptions.append(Subscription(
+                payment_id=f'benchmark-{i}', start=start, expiration_date=end, period=DateRange(start, end, '[)'),
+                user=users[i % len(users)], plan=plan, value='0RUB', active=True
+            ))
+        self.bulk_create(Subscription, subscriptions)
+        self.stdout.write(f'Подписок: {len(subscriptions)}')
@@ -0,0 +1,147 @@
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.db.models import Avg
+from django.db.models import Count
+
+from .aggregations import annotate_user_subscription_action_permitted
+from .caching import get_model_versions
+from .models import User
+from .models import Grade
+from .models import RepairOffer
+from .models import Subscription
+from .models import SubscriptionAction
+from .models import SubscriptionFreeze
+from .models import SubscriptionPlan
+
+
+# индекс категория -> мастера и статистика мастеров в памяти процесса.
+# перестраивается целиком, когда истекает MASTER_INDEX_TTL. Мастера с правом can_take_offers
+# перечитываются еще и при смене версий моделей подписок (общие версии, как у кэша ответов)
+class MasterIndex:
+    permission_models = (Subscription, SubscriptionFreeze, SubscriptionPlan, SubscriptionAction)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._category_masters = {}
+        self._master_categories = {}
+        self._ratings = {}
+        self._complete_counts = {}
+        self._max_complete_count = 0
+        self._permitted = frozenset()
+        self._permitted_versions = None
+
+    def _load(self):
+        category_masters, master_categories = {}, {}
+        relations = User.repair_categories.through.objects.filter(user__role='master', user__is_active=True)
+        for user_id, category_id in relations.values_list('user_id', 'repaircategory_id').iterator():
+            category_masters.setdefault(category_id, set()).add(user_id)
+            master_categories.setdefault(user_id, set()).add(category_id)
+
+        ratings = Grade.objects.filter(valued_user__role='master').values('valued_user').annotate(
+            avg=Avg('grade')
+        ).values_list('valued_user', 'avg')
+        complete_counts = RepairOffer.objects.filter(
+            master__role='master', owner_grade__isnull=False
+        ).values('master').annotate(c=Count('id')).values_list('master', 'c')
+
+        self._category_masters = category_masters
+        self._master_categories = master_categories
+        self._ratings = {user_id: float(avg) for user_id, avg in ratings}
+        self._complete_counts = dict(complete_counts)
+        self._max_complete_count = max(self._complete_counts.values(), default=0)
+        # право зависит и от даты (окончание подписки), поэтому перечитывается вместе с индексом
+        self._permitted_versions = None
+        self._loaded_at = time.monotonic()
+
+    @staticmethod
+    def _load_permitted():
+        queryset = User.objects.filter(role='master', is_active=True)
+        queryset = annotate_user_subscription_action_permitted(queryset, 'can_take_offers')
+        return frozenset(queryset.filter(can_take_offers__permitted=True).values_list('id', flat=True).iterator())
+
+    def _expired(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at > settings.MASTER_INDEX_TTL
+
+    def _ensure_loaded(self):
+        if self._expired():
+            with self._lock:
+                if self._expired():
+                    self._load()
+
+    def get_candidates(self, category_ids):
+        self._ensure_loaded()
+        candidates = set()
+        for category_id in category_ids:
+            candidates |= self._category_masters.get(category_id, set())
+        return candidates
+
+    def get_permitted(self):
+        self._ensure_loaded()
+        versions = get_model_versions(self.permission_models)
+        if versions != self._permitted_versions:
+            with self._lock:
+                if versions != self._permitted_versions:
+                    self._permitted = self._load_permitted()
+                    self._permitted_versions = versions
+        return self._permitted
+
+    def get_categories(self, master_id):
+        return self._master_categories.get(master_id, set())
+
+    def get_rating(self, master_id):
+        return self._ratings.get(master_id, 0.0)
+
+    def get_complete_count(self, master_id):
+        return self._complete_counts.get(master_id, 0)
+
+    @property
+    def max_complete_count(self):
+        return self._max_complete_count
+
+
+master_index = MasterIndex()
+
+
+class MasterMatcher:
+    category_weight = 0.5
+    rating_weight = 0.25
+    complete_weight = 0.15
+    trusted_weight = 0.1
+
+    def __init__(self, offer: RepairOffer, user, index: MasterIndex = master_index):
+        self.offer = offer
+        self.user = user
+        self.index = index
+
+    def score(self, master_id, category_ids, trusted_ids):
+        overlap = len(self.index.get_categories(master_id) & category_ids) / len(category_ids)
+        rating = self.index.get_rating(master_id) / 5
+        max_complete = self.index.max_complete_count
+        complete = math.log1p(self.index.get_complete_count(master_id)) / math.log1p(max_complete) \
+            if max_complete else 0.0
+        trusted = 1.0 if master_id in trusted_ids else 0.0
+        return self.category_weight * overlap + self.rating_weight * rating + \
+            self.complete_weight * complete + self.trusted_weight * trusted
+
+    def rank(self):
+        category_ids = set(self.offer.categories.values_list('id', flat=True))
+        if not category_ids:
+            return []
+        candidates = self.index.get_candidates(category_ids)
+        candidates.discard(self.offer.owner_id)
+        candidates -= set(self.offer.canceled_masters.values_list('id', flat=True))
+        trusted_ids = set(self.user.trusted_masters.values_list('id', flat=True))
+        ranked = [(self.score(master_id, category_ids, trusted_ids), master_id) for master_id in candidates]
+        ranked.sort(reverse=True)
+        return ranked
+
+    def top(self, limit: int):
+        # права мастеров берутся из индекса: без запросов к БД на каждую пачку кандидатов
+        if limit < 1:
+            return []
+        permitted = self.index.get_permitted()
+        return [(score, master_id) for score, master_id in self.rank() if master_id in permitted][:limit]
@@ -0,0 +1,63 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+
+from .caching import SharedVersions
+
+
+# участники чатов в памяти процесса: пользователь -> его чаты, чат -> его участники.
+# записи читаются лениво одним запросом на промах. Изменение participants после коммита меняет общую версию,
+# процессы сверяют ее не чаще CHAT_MEMBERSHIP_CHECK_INTERVAL секунд: версия входит в ключи,
+# и после смены все записи процесса перечитываются. Удаленный из чата теряет доступ в своем процессе сразу,
+# в остальных - в пределах интервала. CHAT_MEMBERSHIP_TTL ограничивает устаревание,
+# если инвалидация разминулась с чтением
+class ChatMembership:
+    version_key = 'chat_membership_version'
+    user_prefix = 'chat_membership:user:'
+    chat_prefix = 'chat_membership:chat:'
+
+    def __init__(self):
+        self.versions = SharedVersions('CHAT_MEMBERSHIP_CHECK_INTERVAL')
+
+    @staticmethod
+    def _through():
+        return apps.get_model('api', 'Chat').participants.through
+
+    def _get_many(self, prefix, ids, lookup, value_field):
+        version = self.versions.get(self.version_key)
+        keys = {f'{prefix}{version}:{i}': i for i in ids}
+        result = {keys[key]: value for key, value in cache.get_many(keys).items()}
+        missing = [i for i in ids if i not in result]
+        if missing:
+            loaded = {i: set() for i in missing}
+            # промах читаем из основной базы: отстающая реплика вернула бы старый состав
+            rows = self._through().objects.using(DEFAULT_DB_ALIAS).filter(**{f'{lookup}__in': missing}).values_list(
+                lookup, value_field)
+            for key_id, value_id in rows:
+                loaded[key_id].add(value_id)
+            loaded = {i: frozenset(values) for i, values in loaded.items()}
+            cache.set_many({f'{prefix}{version}:{i}': values for i, values in loaded.items()},
+                           timeout=settings.CHAT_MEMBERSHIP_TTL)
+            result.update(loaded)
+        return result
+
+    def get_user_chats(self, user_id):
+        return self._get_many(self.user_prefix, [int(user_id)], 'user_id', 'chat_id')[int(user_id)]
+
+    def get_participants_many(self, chat_ids):
+        return self._get_many(self.chat_prefix, [int(chat_id) for chat_id in chat_ids], 'chat_id', 'user_id')
+
+    def get_participants(self, chat_id):
+        return self.get_participants_many([chat_id])[int(chat_id)]
+
+    def is_participant(self, user_id, chat_id):
+        return int(chat_id) in self.get_user_chats(user_id)
+
+    def invalidate(self, user_ids=(), chat_ids=()):
+        # записи процессов не удаляются по одной: новая версия делает недоступными все прежние
+        if user_ids or chat_ids:
+            self.versions.bump(self.version_key)
+
+
+chat_membership = ChatMembership()
@@ -0,0 +1,62 @@
+import re
+
+from django.conf import settings
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.db.models import Count
+from django.utils.html import escape
+
+from .models import Message
+from .membership import chat_membership
+
+
+def get_user_chat_ids(user_id, chat_id=None):
+    chat_ids = chat_membership.get_user_chats(user_id)
+    if chat_id is not None:
+        return [int(chat_id)] if int(chat_id) in chat_ids else []
+    return list(chat_ids)
+
+
+def make_snippet(text, query, width):
+    # фрагмент вокруг первого совпадения, совпадение выделено <mark>, остальное экранировано
+    match = re.search(re.escape(query), text, re.IGNORECASE)
+    if match is None:
+        return escape(text[:width * 2]) + ('…' if len(text) > width * 2 else '')
+    start, end = max(0, match.start() - width), min(len(text), match.end() + width)
+    return ''.join([
+        '…' if start else '',
+        escape(text[start:match.start()]),
+        '<mark>', escape(match.group()), '</mark>',
+        escape(text[match.end():end]),
+        '…' if end < len(text) else '',
+    ])
+
+
+def search_messages(user_id, query, chat_id=None, limit=20):
+    """
+    Поиск подстроки в сообщениях чатов пользователя. Сначала берутся id его чатов (из кэша участников),
+    затем совпадения ищутся по триграммному индексу message_text_trgm_idx только в них.
+    Результат сгруппирован по чатам: чаты и сообщения в них - по убыванию релевантности.
+    """
+    chat_ids = get_user_chat_ids(user_id, chat_id)
+    if not chat_ids:
+        return {'count': 0, 'chats': []}
+
+    matches = Message.objects.filter(deleted=False, chat_id__in=chat_ids, text__icontains=query)
+    counts = dict(matches.order_by().values_list('chat_id').annotate(count=Count('id')))
+    if not counts:
+        return {'count': 0, 'chats': []}
+
+    hits = matches.annotate(rank=TrigramWordSimilarity(query, 'text')).order_by('-rank', '-created')
+    groups = {}
+    for hit in hits.values('id', 'chat_id', 'user_id', 'reply_id', 'created', 'text', 'rank')[:limit]:
+        group = groups.setdefault(hit['chat_id'], {'chat': hit['chat_id'], 'count': counts[hit['chat_id']],
+                                                   'results': []})
+        group['results'].append({
+            'id': hit['id'],
+            'user': hit['user_id'],
+            'reply': hit['reply_id'],
+            'created': hit['created'],
+            'rank': round(hit['rank'], 4),
+            'snippet': make_snippet(hit['text'], query, settings.MESSAGE_SEARCH_SNIPPET_WIDTH),
+        })
+    return {'count': sum(counts.values()), 'chats': list(groups.values())}
@@ -1,8 +1,21 @@
+from django.conf import settings
 from django.db import models
+from django.db import transaction
+from django.db import IntegrityError
 from django.contrib.auth.models import PermissionsMixin, AbstractBaseUser, BaseUserManager
+from django.contrib.postgres.constraints import ExclusionConstraint
+from django.contrib.postgres.fields import DateRangeField
+from django.contrib.postgres.fields import RangeOperators
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.indexes import OpClass
 from django.core.validators import MaxValueValidator
+from django.db.models.functions import Upper
+from django.db.models.functions import Coalesce
 from django.db.models.signals import post_delete
+from django.db.models.signals import pre_delete
+from django.db.models.signals import pre_save
 from django.db.models.signals import post_save
+from django.db.models.signals import m2m_changed
 from django.utils import timezone
 
 from .exceptions import BadRequest
@@ -13,12 +26,38 @@ from .signals import img_model_delete
 from .signals import user_avatar_delete
 from .signals import faq_content_background_delete
 from .signals import create_helpdesk_chat
+from .signals import invalidate_subscription_catalog
+from .signals import bump_cache_version
+from .signals import bump_m2m_cache_version
+from .signals import recount_comment_likes
+from .signals import user_comment_likes_delete
+from .signals import grade_summary_pre_save
+from .signals import grade_summary_save
+from .signals import grade_summary_delete
+from .signals import review_author_pre_save
+from .signals import review_author_save
+from .signals import review_author_delete
+from .signals import grade_photo_summary_refresh
+from .signals import touch_offer_m2m
+from .signals import touch_offer
+from .signals import record_delete
+from .signals import chat_participants_changed
+from .signals import chat_membership_delete
+
+from .catalog import subscription_catalog
 
 from .exceptions import SelfAppointedOffer
 
+from psycopg2.extras import DateRange
+
 import os
 
 
+def is_constraint_violation(exc: IntegrityError, constraint_name: str):
+    diag = getattr(exc.__cause__, 'diag', None)
+    return diag is not None and diag.constraint_name == constraint_name
+
+
 class CustomUserManager(BaseUserManager):
     def create_user(self, email, password):
         user = self.model(email=email, password=password)
@@ -77,6 +116,11 @@ class User(AbstractBaseUser, PermissionsMixin):
     class Meta:
         verbose_name = 'Пользователь'
         verbose_name_plural = 'Пользователи'
+        indexes = [
+            # поиск по email в админке идет через iexact, по имени - через istartswith (LIKE 'префикс%')
+            models.Index(Upper('email'), name='user_email_upper_idx'),
+            models.Index(OpClass(Upper('name'), name='text_pattern_ops'), name='user_name_upper_prefix_idx'),
+        ]
 
     def get_name(self):
         return self.name if self.name else self.email
@@ -109,6 +153,21 @@ class UserReport(models.Model):
     class Meta:
         verbose_name = 'Репорт'
         verbose_name_plural = 'Репорты'
+        indexes = [
+            models.Index(fields=['from_user', 'to_user', 'created'], name='report_from_to_created_idx'),
+        ]
+
+
+class ThrottleBucket(models.Model):
+    # общая для всех воркеров корзина токенов, см. api/throttling.py
+    key = models.CharField(max_length=255, primary_key=True, verbose_name='Ключ')
+    tokens = models.FloatField(verbose_name='Токены')
+    allowed = models.BooleanField(default=True, verbose_name='Последний запрос разрешен')
+    updated = models.DateTimeField(verbose_name='Время обновления')
+
+    class Meta:
+        verbose_name = 'Лимит запросов'
+        verbose_name_plural = 'Лимиты запросов'
 
 
 class OTC(models.Model):
@@ -140,6 +199,41 @@ class RequestForCooperation(models.Model):
         verbose_name_plural = 'Сотрудничество'
 
 
+class Activity(models.Model):
+    # лента событий пользователя: строка на каждого получателя пишется в момент события (fan-out on write)
+    VERBS = (
+        ('cooperation_request', 'Запрос на сотрудничество'),
+        ('cooperation_approved', 'Сотрудничество подтверждено'),
+        ('cooperation_rejected', 'Сотрудничество отклонено'),
+        ('grade', 'Новый отзыв'),
+        ('master_assigned', 'Назначен мастером'),
+        ('master_removed', 'Снят с оффера'),
+        ('master_refused', 'Мастер отказался от оффера'),
+        ('offer_response', 'Отклик на оффер'),
+        ('offer_suggested', 'Предложен оффер'),
+    )
+    user = models.ForeignKey('api.User', on_delete=models.CASCADE, related_name='activities', verbose_name='Получатель')
+    actor = models.ForeignKey('api.User', on_delete=models.SET_NULL, null=True, default=None, related_name='+',
+                              verbose_name='Инициатор')
+    verb = models.CharField(max_length=30, choices=VERBS, verbose_name='Событие')
+    offer = models.ForeignKey('api.RepairOffer', on_delete=models.SET_NULL, null=True, default=None,
+                              related_name='+', verbose_name='Оффер')
+    object_id = models.PositiveIntegerField(null=True, default=None, verbose_name='Объект')
+    data = models.JSONField(default=dict, blank=True, verbose_name='Данные')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Время события')
+
+    def __str__(self):
+        return f'{self.user_id}: {self.verb}'
+
+    class Meta:
+        verbose_name = 'Событие'
+        verbose_name_plural = 'Лента событий'
+        indexes = [
+            # страницы ленты по ключу (user, id)
+            models.Index(fields=['user', '-id'], name='activity_user_id_idx'),
+        ]
+
+
 class CarBrand(models.Model):
     def img_upload(self, filename):
         return os.path.join('cars', 'brands', self.name, filename)
@@ -212,6 +306,9 @@ class Grade(models.Model):
     class Meta:
         verbose_name = 'Отзыв'
         verbose_name_plural = 'Отзывы'
+        indexes = [
+            models.Index(fields=['valued_user', '-created'], name='grade_valued_created_idx'),
+        ]
 
 
 class GradePhoto(models.Model):
@@ -225,6 +322,95 @@ class GradePhoto(models.Model):
         return f'{self.grade.rating_user.get_short_name()} ({self.img.name})'
 
 
+class ReviewSummary(models.Model):
+    """
+    Сводка отзывов о пользователе: счетчики меняются на каждый отзыв через F(),
+    последние отзывы хранятся готовым списком, профиль читает одну строку по pk.
+    """
+    GRADES = range(1, 6)
+
+    user = models.OneToOneField('api.User', on_delete=models.CASCADE, primary_key=True, related_name='review_summary',
+                                verbose_name='Пользователь')
+    count = models.IntegerField(default=0, verbose_name='Количество отзывов')
+    total = models.IntegerField(default=0, verbose_name='Сумма оценок')
+    grade_1 = models.IntegerField(default=0, verbose_name='Оценок 1')
+    grade_2 = models.IntegerField(default=0, verbose_name='Оценок 2')
+    grade_3 = models.IntegerField(default=0, verbose_name='Оценок 3')
+    grade_4 = models.IntegerField(default=0, verbose_name='Оценок 4')
+    grade_5 = models.IntegerField(default=0, verbose_name='Оценок 5')
+    latest = models.JSONField(default=list, verbose_name='Последние отзывы')
+    updated = models.DateTimeField(auto_now=True, verbose_name='Время обновления')
+
+    def __str__(self):
+        return f'{self.user_id}: {self.average} ({self.count})'
+
+    @property
+    def average(self):
+        return round(self.total / self.count, 2) if self.count else 0.0
+
+    @property
+    def histogram(self):
+        return {grade: getattr(self, f'grade_{grade}') for grade in self.GRADES}
+
+    @staticmethod
+    def add_grade(user_id, grade, sign=1):
+        ReviewSummary.objects.get_or_create(user_id=user_id)
+        values = {'count': models.F('count') + sign, 'total': models.F('total') + sign * grade}
+        if grade in ReviewSummary.GRADES:
+            values[f'grade_{grade}'] = models.F(f'grade_{grade}') + sign
+        ReviewSummary.objects.filter(user_id=user_id).update(**values)
+
+    @staticmethod
+    def rebuild(user_id):
+        # полный пересчет: после правок отзывов в админке и для заполнения сводок по старым отзывам
+        grades = Grade.objects.filter(valued_user_id=user_id)
+        values = grades.aggregate(count=models.Count('pk'), total=Coalesce(models.Sum('grade'), 0), **{
+            f'grade_{grade}': models.Count('pk', filter=models.Q(grade=grade)) for grade in ReviewSummary.GRADES
+        })
+        ReviewSummary.objects.update_or_create(user_id=user_id, defaults=values)
+        ReviewSummary.refresh_latest(user_id)
+
+    @staticmethod
+    def refresh_latest(user_id):
+        # блокировка строки сводки: параллельные обновления пишут список по очереди и не затирают друг друга
+        with transaction.atomic():
+            summary = ReviewSummary.objects.select_for_update().filter(user_id=user_id).first()
+            if summary is None:
+                return
+            grades = Grade.objects.filter(valued_user_id=user_id).select_related('rating_user').prefetch_related(
+                'images').order_by('-created', '-id')[:settings.REVIEW_SUMMARY_LATEST]
+            summary.latest = [ReviewSummary.snapshot(grade) for grade in grades]
+            summary.save(update_fields=['latest', 'updated'])
+
+    @staticmethod
+    def refresh_author(user_id):
+        # имя и аватар автора скопированы в latest: после их правки или удаления автора пересобираем эти списки
+        summaries = ReviewSummary.objects.filter(latest__contains=[{'rating_user': {'id': user_id}}])
+        for summary_user_id in summaries.values_list('user_id', flat=True):
+            ReviewSummary.refresh_latest(summary_user_id)
+
+    @staticmethod
+    def snapshot(grade):
+        rating_user = grade.rating_user
+        return {
+            'id': grade.id,
+            'grade': grade.grade,
+            'comment': grade.comment,
+            'offer': grade.offer_id,
+            'created': grade.created.isoformat(),
+            'rating_user': rating_user and {
+                'id': rating_user.id,
+                'name': rating_user.name,
+                'avatar': rating_user.avatar.url if rating_user.avatar else None,
+            },
+            'photos': [photo.img.url for photo in grade.images.all()],
+        }
+
+    class Meta:
+        verbose_name = 'Сводка отзывов'
+        verbose_name_plural = 'Сводки отзывов'
+
+
 class Comment(models.Model):
     offer = models.ForeignKey('api.RepairOffer', on_delete=models.CASCADE, related_name='comments',
                               verbose_name='Оффер')
@@ -234,11 +420,35 @@ class Comment(models.Model):
                              verbose_name='Пользователь')
     text = models.TextField(verbose_name='Текст')
     users_liked = models.ManyToManyField('api.User', related_name='liked_comments', blank=True, verbose_name='Лайкнули')
+    likes_count = models.PositiveIntegerField(default=0, editable=False, verbose_name='Количество лайков')
     created = models.DateTimeField(auto_now_add=True, editable=False, verbose_name='Время создания')
 
     def __str__(self):
         return f'{self.user.name}: {self.text}'
 
+    def like(self, user_id):
+        # счетчик меняется только если строка лайка действительно добавилась: повторный лайк ничего не делает
+        with transaction.atomic():
+            _, created = Comment.users_liked.through.objects.get_or_create(comment_id=self.pk, user_id=user_id)
+            if created:
+                Comment.objects.filter(pk=self.pk).update(likes_count=models.F('likes_count') + 1)
+        return created
+
+    def unlike(self, user_id):
+        with transaction.atomic():
+            deleted, _ = Comment.users_liked.through.objects.filter(comment_id=self.pk, user_id=user_id).delete()
+            if deleted:
+                Comment.objects.filter(pk=self.pk).update(likes_count=models.F('likes_count') - deleted)
+        return bool(deleted)
+
+    @staticmethod
+    def recount_likes(comment_ids=None):
+        # пересчет по таблице лайков: после правок users_liked в обход like/unlike
+        queryset = Comment.objects.all() if comment_ids is None else Comment.objects.filter(pk__in=comment_ids)
+        likes = Comment.users_liked.through.objects.filter(comment_id=models.OuterRef('pk')).order_by().values(
+            'comment_id').annotate(count=models.Count('pk')).values('count')
+        return queryset.update(likes_count=Coalesce(models.Subquery(likes), 0))
+
     def reply_str(self):
         if not self.reply:
             return ''
@@ -255,6 +465,12 @@ class Comment(models.Model):
     class Meta:
         verbose_name = 'Комментарий'
         verbose_name_plural = 'Коментарии'
+        indexes = [
+            # страницы веток: корневые комментарии оффера и ответы на комментарий по времени
+            models.Index(fields=['offer', 'created', 'id'], condition=models.Q(reply__isnull=True),
+                         name='comment_offer_roots_idx'),
+            models.Index(fields=['reply', 'created', 'id'], name='comment_replies_idx'),
+        ]
 
 
 class CommentMedia(models.Model):
@@ -302,6 +518,8 @@ class RepairOffer(models.Model):
     created = models.DateTimeField(auto_now_add=True, editable=False, verbose_name='Время создания')
     canceled_masters = models.ManyToManyField('api.User', related_name='canceled_offers', blank=True,
                                               verbose_name='Отказавшиеся мастера')
+    # меняется при любой записи оффера и того, что отдается вместе с ним: категорий, фото, комментариев, просмотров
+    updated = models.DateTimeField(auto_now=True, db_index=True, verbose_name='Время изменения')
 
     def __str__(self):
         return self.title
@@ -311,6 +529,11 @@ class RepairOffer(models.Model):
             raise SelfAppointedOffer
         return super(RepairOffer, self).save(*args, **kwargs)
 
+    @staticmethod
+    def touch(offer_ids):
+        # для изменений, которые идут мимо save(): m2m, фото, bulk_create
+        return RepairOffer.objects.filter(pk__in=offer_ids).update(updated=timezone.now())
+
     class Meta:
         verbose_name = 'Оффер'
         verbose_name_plural = 'Офферы'
@@ -339,9 +562,12 @@ class Chat(models.Model):
 class Message(models.Model):
     user = models.ForeignKey('api.User', on_delete=models.SET_NULL, null=True, related_name='messages',
                              verbose_name='Пользователь')
-    reply = models.ForeignKey('api.Message', on_delete=models.SET_NULL, null=True, default=None,
+    # таблица сообщений секционируется по created (команда partition_messages), а внешний ключ
+    # на секционированную таблицу требует created в первичном ключе: ссылки на сообщения в базе не проверяются
+    reply = models.ForeignKey('api.Message', on_delete=models.SET_NULL, null=True, default=None, db_constraint=False,
                               related_name='messages_replies', verbose_name='Кому ответить')
-    have_read = models.ManyToManyField('api.User', blank=True, related_name='read_messages', verbose_name='Прочитали')
+    have_read = models.ManyToManyField('api.User', blank=True, related_name='read_messages', db_constraint=False,
+                                       verbose_name='Прочитали')
     chat = models.ForeignKey('api.Chat', on_delete=models.CASCADE, verbose_name='Чат')
     text = models.TextField(verbose_name='Текст')
     created = models.DateTimeField(auto_now_add=True, editable=False, verbose_name='Время создания')
@@ -372,14 +598,23 @@ class Message(models.Model):
         verbose_name = "Сообщение"
         verbose_name_plural = "Сообщения"
         ordering = ["-created"]
+        indexes = [
+            # лента чата: только неудаленные сообщения, по партициям отсекается условием на created
+            models.Index(fields=['chat', '-created'], condition=models.Q(deleted=False),
+                         name='message_chat_created_idx'),
+            # icontains в Postgres - UPPER(text) LIKE UPPER(...), поэтому индекс по выражению
+            GinIndex(OpClass(Upper('text'), name='gin_trgm_ops'), condition=models.Q(deleted=False),
+                     name='message_text_trgm_idx'),
+        ]
 
 
 class MessageMedia(models.Model):
     def upload_message_media_file(self, filename):
-        return os.path.join("chats", str(self.message.chat.pk), "media", filename)
+        return os.path.join("chats", str(self.message.chat_id), "media", filename)
 
     file = models.FileField(upload_to=upload_message_media_file, verbose_name='Файл')
-    message = models.ForeignKey('api.Message', on_delete=models.CASCADE, related_name="media", verbose_name='Сообщение')
+    message = models.ForeignKey('api.Message', on_delete=models.CASCADE, related_name="media", db_constraint=False,
+                                verbose_name='Сообщение')
 
     @property
     def extension(self):
@@ -443,10 +678,7 @@ class SubscriptionPlan(models.Model):
         return super(SubscriptionPlan, self).save(*args, **kwargs)
 
     def get_permissions(self):
-        actions = SubscriptionAction.objects.filter(not_affect=False)
-        actions = actions.annotate(enable=models.Exists(self.actions.filter(id=models.OuterRef('pk'))))
-        actions = actions.values('code', 'enable')
-        return {i['code']: i['enable'] for i in actions}
+        return subscription_catalog.get_permissions(self.id)
 
     class Meta:
         verbose_name = 'План подписки'
@@ -472,6 +704,7 @@ class Subscription(models.Model):
     payment_id = models.CharField(max_length=200)
     start = models.DateField(default=None, null=True)
     expiration_date = models.DateField(default=None, null=True)
+    period = DateRangeField(default=None, null=True, editable=False, verbose_name='Период')
     user = models.ForeignKey('api.User', on_delete=models.SET_NULL, null=True)
     plan = models.ForeignKey('api.SubscriptionPlan', on_delete=models.CASCADE)
     value = models.CharField(max_length=100)
@@ -483,19 +716,21 @@ class Subscription(models.Model):
     @staticmethod
     def has_active(user):
         n = timezone.now().date()
-        return Subscription.objects.filter(user=user, active=True, start__gte=n, expiration_date__gt=n).exists()
+        return Subscription.objects.filter(user=user, active=True, period__contains=n).exists()
 
     @staticmethod
     def cancel_active(user):
         n = timezone.now().date()
-        Subscription.objects.filter(user=user, active=True, start__lte=n, expiration_date__gt=n).update(active=False)
+        Subscription.objects.filter(user=user, active=True, period__contains=n).update(active=False)
+        # update идет мимо post_save: версию, по которой MasterIndex перечитывает права, меняем сами
+        bump_cache_version(Subscription)
 
     @staticmethod
     def get_active(user):
         n = timezone.now().date()
-        sub = Subscription.objects.filter(user=user, active=True, start__lte=n, expiration_date__gt=n).first()
+        sub = Subscription.objects.filter(user=user, active=True, period__contains=n).first()
         if sub:
-            if sub.subscriptionfreeze_set.filter(start__lte=n, end__gte=n).exists():
+            if sub.subscriptionfreeze_set.filter(period__contains=n).exists():
                 return None
         return sub
 
@@ -503,12 +738,10 @@ class Subscription(models.Model):
     def check_action(user, action: str, raise_exception=True):
         active_subscription = Subscription.get_active(user)
         if active_subscription:
-            plan = active_subscription.plan
+            plan_id = active_subscription.plan_id
         else:
-            plan = SubscriptionPlan.objects.get(default=True)
-        if not plan:
-            return False
-        check = plan.actions.filter(code=action).exists()
+            plan_id = subscription_catalog.get_default_plan().id
+        check = subscription_catalog.plan_has_action(plan_id, action)
         if not check and raise_exception:
             raise Forbidden('Действие недоступно в рамках текущей подписки')
         return check
@@ -516,22 +749,33 @@ class Subscription(models.Model):
     @property
     def is_freeze(self):
         n = timezone.now().date()
-        return self.subscriptionfreeze_set.filter(start__lte=n, end__gte=n).exists()
+        return self.subscriptionfreeze_set.filter(period__contains=n).exists()
 
     def save(self, *args, **kwargs):
-        if self.user.subscription_set.exclude(id=self.id).exclude(active=False).filter(
-                models.Q(start__lte=self.start, expiration_date__gte=self.start) |
-                models.Q(start__gte=self.start, expiration_date__lte=self.expiration_date) |
-                models.Q(start__lt=self.expiration_date, expiration_date__gte=self.expiration_date) |
-                models.Q(start__lte=self.start, expiration_date__gte=self.expiration_date)
-        ).exists():
-            raise BadRequest('Подписки пересекаются')
-        return super(Subscription, self).save(*args, **kwargs)
+        # подписка действует с даты начала до даты окончания (не включительно)
+        self.period = DateRange(self.start, self.expiration_date, '[)') if self.start else None
+        try:
+            with transaction.atomic():
+                return super(Subscription, self).save(*args, **kwargs)
+        except IntegrityError as e:
+            if is_constraint_violation(e, 'subscription_period_overlap'):
+                raise BadRequest('Подписки пересекаются')
+            raise
 
     class Meta:
         verbose_name = "Подписка"
         verbose_name_plural = "Подписки"
         ordering = ["-id"]
+        indexes = [
+            models.Index(Upper('payment_id'), name='subscription_payment_upper_idx'),
+        ]
+        constraints = [
+            ExclusionConstraint(
+                name='subscription_period_overlap',
+                expressions=[('user', RangeOperators.EQUAL), ('period', RangeOperators.OVERLAPS)],
+                condition=models.Q(active=True),
+            ),
+        ]
 
 
 class SubscriptionFreeze(models.Model):
@@ -539,10 +783,22 @@ class SubscriptionFreeze(models.Model):
     renew_subscription = models.BooleanField(default=False)
     start = models.DateField()
     end = models.DateField()
+    period = DateRangeField(default=None, null=True, editable=False, verbose_name='Период')
 
     def __str__(self):
         return f'{self.subscription.user.name} ({self.start} - {self.end})'
 
+    def save(self, *args, **kwargs):
+        # заморозка действует включая дату окончания
+        self.period = DateRange(self.start, self.end, '[]')
+        try:
+            with transaction.atomic():
+                return super(SubscriptionFreeze, self).save(*args, **kwargs)
+        except IntegrityError as e:
+            if is_constraint_violation(e, 'subscription_freeze_period_overlap'):
+                raise BadRequest('Заморозки пересекаются')
+            raise
+
     # @transaction.atomic
     # def save(self, *args, **kwargs):
     #     if not self.id:
@@ -557,6 +813,12 @@ class SubscriptionFreeze(models.Model):
     class Meta:
         verbose_name = 'Заморозка'
         verbose_name_plural = 'Заморозки'
+        constraints = [
+            ExclusionConstraint(
+                name='subscription_freeze_period_overlap',
+                expressions=[('subscription', RangeOperators.EQUAL), ('period', RangeOperators.OVERLAPS)],
+            ),
+        ]
 
 
 class FAQ(models.Model):
@@ -663,3 +925,36 @@ post_delete.connect(user_avatar_delete, sender=User)
 post_delete.connect(faq_content_background_delete, sender=FAQContent)
 
 post_save.connect(create_helpdesk_chat, sender=User)
+post_save.connect(invalidate_subscription_catalog, sender=SubscriptionPlan)
+post_save.connect(invalidate_subscription_catalog, sender=SubscriptionAction)
+post_delete.connect(invalidate_subscription_catalog, sender=SubscriptionPlan)
+post_delete.connect(invalidate_subscription_catalog, sender=SubscriptionAction)
+m2m_changed.connect(invalidate_subscription_catalog, sender=SubscriptionPlan.actions.through)
+
+# Subscription и SubscriptionFreeze - для множества мастеров с правом в MasterIndex
+for cached_model in (CarBrand, Car, RepairCategory, FAQ, FAQTopic, FAQContent, SubscriptionPlan, SubscriptionAction,
+                     Subscription, SubscriptionFreeze):
+    post_save.connect(bump_cache_version, sender=cached_model)
+    post_delete.connect(bump_cache_version, sender=cached_model)
+m2m_changed.connect(bump_m2m_cache_version, sender=SubscriptionPlan.actions.through)
+m2m_changed.connect(recount_comment_likes, sender=Comment.users_liked.through)
+pre_delete.connect(user_comment_likes_delete, sender=User)
+pre_save.connect(grade_summary_pre_save, sender=Grade)
+post_save.connect(grade_summary_save, sender=Grade)
+post_delete.connect(grade_summary_delete, sender=Grade)
+pre_save.connect(review_author_pre_save, sender=User)
+post_save.connect(review_author_save, sender=User)
+post_delete.connect(review_author_delete, sender=User)
+post_save.connect(grade_photo_summary_refresh, sender=GradePhoto)
+post_delete.connect(grade_photo_summary_refresh, sender=GradePhoto)
+m2m_changed.connect(touch_offer_m2m, sender=RepairOffer.categories.through)
+m2m_changed.connect(touch_offer_m2m, sender=RepairOffer.canceled_masters.through)
+m2m_changed.connect(touch_offer_m2m, sender=RepairOffer.views.through)
+post_save.connect(touch_offer, sender=OfferImage)
+post_delete.connect(touch_offer, sender=OfferImage)
+post_save.connect(touch_offer, sender=Comment)
+post_delete.connect(touch_offer, sender=Comment)
+post_delete.connect(record_delete, sender=RepairOffer)
+m2m_changed.connect(chat_participants_changed, sender=Chat.participants.through)
+pre_delete.connect(chat_membership_delete, sender=Chat)
+pre_delete.connect(chat_membership_delete, sender=User)
@@ -0,0 +1,30 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from rest_framework.utils import json, encoders
+
+
+def category_group(category_id):
+    return f'offers-category-{category_id}'
+
+
+def offer_event(offer_id, owner_id, data):
+    text_data = json.dumps(data, cls=encoders.JSONEncoder, ensure_ascii=False)
+    return {'type': 'new_offer', 'message': text_data, 'offer_id': offer_id, 'owner_id': owner_id}
+
+
+async def send_to_categories(channel_layer, category_ids, event):
+    for category_id in category_ids:
+        await channel_layer.group_send(category_group(category_id), event)
+
+
+def broadcast_offer(offer, data):
+    """
+    Рассылает новый публичный оффер в группы его категорий. В группах только подключенные
+    мастера с этой категорией, поэтому стоимость рассылки зависит от числа заинтересованных,
+    а не от числа всех мастеров. Мастер из нескольких категорий получит оффер один раз:
+    повторы отбрасывает OfferFeedConsumer.
+    """
+    if offer.private:
+        return
+    category_ids = list(offer.categories.values_list('id', flat=True))
+    async_to_sync(send_to_categories)(get_channel_layer(), category_ids, offer_event(offer.id, offer.owner_id, data))
@@ -1,7 +1,98 @@
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+from rest_framework.pagination import BasePagination
+from rest_framework.pagination import CursorPagination
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+
+from .exceptions import BadRequest
 
 
 class StandardPagination(PageNumberPagination):
     page_size = 5
     page_size_query_param = 'page_size'
     max_page_size = 10
+
+
+class MessagePagination(CursorPagination):
+    # курсор по created: свежие страницы читают только последние партиции сообщений,
+    # старые доступны по ссылке next без OFFSET и без COUNT(*) по всем партициям
+    ordering = '-created'
+    page_size = StandardPagination.page_size
+    page_size_query_param = StandardPagination.page_size_query_param
+    max_page_size = StandardPagination.max_page_size
+
+
+def estimate_count(queryset):
+    # оценка числа строк по статистике Postgres вместо полного COUNT(*)
+    with connections[queryset.db].cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row = cursor.fetchone()
+            return max(row[0], 0) if row else 0
+        sql, params = queryset.order_by().query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        return cursor.fetchone()[0][0]['Plan']['Plan Rows']
+
+
+class EstimatedCountPaginator(Paginator):
+    # точный COUNT(*) только там, где строк по оценке немного
+    @cached_property
+    def count(self):
+        if not isinstance(self.object_list, QuerySet):
+            return super(EstimatedCountPaginator, self).count
+        estimate = estimate_count(self.object_list)
+        if estimate < settings.ADMIN_EXACT_COUNT_LIMIT:
+            return super(EstimatedCountPaginator, self).count
+        return estimate
+
+
+class KeysetPagination(BasePagination):
+    """
+    Страницы по ключу id вместо номера страницы: ?before=<id> - записи старше, от новых к старым;
+    ?after=<id> - записи новее, от старых к новым (догрузка после переподключения: следующая страница -
+    ?after=<after из ответа>, пока has_more). Стоимость не растет с глубиной и не зависит от новых записей.
+    """
+    page_size = 20
+    max_page_size = 100
+
+    def get_param(self, request, name, default=None):
+        value = request.query_params.get(name, default)
+        if value is None:
+            return None
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise BadRequest(f'Параметр {name} должен быть целым числом')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        limit = min(max(self.get_param(request, 'limit', self.page_size), 1), self.max_page_size)
+        before, after = self.get_param(request, 'before'), self.get_param(request, 'after')
+        if before is not None:
+            queryset = queryset.filter(pk__lt=before)
+        if after is not None:
+            queryset = queryset.filter(pk__gt=after)
+        # при догрузке берем самые старые из пропущенных, иначе разрыв больше limit потеряется
+        self.ascending = after is not None and before is None
+        page = list(queryset.order_by('pk' if self.ascending else '-pk')[:limit + 1])
+        self.has_more = len(page) > limit
+        self.page = page[:limit]
+        self.after = after
+        return self.page
+
+    def get_paginated_response(self, data):
+        if self.ascending:
+            before, after = None, self.page[-1].pk if self.page else self.after
+        else:
+            before = self.page[-1].pk if self.has_more else None
+            after = self.page[0].pk if self.page else self.after
+        return Response({
+            'before': before,
+            'after': after,
+            'has_more': self.has_more,
+            'results': data,
+        })
@@ -0,0 +1,264 @@
+import csv
+import datetime
+import gzip
+import os
+import re
+import shutil
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from dateutil.relativedelta import relativedelta
+
+from .models import Message
+from .models import MessageMedia
+
+PARTITION_RE = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+def table():
+    return Message._meta.db_table
+
+
+def quote(name):
+    return connection.ops.quote_name(name)
+
+
+def month_start(value):
+    value = value.astimezone(datetime.timezone.utc)
+    return datetime.datetime(value.year, value.month, 1, tzinfo=datetime.timezone.utc)
+
+
+def add_months(month, count):
+    return month + relativedelta(months=count)
+
+
+def parse_month(value):
+    # 'YYYY-MM' -> начало месяца в UTC
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').replace(tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+
+def partition_name(month):
+    return f'{table()}_p{month:%Y%m}'
+
+
+def default_partition_name():
+    return f'{table()}_default'
+
+
+def is_partitioned(cursor):
+    cursor.execute('SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)', [table()])
+    return cursor.fetchone() is not None
+
+
+def list_partitions(cursor):
+    # месячные партиции таблицы сообщений: {начало месяца: имя}
+    cursor.execute('SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid '
+                   'WHERE i.inhparent = to_regclass(%s)', [table()])
+    partitions = {}
+    for name, in cursor.fetchall():
+        match = PARTITION_RE.search(name)
+        if match:
+            partitions[datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc)] = name
+    return partitions
+
+
+def create_partition(cursor, month):
+    """
+    Создает партицию месяца. Строки этого месяца, попавшие в партицию по умолчанию
+    (партиции заранее не создали), переносятся в новую партицию.
+    """
+    name, default = partition_name(month), default_partition_name()
+    bounds = [month, add_months(month, 1)]
+    cursor.execute('SELECT 1 FROM ONLY {default} WHERE created >= %s AND created < %s LIMIT 1'.format(
+        default=quote(default)), bounds)
+    if cursor.fetchone() is None:
+        cursor.execute(f'CREATE TABLE {quote(name)} PARTITION OF {quote(table())} FOR VALUES FROM (%s) TO (%s)', bounds)
+        return name
+    cursor.execute(f'ALTER TABLE {quote(table())} DETACH PARTITION {quote(default)}')
+    cursor.execute(f'CREATE TABLE {quote(name)} PARTITION OF {quote(table())} FOR VALUES FROM (%s) TO (%s)', bounds)
+    cursor.execute(f'WITH moved AS (DELETE FROM {quote(default)} WHERE created >= %s AND created < %s RETURNING *) '
+                   f'INSERT INTO {quote(table())} SELECT * FROM moved', bounds)
+    cursor.execute(f'ALTER TABLE {quote(table())} ATTACH PARTITION {quote(default)} DEFAULT')
+    return name
+
+
+def ensure_partitions(cursor, ahead):
+    # партиции с текущего месяца на ahead месяцев вперед
+    existing = list_partitions(cursor)
+    current = month_start(timezone.now())
+    return [create_partition(cursor, month) for month in (add_months(current, i) for i in range(ahead + 1))
+            if month not in existing]
+
+
+def recreate_indexes(editor):
+    # индексы и внешние ключи уже на секционированной таблице, имена те же, что дал бы Django
+    for field in Message._meta.local_fields:
+        editor.deferred_sql.extend(editor._field_indexes_sql(Message, field))
+        if field.remote_field and field.db_constraint:
+            editor.deferred_sql.append(editor._create_fk_sql(Message, field, '_fk_%(to_table)s_%(to_column)s'))
+    for index in Message._meta.indexes:
+        editor.add_index(Message, index)
+
+
+@transaction.atomic
+def partition_table(ahead):
+    """
+    Переводит таблицу сообщений на секционирование по месяцам created.
+    Таблица пересоздается и данные копируются, поэтому запускать в окно обслуживания.
+    Первичный ключ становится (id, created): внешние ключи на сообщения в базе больше не проверяются.
+    """
+    legacy = f'{table()}_unpartitioned'
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {quote(table())} RENAME TO {quote(legacy)}')
+        cursor.execute('SELECT conrelid::regclass::text, conname FROM pg_constraint '
+                       'WHERE contype = %s AND confrelid = to_regclass(%s) AND conrelid <> confrelid', ['f', legacy])
+        for relation, constraint in cursor.fetchall():
+            cursor.execute(f'ALTER TABLE {relation} DROP CONSTRAINT {quote(constraint)}')
+        cursor.execute('SELECT pg_get_serial_sequence(%s, %s)', [legacy, 'id'])
+        sequence, = cursor.fetchone()
+
+        cursor.execute(f'CREATE TABLE {quote(table())} (LIKE {quote(legacy)} INCLUDING DEFAULTS) '
+                       f'PARTITION BY RANGE (created)')
+        cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {quote(table())}.id')
+        cursor.execute(f'CREATE TABLE {quote(default_partition_name())} PARTITION OF {quote(table())} DEFAULT')
+
+        cursor.execute(f'SELECT min(created) FROM {quote(legacy)}')
+        first, = cursor.fetchone()
+        month, current = month_start(first or timezone.now()), month_start(timezone.now())
+        while month < current:
+            create_partition(cursor, month)
+            month = add_months(month, 1)
+        ensure_partitions(cursor, ahead)
+
+        cursor.execute(f'INSERT INTO {quote(table())} SELECT * FROM {quote(legacy)}')
+        cursor.execute(f'DROP TABLE {quote(legacy)}')
+        cursor.execute(f'ALTER TABLE {quote(table())} ADD CONSTRAINT {quote(table() + "_pkey")} '
+                       f'PRIMARY KEY (id, created)')
+    with connection.schema_editor(atomic=False) as editor:
+        recreate_indexes(editor)
+
+
+def archive_dir(month):
+    return os.path.join(settings.MESSAGE_ARCHIVE_DIR, partition_name(month))
+
+
+def related_tables():
+    # таблицы со ссылками на сообщения: (таблица, столбец id сообщения)
+    have_read = Message.have_read.through
+    return [
+        ('media', MessageMedia._meta.db_table, MessageMedia._meta.get_field('message').column),
+        ('have_read', have_read._meta.db_table, have_read._meta.get_field('message').column),
+    ]
+
+
+def copy_to_file(cursor, query, path):
+    with gzip.open(path + '.tmp', 'wb') as file:
+        cursor.copy_expert(f'COPY ({query}) TO STDOUT WITH CSV HEADER', file)
+    os.replace(path + '.tmp', path)
+
+
+@transaction.atomic
+def archive_partition(month):
+    """
+    Отсоединяет партицию месяца и выгружает ее вместе со строками медиа и прочтений в CSV.gz,
+    затем удаляет их из базы. Файлы вложений остаются в хранилище.
+    Ответы из более новых месяцев на архивируемые сообщения обнуляются, как при SET_NULL:
+    внешнего ключа у reply нет, и удаление партиции Django не обрабатывает. Сами ссылки сохраняются
+    в replies.csv.gz, restore_partition их возвращает.
+    При ошибке выгрузки транзакция откатывается и партиция остается на месте.
+    """
+    name, directory = partition_name(month), archive_dir(month)
+    os.makedirs(directory, exist_ok=True)
+    with connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {quote(table())} DETACH PARTITION {quote(name)}')
+        copy_to_file(cursor, f'SELECT * FROM {quote(name)}', os.path.join(directory, 'messages.csv.gz'))
+        counts = {'messages': cursor.rowcount}
+        for key, related, column in related_tables():
+            query = f'SELECT * FROM {quote(related)} WHERE {quote(column)} IN (SELECT id FROM {quote(name)})'
+            copy_to_file(cursor, query, os.path.join(directory, f'{key}.csv.gz'))
+            cursor.execute(f'DELETE FROM {quote(related)} WHERE {quote(column)} IN (SELECT id FROM {quote(name)})')
+            counts[key] = cursor.rowcount
+        replies = f'FROM {quote(table())} WHERE reply_id IN (SELECT id FROM {quote(name)})'
+        copy_to_file(cursor, f'SELECT id, created, reply_id {replies}', os.path.join(directory, 'replies.csv.gz'))
+        cursor.execute(f'UPDATE {quote(table())} SET reply_id = NULL WHERE reply_id IN (SELECT id FROM {quote(name)})')
+        counts['replies'] = cursor.rowcount
+        cursor.execute(f'DROP TABLE {quote(name)}')
+    return counts
+
+
+def copy_from_file(cursor, relation, path):
+    with gzip.open(path, 'rb') as file:
+        cursor.copy_expert(f'COPY {quote(relation)} FROM STDIN WITH CSV HEADER', file)
+
+
+@transaction.atomic
+def restore_partition(month):
+    # обратная операция к archive_partition: партиция снова присоединяется, файлы архива удаляются
+    name, directory = partition_name(month), archive_dir(month)
+    with connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {quote(name)} (LIKE {quote(table())} INCLUDING DEFAULTS)')
+        copy_from_file(cursor, name, os.path.join(directory, 'messages.csv.gz'))
+        cursor.execute(f'ALTER TABLE {quote(table())} ATTACH PARTITION {quote(name)} '
+                       f'FOR VALUES FROM (%s) TO (%s)', [month, add_months(month, 1)])
+        for key, related, column in related_tables():
+            copy_from_file(cursor, related, os.path.join(directory, f'{key}.csv.gz'))
+        replies = os.path.join(directory, 'replies.csv.gz')
+        if os.path.exists(replies):
+            # ответы, обнуленные при архивации, снова указывают на сообщения месяца, если их не изменили с тех пор
+            cursor.execute('CREATE TEMPORARY TABLE archived_replies (id bigint, created timestamptz, reply_id bigint) '
+                           'ON COMMIT DROP')
+            copy_from_file(cursor, 'archived_replies', replies)
+            cursor.execute(f'UPDATE {quote(table())} message SET reply_id = archived.reply_id '
+                           f'FROM archived_replies archived WHERE message.id = archived.id '
+                           f'AND message.created = archived.created AND message.reply_id IS NULL')
+    transaction.on_commit(lambda: shutil.rmtree(directory, ignore_errors=True))
+
+
+def archived_months():
+    if not os.path.isdir(settings.MESSAGE_ARCHIVE_DIR):
+        return []
+    months = []
+    for name in os.listdir(settings.MESSAGE_ARCHIVE_DIR):
+        match = PARTITION_RE.search(name)
+        if match and os.path.exists(os.path.join(settings.MESSAGE_ARCHIVE_DIR, name, 'messages.csv.gz')):
+            months.append(datetime.datetime(int(match[1]), int(match[2]), 1, tzinfo=datetime.timezone.utc))
+    return sorted(months)
+
+
+def read_archive(month, key):
+    path = os.path.join(archive_dir(month), f'{key}.csv.gz')
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as file:
+        yield from csv.DictReader(file)
+
+
+def iter_archived_messages(month, chat_id):
+    """
+    Читает сообщения чата из архива месяца без восстановления партиции, в порядке created.
+    Файл месяца читается целиком потоком, поэтому это путь для редких запросов к старой истории.
+    """
+    read = {}
+    for row in read_archive(month, 'have_read'):
+        read.setdefault(row['message_id'], []).append(int(row['user_id']))
+    messages = []
+    for row in read_archive(month, 'messages'):
+        if row['chat_id'] != str(chat_id) or row['deleted'] == 't':
+            continue
+        messages.append({
+            'id': int(row['id']),
+            'chat': int(row['chat_id']),
+            'user': int(row['user_id']) if row['user_id'] else None,
+            'reply': int(row['reply_id']) if row['reply_id'] else None,
+            'text': row['text'],
+            'tech': row['tech'] == 't',
+            'created': parse_datetime(row['created']),
+            'changed': parse_datetime(row['changed']),
+            'have_read': read.get(row['id'], []),
+        })
+    return sorted(messages, key=lambda message: (message['created'], message['id']))
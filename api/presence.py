@@ -0,0 +1,171 @@
+import threading
+import time
+
+from django.conf import settings
+
+from fixithere import metrics
+
+
+class PresenceRegistry:
+    """
+    Кто на связи и кто печатает - в памяти процесса, без записей в базу.
+    Как и InMemoryChannelLayer, рассчитан на один процесс с веб-сокетами.
+    Соединение отмечается при подключении и сообщениями heartbeat от клиента: соединение,
+    молчащее дольше PRESENCE_TTL, считается оборванным (disconnect мог не дойти).
+    Чаты, откуда так выбыли участники, отдает sweep() - по ним консьюмеры рассылают новый список в сети.
+    """
+    sweep_interval = 1.0
+
+    def __init__(self):
+        # channel_name -> [user_id, chat_id или None, время последнего heartbeat]
+        self._channels = {}
+        # user_id -> соединения пользователя; chat_id -> {user_id: соединения в этом чате}
+        self._users = {}
+        self._chats = {}
+        # chat_id -> {user_id: печатает до}; chat_id -> время последней рассылки typing;
+        # чаты с отложенной до конца окна рассылкой typing
+        self._typing = {}
+        self._typing_sent = {}
+        self._typing_pending = set()
+        # чаты, где участник выбыл по PRESENCE_TTL, до следующего sweep()
+        self._swept_chats = set()
+        self._lock = threading.Lock()
+        self._swept_at = float('-inf')
+
+    def join(self, channel, user_id, chat_id=None):
+        # True, если пользователь только что появился в чате (первое его соединение с этим чатом)
+        now = time.monotonic()
+        with self._lock:
+            self._sweep(now)
+            self._channels[channel] = [user_id, chat_id, now]
+            self._users.setdefault(user_id, set()).add(channel)
+            if chat_id is None:
+                return False
+            channels = self._chats.setdefault(chat_id, {}).setdefault(user_id, set())
+            channels.add(channel)
+            return len(channels) == 1
+
+    def heartbeat(self, channel):
+        # False - соединение уже выброшено по PRESENCE_TTL, его нужно зарегистрировать заново
+        with self._lock:
+            record = self._channels.get(channel)
+            if record is None:
+                return False
+            record[2] = time.monotonic()
+            return True
+
+    def leave(self, channel):
+        # True, если у пользователя не осталось соединений с чатом этого соединения
+        with self._lock:
+            return self._remove(channel)
+
+    def _remove(self, channel):
+        record = self._channels.pop(channel, None)
+        if record is None:
+            return False
+        user_id, chat_id, _ = record
+        channels = self._users.get(user_id)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self._users[user_id]
+        if chat_id is None:
+            return False
+        members = self._chats.get(chat_id, {})
+        channels = members.get(user_id, set())
+        channels.discard(channel)
+        if channels:
+            return False
+        members.pop(user_id, None)
+        self._typing.get(chat_id, {}).pop(user_id, None)
+        if not members:
+            self._chats.pop(chat_id, None)
+            self._typing.pop(chat_id, None)
+            self._typing_sent.pop(chat_id, None)
+            self._typing_pending.discard(chat_id)
+        return True
+
+    def _sweep(self, now):
+        # вызывается под блокировкой, полный обход - не чаще раза в sweep_interval
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        border = now - settings.PRESENCE_TTL
+        for channel in [c for c, record in self._channels.items() if record[2] < border]:
+            chat_id = self._channels[channel][1]
+            if self._remove(channel):
+                self._swept_chats.add(chat_id)
+
+    def sweep(self):
+        """
+        Выбрасывает соединения, молчащие дольше PRESENCE_TTL, и возвращает {chat_id: кто в сети}
+        по чатам, из которых с прошлого вызова так выбыл участник. Вызывается по таймеру.
+        """
+        with self._lock:
+            self._sweep(time.monotonic())
+            chats, self._swept_chats = self._swept_chats, set()
+            return {chat_id: sorted(self._chats.get(chat_id, {})) for chat_id in chats}
+
+    def online(self, user_ids):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return {user_id for user_id in user_ids if user_id in self._users}
+
+    def chat_online(self, chat_id):
+        with self._lock:
+            self._sweep(time.monotonic())
+            return sorted(self._chats.get(chat_id, {}))
+
+    def typing(self, chat_id, user_id):
+        """
+        Отмечает, что пользователь печатает. Рассылка в чат - не чаще PRESENCE_TYPING_RATE раз в секунду.
+        Возвращает (users, flush_in): users - список печатающих, если пора разослать, иначе None;
+        flush_in - через сколько секунд вызвать flush_typing, чтобы разослать события, пришедшие внутри окна.
+        flush_in получает только первое такое событие окна, остальные попадут в ту же рассылку.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._typing.setdefault(chat_id, {})[user_id] = now + settings.PRESENCE_TYPING_TTL
+            wait = self._typing_sent.get(chat_id, float('-inf')) + 1 / settings.PRESENCE_TYPING_RATE - now
+            if wait > 0:
+                metrics.presence_typing_events.inc(result='coalesced')
+                if chat_id in self._typing_pending:
+                    return None, None
+                self._typing_pending.add(chat_id)
+                return None, wait
+            self._typing_pending.discard(chat_id)
+            metrics.presence_typing_events.inc(result='sent')
+            return self._send_typing(chat_id, now), None
+
+    def flush_typing(self, chat_id):
+        # рассылка в конце окна: список печатающих или None, если его уже разослали или чат опустел
+        now = time.monotonic()
+        with self._lock:
+            if chat_id not in self._typing_pending or chat_id not in self._typing:
+                return None
+            self._typing_pending.discard(chat_id)
+            metrics.presence_typing_events.inc(result='flushed')
+            return self._send_typing(chat_id, now)
+
+    def _send_typing(self, chat_id, now):
+        self._typing_sent[chat_id] = now
+        typing = self._typing[chat_id]
+        for expired in [u for u, until in typing.items() if until < now]:
+            del typing[expired]
+        return sorted(typing)
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._users), 'connections': len(self._channels), 'chats': len(self._chats)}
+
+
+presence = PresenceRegistry()
+
+
+def collect():
+    metrics.presence_online.clear()
+    for key, value in presence.stats().items():
+        metrics.presence_online.set(value, kind=key)
+
+
+metrics.registry.add_collector(collect)
@@ -10,6 +10,8 @@ from .models import RepairCategory
 from .models import OfferImage
 from .models import Grade
 from .models import GradePhoto
+from .models import ReviewSummary
+from .models import Activity
 from .models import Comment
 from .models import CommentMedia
 from .models import RepairOffer
@@ -62,6 +64,13 @@ class UserProfileSerializer(serializers.ModelSerializer):
         ]
 
 
+class MatchedMasterSerializer(UserProfileSerializer):
+    score = serializers.FloatField(read_only=True)
+
+    class Meta(UserProfileSerializer.Meta):
+        fields = UserProfileSerializer.Meta.fields + ['score']
+
+
 class UserProfileSimpleSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(read_only=True)
     name = serializers.CharField(read_only=True)
@@ -84,6 +93,16 @@ class RequestForCooperationSerializer(serializers.ModelSerializer):
     class Meta:
         model = RequestForCooperation
         fields = '__all__'
+        # запрос всегда от текущего пользователя, ответ - через approve/reject
+        read_only_fields = ['requesting', 'positive_response', 'responded']
+
+
+class ActivitySerializer(serializers.ModelSerializer):
+    actor = UserProfileSimpleSerializer(read_only=True)
+
+    class Meta:
+        model = Activity
+        fields = ['id', 'verb', 'actor', 'offer', 'object_id', 'data', 'created']
 
 
 class OfferImageSerializer(serializers.ModelSerializer):
@@ -96,6 +115,7 @@ class GradeSerializer(serializers.ModelSerializer):
     _rating_user = UserProfileSerializer(read_only=True, source='rating_user')
     _valued_user = UserProfileSerializer(read_only=True, source='valued_user')
     photo_count = serializers.SerializerMethodField()
+    fast_counts = {'photo_count': 'images'}
 
     def get_photo_count(self, instance):
         return instance.images.count()
@@ -105,6 +125,28 @@ class GradeSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class ReviewSummarySerializer(serializers.ModelSerializer):
+    average = serializers.FloatField(read_only=True)
+    histogram = serializers.DictField(child=serializers.IntegerField(), read_only=True)
+    latest = serializers.SerializerMethodField()
+
+    def get_latest(self, instance):
+        # в сводке хранятся относительные ссылки на файлы, абсолютные собираем по текущему запросу
+        request = self.context.get('request')
+        absolute = request.build_absolute_uri if request else (lambda url: url)
+        latest = []
+        for review in instance.latest:
+            review = dict(review, photos=[absolute(url) for url in review['photos']])
+            if review['rating_user'] and review['rating_user']['avatar']:
+                review['rating_user'] = dict(review['rating_user'], avatar=absolute(review['rating_user']['avatar']))
+            latest.append(review)
+        return latest
+
+    class Meta:
+        model = ReviewSummary
+        fields = ['user', 'count', 'average', 'histogram', 'latest', 'updated']
+
+
 class SendGradeSerializer(serializers.Serializer):
     grade = serializers.IntegerField(max_value=5, min_value=1)
     comment = serializers.CharField(allow_blank=True)
@@ -128,16 +170,15 @@ class CommentMediaSerializer(serializers.ModelSerializer):
 class CommentSerializer(serializers.ModelSerializer):
     user = serializers.HiddenField(default=serializers.CurrentUserDefault())
     _user = UserProfileSimpleSerializer(read_only=True, source='user')
-    users_liked = serializers.SerializerMethodField()
+    users_liked = serializers.IntegerField(read_only=True, source='likes_count')
     reply_str = serializers.SerializerMethodField()
     cut_text = serializers.CharField(read_only=True)
     media = CommentMediaSerializer(read_only=True, many=True)
-    is_liked = serializers.BooleanField(read_only=True)
+    is_liked = serializers.SerializerMethodField()
 
-    def get_users_liked(self, instance):
-        if hasattr(instance, 'users_liked_count'):
-            return instance.users_liked_count
-        return instance.users_liked.count()
+    def get_is_liked(self, instance):
+        # liked_ids передает CommentViewSet.get_serializer
+        return instance.pk in self.context.get('liked_ids', ())
 
     def get_reply_str(self, instance):
         return instance.reply_str()
@@ -147,6 +188,11 @@ class CommentSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class CommentThreadSerializer(CommentSerializer):
+    # replies и depth проставляются при сборке дерева в threads.build_tree
+    replies_count = serializers.IntegerField(read_only=True)
+
+
 class RepairOfferSerializer(serializers.ModelSerializer):
     owner = serializers.HiddenField(default=serializers.CurrentUserDefault())
     _owner = UserProfileSerializer(read_only=True, source='owner')
@@ -158,6 +204,7 @@ class RepairOfferSerializer(serializers.ModelSerializer):
     views = serializers.SerializerMethodField()
     comments = serializers.SerializerMethodField()
     images = OfferImageSerializer(read_only=True, many=True)
+    fast_counts = {'views': 'views', 'comments': 'comments'}
 
     # def get_images(self, instance):
     #     return [
@@ -270,3 +317,19 @@ class FAQContentSerializer(serializers.ModelSerializer):
     class Meta:
         model = FAQContent
         fields = '__all__'
+
+
+class FAQDocumentSerializer(serializers.ModelSerializer):
+    content = FAQContentSerializer(many=True, read_only=True)
+
+    class Meta:
+        model = FAQ
+        fields = '__all__'
+
+
+class FAQTopicDocumentSerializer(serializers.ModelSerializer):
+    faqs = FAQDocumentSerializer(many=True, read_only=True, source='actual_faqs')
+
+    class Meta:
+        model = FAQTopic
+        fields = '__all__'
@@ -13,12 +13,16 @@ from .exceptions import InvalidOTC
 from .exceptions import UserDoesNotExist
 from .exceptions import BadRequest
 from .models import User, OTC
+from django.db import transaction
 from django.db.models import Q
 from django.contrib.postgres.search import SearchVector
 
 from .models import Chat
 from .models import Subscription
-from .models import SubscriptionPlan
+from .models import RequestForCooperation
+
+from .catalog import subscription_catalog
+from .activity import publish
 
 
 def get_user_by_email(email):
@@ -204,6 +208,14 @@ def set_master(instance, master_id):
         raise UserDoesNotExist('Мастер не найден')
 
 
+@transaction.atomic
+def request_cooperation(requesting, responsible, request=None, **fields):
+    # единственное место создания запроса на сотрудничество: из профиля мастера и через /cooperation/
+    cooperation = RequestForCooperation.objects.create(requesting=requesting, responsible=responsible, **fields)
+    publish('cooperation_request', [responsible.id], actor=requesting, object_id=cooperation.id, request=request)
+    return cooperation
+
+
 def offers_base_filter(queryset, user_id):
     return queryset.filter(
         Q(private=False) |
@@ -212,6 +224,15 @@ def offers_base_filter(queryset, user_id):
     )
 
 
+def get_liked_comment_ids(user, comments):
+    # «лайкнул ли я» для всей страницы одним запросом
+    ids = [comment.pk for comment in comments]
+    if not ids or not user.is_authenticated:
+        return set()
+    return set(user.liked_comments.through.objects.filter(user_id=user.pk, comment_id__in=ids).values_list(
+        'comment_id', flat=True))
+
+
 def subscription_plans_base_filter(queryset):
     now_date = timezone.now().date()
     return queryset.filter(
@@ -237,8 +258,8 @@ def create_helpdesk_chat_for_user(user):
     return hd_chat
 
 
-def get_user_subscription_plan(user):
-    sub = Subscription.get_active(user)
+def get_user_subscription_plan(user, sub=None):
+    sub = sub or Subscription.get_active(user)
     if sub:
-        return sub.plan
-    return subscription_plans_base_filter(SubscriptionPlan.objects.all()).get(default=True)
+        return subscription_catalog.get_plan(sub.plan_id)
+    return subscription_catalog.get_default_plan(available_only=True)
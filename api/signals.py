@@ -1,3 +1,13 @@
+from django.db import connections
+from django.db import transaction
+from django.db.models import F
+
+from .catalog import subscription_catalog
+from .caching import bump_model_version
+from .caching import record_model_delete
+from .membership import chat_membership
+
+
 def file_model_delete(sender, instance, **kwargs):
     if instance.file.name:
         instance.file.delete(False)
@@ -27,3 +37,164 @@ def create_helpdesk_chat(sender, instance, created, **kwargs):
             private=True
         )
         hd_chat.participants.add(instance.id)
+
+
+def create_postgres_extensions(sender, using, **kwargs):
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+def invalidate_subscription_catalog(sender, **kwargs):
+    transaction.on_commit(subscription_catalog.invalidate)
+
+
+def bump_cache_version(sender, **kwargs):
+    transaction.on_commit(lambda: bump_model_version(sender))
+
+
+def bump_m2m_cache_version(sender, instance, model, **kwargs):
+    transaction.on_commit(lambda: [bump_model_version(type(instance)), bump_model_version(model)])
+
+
+def recount_comment_likes(sender, instance, action, reverse, pk_set, **kwargs):
+    # users_liked.add/remove/clear и правки в админке идут мимо Comment.like, счетчик пересчитываем
+    if action == 'pre_clear' and reverse:
+        instance._cleared_comment_ids = list(instance.liked_comments.values_list('pk', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        comment_ids = [instance.pk]
+    elif action == 'post_clear':
+        comment_ids = getattr(instance, '_cleared_comment_ids', [])
+    else:
+        comment_ids = pk_set
+    sender._meta.get_field('comment').related_model.recount_likes(comment_ids)
+
+
+def user_comment_likes_delete(sender, instance, **kwargs):
+    # лайки удаляемого пользователя уходят каскадом без сигналов m2m
+    instance.liked_comments.update(likes_count=F('likes_count') - 1)
+
+
+def grade_summary_pre_save(sender, instance, **kwargs):
+    # при правке отзыва пересчитываем сводки и старого, и нового оцениваемого
+    instance._summary_users = set()
+    if instance.pk is not None:
+        instance._summary_users = set(sender.objects.filter(pk=instance.pk).values_list('valued_user_id', flat=True))
+
+
+def grade_summary_save(sender, instance, created, **kwargs):
+    summary_model = sender._meta.apps.get_model('api', 'ReviewSummary')
+    user_id = instance.valued_user_id
+    if created:
+        if user_id is not None:
+            summary_model.add_grade(user_id, instance.grade)
+            transaction.on_commit(lambda: summary_model.refresh_latest(user_id))
+        return
+    for user_id in (instance._summary_users | {user_id}) - {None}:
+        transaction.on_commit(lambda user_id=user_id: summary_model.rebuild(user_id))
+
+
+def grade_summary_delete(sender, instance, **kwargs):
+    user_id = instance.valued_user_id
+    if user_id is None:
+        return
+    summary_model = sender._meta.apps.get_model('api', 'ReviewSummary')
+    summary_model.add_grade(user_id, instance.grade, sign=-1)
+    transaction.on_commit(lambda: summary_model.refresh_latest(user_id))
+
+
+def review_author_pre_save(sender, instance, update_fields=None, **kwargs):
+    # last_login и прочие частичные сохранения не трогают имя и аватар, лишний запрос не нужен
+    instance._review_author_changed = False
+    if instance.pk is None or (update_fields is not None and not {'name', 'avatar'} & set(update_fields)):
+        return
+    old = sender.objects.filter(pk=instance.pk).values_list('name', 'avatar').first()
+    instance._review_author_changed = old is not None and (old[0], old[1] or '') != (instance.name,
+                                                                                    instance.avatar.name or '')
+
+
+def review_author_save(sender, instance, created, **kwargs):
+    if getattr(instance, '_review_author_changed', False):
+        summary_model = sender._meta.apps.get_model('api', 'ReviewSummary')
+        transaction.on_commit(lambda: summary_model.refresh_author(instance.pk))
+
+
+def review_author_delete(sender, instance, **kwargs):
+    # rating_user обнуляется через SET_NULL без сигналов отзывов, а в сводках остались имя и аватар
+    user_id = instance.pk
+    summary_model = sender._meta.apps.get_model('api', 'ReviewSummary')
+    transaction.on_commit(lambda: summary_model.refresh_author(user_id))
+
+
+def grade_photo_summary_refresh(sender, instance, **kwargs):
+    # фото в админке меняют список последних отзывов; фото из send_grade создаются bulk_create без сигналов
+    grade_model = sender._meta.get_field('grade').related_model
+    user_id = grade_model.objects.filter(pk=instance.grade_id).values_list('valued_user_id', flat=True).first()
+    if user_id is not None:
+        summary_model = sender._meta.apps.get_model('api', 'ReviewSummary')
+        transaction.on_commit(lambda: summary_model.refresh_latest(user_id))
+
+
+def touch_offer_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    # categories.set()/add()/remove() не вызывают save() оффера
+    if action == 'pre_clear' and reverse:
+        # category.repairoffer_set.clear(): после очистки связей уже не найти
+        target = next(f for f in sender._meta.concrete_fields if f.is_relation and f.name != 'repairoffer')
+        instance._touched_offer_ids = list(
+            sender.objects.filter(**{target.attname: instance.pk}).values_list('repairoffer_id', flat=True))
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        offer_ids = [instance.pk]
+    elif action == 'post_clear':
+        offer_ids = getattr(instance, '_touched_offer_ids', [])
+    else:
+        offer_ids = pk_set
+    if offer_ids:
+        sender._meta.get_field('repairoffer').related_model.touch(offer_ids)
+
+
+def record_delete(sender, **kwargs):
+    transaction.on_commit(lambda: record_model_delete(sender))
+
+
+def touch_offer(sender, instance, **kwargs):
+    # фото и комментарии входят в ответ оффера (images, comments);
+    # фото из создания оффера пишутся bulk_create без сигналов, там touch вызывается явно
+    sender._meta.get_field('offer').related_model.touch([instance.offer_id])
+
+
+def invalidate_chat_membership(user_ids, chat_ids):
+    user_ids, chat_ids = list(user_ids), list(chat_ids)
+    transaction.on_commit(lambda: chat_membership.invalidate(user_ids=user_ids, chat_ids=chat_ids))
+
+
+def chat_participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # forward: instance - чат, pk_set - пользователи; reverse (user.chats) - наоборот
+    if action == 'pre_clear':
+        # после очистки связей их уже не найти
+        if reverse:
+            related_ids = sender.objects.filter(user_id=instance.pk).values_list('chat_id', flat=True)
+        else:
+            related_ids = sender.objects.filter(chat_id=instance.pk).values_list('user_id', flat=True)
+        instance._cleared_membership_ids = list(related_ids)
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    related_ids = getattr(instance, '_cleared_membership_ids', []) if action == 'post_clear' else pk_set
+    if reverse:
+        invalidate_chat_membership([instance.pk], related_ids)
+    else:
+        invalidate_chat_membership(related_ids, [instance.pk])
+
+
+def chat_membership_delete(sender, instance, **kwargs):
+    # при удалении чата или пользователя строки participants уходят каскадом без сигналов m2m
+    through = sender._meta.apps.get_model('api', 'Chat').participants.through
+    if sender._meta.model_name == 'chat':
+        user_ids = through.objects.filter(chat_id=instance.pk).values_list('user_id', flat=True)
+        invalidate_chat_membership(user_ids, [instance.pk])
+    else:
+        chat_ids = through.objects.filter(user_id=instance.pk).values_list('chat_id', flat=True)
+        invalidate_chat_membership([instance.pk], chat_ids)
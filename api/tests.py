@@ -1,3 +1,1158 @@
+import asyncio
+import datetime
+import io
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.admin.sites import site
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase
+
+from fixithere import routers
+from fixithere.middleware import ReplicaRoutingMiddleware
+
+from .caching import bump_model_version
+from .caching import get_model_versions
+from .caching import get_version_key
+from .catalog import SubscriptionCatalog
+from .consumers import OfferFeedConsumer
+from .consumers import chat_group
+from .consumers import flush_typing_later
+from .exceptions import BadRequest
+from .matching import MasterIndex
+from .matching import MasterMatcher
+from .membership import ChatMembership
+from .membership import chat_membership
+from .message_search import make_snippet
+from .models import Activity
+from .models import CarBrand
+from .models import Chat
+from .models import Comment
+from .models import Grade
+from .models import GradePhoto
+from .models import Message
+from .models import OfferImage
+from .models import RepairCategory
+from .models import RepairOffer
+from .models import RequestForCooperation
+from .models import ReviewSummary
+from .models import Subscription
+from .models import SubscriptionAction
+from .models import SubscriptionFreeze
+from .models import SubscriptionPlan
+from .models import ThrottleBucket
+from .models import User
+from .models import UserReport
+from .offer_feed import broadcast_offer
+from .partitions import add_months
+from .partitions import archive_partition
+from .partitions import archived_months
+from .partitions import iter_archived_messages
+from .partitions import month_start
+from .partitions import parse_month
+from .partitions import partition_table
+from .partitions import restore_partition
+from .presence import PresenceRegistry
+from .renderers import FastJSONRenderer
+from .renderers import orjson
+from .throttling import memory_buckets
+from .throttling import prune_shared_buckets
+
+
+def create_user(email, **fields):
+    user = User.objects.create_user(email=email, password='password')
+    if fields:
+        User.objects.filter(pk=user.pk).update(**fields)
+        user.refresh_from_db()
+    return user
+
+
+def create_plan(code='base', **fields):
+    fields.setdefault('name', code)
+    return SubscriptionPlan.objects.create(code=code, cost=100, currency='RUB', **fields)
+
+
+class SubscriptionPeriodTest(TestCase):
+    def setUp(self):
+        self.user = create_user('driver@test.ru')
+        self.plan = create_plan()
+        self.today = timezone.now().date()
+
+    def subscribe(self, start, days, active=True, payment_id='p'):
+        return Subscription.objects.create(user=self.user, plan=self.plan, payment_id=payment_id, value='100',
+                                           start=start, expiration_date=start + datetime.timedelta(days=days),
+                                           active=active)
+
+    def test_overlapping_active_subscriptions_rejected(self):
+        self.subscribe(self.today, 30)
+        with self.assertRaises(BadRequest):
+            self.subscribe(self.today + datetime.timedelta(days=10), 30)
+
+    def test_adjacent_and_inactive_subscriptions_allowed(self):
+        self.subscribe(self.today, 30)
+        # конец периода не включается: следующая подписка может начаться в день окончания
+        self.subscribe(self.today + datetime.timedelta(days=30), 30)
+        self.subscribe(self.today, 30, active=False)
+        self.assertEqual(Subscription.objects.filter(user=self.user).count(), 3)
+
+    def test_active_lookups(self):
+        self.assertFalse(Subscription.has_active(self.user))
+        self.assertIsNone(Subscription.get_active(self.user))
+
+        expired = self.subscribe(self.today - datetime.timedelta(days=30), 30)
+        self.assertFalse(Subscription.has_active(self.user))
+
+        sub = self.subscribe(self.today, 30)
+        self.assertTrue(Subscription.has_active(self.user))
+        self.assertEqual(Subscription.get_active(self.user), sub)
+
+        Subscription.cancel_active(self.user)
+        sub.refresh_from_db()
+        expired.refresh_from_db()
+        self.assertFalse(sub.active)
+        self.assertTrue(expired.active)
+
+    def test_frozen_subscription_is_not_active(self):
+        sub = self.subscribe(self.today - datetime.timedelta(days=5), 30)
+        SubscriptionFreeze.objects.create(subscription=sub, start=self.today - datetime.timedelta(days=1),
+                                          end=self.today)
+        self.assertTrue(sub.is_freeze)
+        self.assertIsNone(Subscription.get_active(self.user))
+        with self.assertRaises(BadRequest):
+            SubscriptionFreeze.objects.create(subscription=sub, start=self.today, end=self.today)
+
+    def test_backfill_command(self):
+        sub = self.subscribe(self.today, 30)
+        freeze = SubscriptionFreeze.objects.create(subscription=sub, start=self.today, end=self.today)
+        Subscription.objects.update(period=None)
+        SubscriptionFreeze.objects.update(period=None)
+        self.assertFalse(Subscription.has_active(self.user))
+
+        call_command('backfill_subscription_periods', stdout=io.StringIO())
+        # дата окончания заморозки входит в период
+        self.assertTrue(SubscriptionFreeze.objects.filter(pk=freeze.pk, period__contains=self.today).exists())
+        self.assertTrue(sub.is_freeze)
+        SubscriptionFreeze.objects.all().delete()
+        self.assertEqual(Subscription.get_active(self.user), sub)
+
+
+class PayNotificationsTest(APITestCase):
+    url = '/api/subscription/pay_notifications/'
+
+    def test_unknown_payment(self):
+        response = self.client.post(self.url, {'object': {'id': 'unknown', 'status': 'succeeded'}}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(SUBSCRIPTION_CATALOG_CHECK_INTERVAL=0)
+class SubscriptionCatalogTest(TestCase):
+    def test_other_process_sees_changes(self):
+        plan = create_plan()
+        action = SubscriptionAction.objects.create(name='Отклики', value='да', code='respond')
+        # отдельный каталог - как в другом процессе: о смене версии он узнает только из кэша 'shared'
+        reader = SubscriptionCatalog()
+        self.assertEqual(reader.get_permissions(plan.id), {'respond': False})
+        self.assertEqual(reader.get_default_plan(), plan)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            plan.actions.add(action)
+        self.assertEqual(reader.get_permissions(plan.id), {'respond': True})
+        self.assertTrue(reader.plan_has_action(plan.id, 'respond'))
+        self.assertEqual(reader.get_plans_with_action('respond'), [plan.id])
+
+
+class MatchingMastersTest(APITestCase):
+    def setUp(self):
+        self.owner = create_user('owner@test.ru')
+        self.master = create_user('master@test.ru', role='master')
+        category = RepairCategory.objects.create(name='Двигатель', color='#000000')
+        self.master.repair_categories.add(category)
+        self.offer = RepairOffer.objects.create(owner=self.owner, title='Стук', description='Стучит двигатель')
+        self.offer.categories.add(category)
+        self.url = f'/api/offers/{self.offer.id}/matching_masters/'
+        self.client.force_authenticate(self.owner)
+
+    def test_limit_must_be_positive(self):
+        for limit in ('0', '-5', 'x'):
+            self.assertEqual(self.client.get(self.url, {'limit': limit}).status_code, 400)
+
+    def test_limit_is_capped(self):
+        plan = create_plan(code='free')
+        plan.actions.add(SubscriptionAction.objects.create(name='Отклики', value='да', code='can_take_offers'))
+        extra = create_user('master2@test.ru', role='master')
+        extra.repair_categories.set(self.master.repair_categories.all())
+        with override_settings(MAX_MATCHING_MASTERS=1):
+            response = self.client.get(self.url, {'limit': '1000'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 1)
+
+    def test_permissions_from_index(self):
+        plan = create_plan(code='free', default=True)
+        action = SubscriptionAction.objects.create(name='Отклики', value='да', code='can_take_offers')
+        paid = create_plan(code='paid')
+        paid.actions.add(action)
+        category = self.master.repair_categories.get()
+        others = [create_user(f'master{i}@test.ru', role='master') for i in range(30)]
+        for other in others:
+            other.repair_categories.add(category)
+        matcher = MasterMatcher(self.offer, self.owner, index=MasterIndex())
+        self.assertEqual(matcher.top(1), [])
+
+        # права из индекса: число запросов не зависит от числа мастеров без права
+        with self.captureOnCommitCallbacks(execute=True):
+            Subscription.objects.create(user=others[-1], plan=paid, active=True, start=timezone.now().date(),
+                                        expiration_date=timezone.now().date() + datetime.timedelta(days=30))
+        with self.assertNumQueries(4):
+            self.assertEqual([master_id for _, master_id in matcher.top(1)], [others[-1].id])
+        with self.assertNumQueries(3):
+            matcher.top(1)
+
+
+@unittest.skipIf(orjson is None, 'orjson не установлен')
+class FastJSONRendererTest(unittest.TestCase):
+    def test_same_bytes_as_drf(self):
+        data = {
+            'created': timezone.now(),
+            'naive': datetime.datetime(2022, 1, 2, 3, 4, 5, 678000),
+            'date': datetime.date(2022, 1, 2),
+            'time': datetime.time(3, 4, 5, 678901),
+            'counts': {1: 'один', 2.5: 'два с половиной', None: 'нет'},
+            'text': 'строка\u2028с разделителем\u2029и "кавычками"',
+            'nested': [{'decimal': 1.5, 'flag': False, 'empty': None}],
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertIn(b'Z"', FastJSONRenderer().render({'created': timezone.now()}))
+
+    def test_falls_back_where_orjson_differs(self):
+        for data in [{'big': 2 ** 64, 'negative': -2 ** 70}, {'floats': [1e20, 1e-7, 1.5e300, 0.1]},
+                     {'text': 'ключ 1e5 в строке', 'n': 1}]:
+            self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_non_finite_floats(self):
+        # единственное оставленное отличие: DRF в строгом режиме не кодирует NaN, orjson пишет null
+        with self.assertRaises(ValueError):
+            JSONRenderer().render({'value': float('nan')})
+        self.assertEqual(FastJSONRenderer().render({'value': float('nan')}), b'{"value":null}')
+
+
+class FastListSerializersTest(APITestCase):
+    urls = [
+        '/api/offers/?ordering=created',
+        '/api/offers/?ordering=-created&page_size=2',
+        '/api/masters/',
+        '/api/grades/?ordering=created',
+    ]
+
+    def setUp(self):
+        self.owner = create_user('owner@test.ru', name='Водитель')
+        self.master = create_user('master@test.ru', name='Мастер', role='master', avatar='avatars/master.png')
+        plan = create_plan(code='free')
+        plan.actions.add(SubscriptionAction.objects.create(name='Отклики', value='да', code='can_take_offers'))
+        categories = [RepairCategory.objects.create(name=f'Категория {i}', color=f'#00000{i}') for i in range(3)]
+        self.master.repair_categories.add(*categories[:2])
+        for i in range(3):
+            offer = RepairOffer.objects.create(owner=self.owner, master=self.master if i else None,
+                                               title=f'Оффер {i}', description='Описание')
+            offer.categories.add(*categories[i:])
+            offer.views.add(self.master)
+            OfferImage.objects.create(offer=offer, img=f'offers/{i}.jpg')
+            Comment.objects.create(offer=offer, user=self.master, text='Комментарий')
+            if i:
+                grade = Grade.objects.create(grade=i + 3, rating_user=self.owner, valued_user=self.master,
+                                             offer=offer, comment='Спасибо')
+                GradePhoto.objects.create(grade=grade, img=f'grades/{i}.jpg')
+                RepairOffer.objects.filter(pk=offer.pk).update(owner_grade=grade)
+        self.client.force_authenticate(self.owner)
+
+    def test_fast_and_drf_responses_match(self):
+        for url in self.urls + [f'/api/public_offers/?master={self.master.id}&ordering=created']:
+            with override_settings(FAST_LIST_SERIALIZERS=False):
+                expected = self.client.get(url)
+            with override_settings(FAST_LIST_SERIALIZERS=True):
+                actual = self.client.get(url)
+            self.assertEqual(expected.status_code, 200, url)
+            self.assertTrue(expected.data['results'], url)
+            self.assertEqual(actual.content.decode(), expected.content.decode(), url)
+
+
+class LargeTableAdminSearchTest(TestCase):
+    def test_subscription_search(self):
+        today = timezone.now().date()
+        plans = [create_plan(code='base', name='Базовый'), create_plan(code='pro', name='Профи')]
+        users = [create_user('ivanov@test.ru', name='Иванов'), create_user('petrov@test.ru', name='Петров')]
+        subs = [Subscription.objects.create(user=user, plan=plan, payment_id=f'pay-{i}', value='100', start=today,
+                                            expiration_date=today + datetime.timedelta(days=30))
+                for i, (user, plan) in enumerate(zip(users, plans))]
+        admin = site._registry[Subscription]
+        request = RequestFactory().get('/')
+        for term, expected in [('иван', [subs[0]]), ('PETROV@TEST.RU', [subs[1]]), ('проф', [subs[1]]),
+                               ('PAY-0', [subs[0]]), ('ров', []), ('иван базов', [subs[0]]), ('иван проф', [])]:
+            queryset, may_have_duplicates = admin.get_search_results(request, Subscription.objects.all(), term)
+            self.assertEqual(list(queryset), expected, term)
+            self.assertFalse(may_have_duplicates)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaPinTest(TestCase):
+    def handle(self, method, write=False, cookies=None, **headers):
+        states = []
+
+        def get_response(request):
+            states.append(routers.current_state.get())
+            states[0].written = write
+            return HttpResponse()
+
+        # у каждого запроса свой экземпляр middleware и пустой локальный кэш - как в разных процессах
+        caches['default'].clear()
+        request = getattr(RequestFactory(), method)('/', **headers)
+        request.COOKIES.update(cookies or {})
+        self.response = ReplicaRoutingMiddleware(get_response)(request)
+        return states[0].pinned
+
+    def test_pin_survives_other_process(self):
+        auth = {'HTTP_AUTHORIZATION': 'Bearer token'}
+        self.assertFalse(self.handle('get', **auth))
+        self.assertTrue(self.handle('post', write=True, **auth))
+        self.assertTrue(self.handle('get', **auth))
+        self.assertFalse(self.handle('get', HTTP_AUTHORIZATION='Bearer other'))
+
+    def test_pin_cookie(self):
+        self.assertTrue(self.handle('post', write=True))
+        cookies = {'db_pin': self.response.cookies['db_pin'].value}
+        with self.assertNumQueries(0):
+            # метка в cookie: общий кэш не читается
+            self.assertTrue(self.handle('get', cookies=cookies, HTTP_AUTHORIZATION='Bearer token'))
+        with mock.patch('fixithere.middleware.time.time', return_value=time.time() + 11), self.assertNumQueries(0):
+            self.assertFalse(self.handle('get', cookies=cookies, HTTP_AUTHORIZATION='Bearer token'))
+        # подделанная cookie не закрепляет и не отменяет проверку общего кэша
+        self.assertFalse(self.handle('get', cookies={'db_pin': '9999999999'}))
+
+    def test_shared_cache_write_does_not_pin(self):
+        state = routers.RoutingState()
+        token = routers.current_state.set(state)
+        try:
+            caches['shared'].set('replica_pin_test', 1)
+            caches['shared'].delete('replica_pin_test')
+        finally:
+            routers.current_state.reset(token)
+        self.assertFalse(state.written)
+
+
+@override_settings(WRITE_THROTTLE_RATES={
+    'reports.create': {'rate': '1/hour', 'burst': 2},
+    'cooperation.create': {'rate': '1/hour', 'burst': 1},
+})
+class WriteThrottleTest(APITestCase):
+    def setUp(self):
+        memory_buckets._buckets.clear()
+        self.user = create_user('master@test.ru', role='master')
+        self.others = [create_user(f'user{i}@test.ru', role='master') for i in range(4)]
+        self.client.force_authenticate(self.user)
+        create_plan().actions.add(
+            SubscriptionAction.objects.create(name='Отклики', value='да', code='can_take_offers'))
+
+    def report(self, user):
+        return self.client.post('/api/reports/', {'to_user': user.id, 'reason': 'Спам'})
+
+    def test_burst_then_throttled(self):
+        self.assertEqual(self.report(self.others[0]).status_code, 201)
+        self.assertEqual(self.report(self.others[1]).status_code, 201)
+        response = self.report(self.others[2])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(UserReport.objects.count(), 2)
+
+    def test_shared_bucket_applies_to_other_processes(self):
+        self.report(self.others[0])
+        self.report(self.others[1])
+        # корзины другого процесса пусты, но общая корзина в базе уже исчерпана
+        memory_buckets._buckets.clear()
+        self.assertEqual(self.report(self.others[2]).status_code, 429)
+
+    def test_cooperation_actions_share_bucket(self):
+        url = f'/api/masters/{self.others[0].id}/request_for_cooperation/'
+        self.assertEqual(self.client.post(url).status_code, 200)
+        response = self.client.post('/api/cooperation/', {'requesting': self.user.id, 'responsible': self.others[1].id})
+        self.assertEqual(response.status_code, 429)
+
+    def test_prune_keeps_recent_buckets(self):
+        self.report(self.others[0])
+        ThrottleBucket.objects.create(key='reports.create:old', tokens=0,
+                                      updated=timezone.now() - datetime.timedelta(hours=3))
+        self.assertEqual(prune_shared_buckets(), 1)
+        self.assertEqual(list(ThrottleBucket.objects.values_list('key', flat=True)), [f'reports.create:{self.user.id}'])
+
+
+@override_settings(WRITE_THROTTLE_RATES={})
+class UserReportTest(APITestCase):
+    def test_one_report_per_user_in_12_hours(self):
+        user, other, third = [create_user(f'{name}@test.ru') for name in ('driver', 'master', 'third')]
+        self.client.force_authenticate(user)
+        url, data = '/api/reports/', {'to_user': other.id, 'reason': 'Спам'}
+        self.assertEqual(self.client.post(url, data).status_code, 201)
+        self.assertEqual(self.client.post(url, data).status_code, 400)
+        self.assertEqual(self.client.post(url, {'to_user': third.id, 'reason': 'Спам'}).status_code, 201)
+
+        UserReport.objects.update(created=timezone.now() - datetime.timedelta(hours=12, minutes=1))
+        self.assertEqual(self.client.post(url, data).status_code, 201)
+        self.assertEqual(UserReport.objects.filter(from_user=user, to_user=other).count(), 2)
+
+
+@override_settings(WRITE_THROTTLE_RATES={})
+class CommentLikeTest(APITestCase):
+    def setUp(self):
+        self.users = [create_user(f'user{i}@test.ru') for i in range(2)]
+        offer = RepairOffer.objects.create(owner=self.users[0], title='Стук', description='Стучит двигатель')
+        self.comment = Comment.objects.create(offer=offer, user=self.users[0], text='Комментарий')
+        self.url = f'/api/comments/{self.comment.id}/'
+
+    def post(self, user, action):
+        self.client.force_authenticate(user)
+        return self.client.post(f'{self.url}{action}/')
+
+    def likes(self):
+        self.comment.refresh_from_db()
+        return self.comment.likes_count
+
+    def test_like_and_unlike_are_idempotent(self):
+        for _ in range(2):
+            self.assertEqual(self.post(self.users[0], 'like').data, {'like': True})
+        self.assertEqual(self.likes(), 1)
+        self.post(self.users[1], 'like')
+        self.assertEqual(self.likes(), 2)
+        self.assertEqual(self.comment.users_liked.count(), 2)
+
+        response = self.client.get(self.url)
+        self.assertEqual((response.data['users_liked'], response.data['is_liked']), (2, True))
+
+        for _ in range(2):
+            self.assertEqual(self.post(self.users[1], 'unlike').data, {'like': False})
+        self.assertEqual(self.likes(), 1)
+        response = self.client.get(self.url)
+        self.assertEqual((response.data['users_liked'], response.data['is_liked']), (1, False))
+
+    def test_count_follows_m2m_changes_and_user_deletion(self):
+        self.comment.like(self.users[1].id)
+        self.comment.users_liked.add(self.users[0])
+        self.assertEqual(self.likes(), 2)
+        self.comment.users_liked.remove(self.users[0])
+        self.assertEqual(self.likes(), 1)
+        self.users[1].delete()
+        self.assertEqual(self.likes(), 0)
+
+        Comment.objects.filter(pk=self.comment.pk).update(likes_count=10)
+        Comment.recount_likes([self.comment.pk])
+        self.assertEqual(self.likes(), 0)
+
+
+class CommentThreadTest(APITestCase):
+    def setUp(self):
+        self.owner, self.stranger = create_user('owner@test.ru'), create_user('stranger@test.ru')
+        self.offer = RepairOffer.objects.create(owner=self.owner, title='Стук', description='Стучит двигатель')
+        self.roots = [self.comment(f'Корень {i}') for i in range(3)]
+        self.answers = [self.comment(f'Ответ {i}', self.roots[0]) for i in range(3)]
+        self.deep = self.comment('Второй уровень', self.answers[0])
+        self.deeper = self.comment('Третий уровень', self.deep)
+        self.client.force_authenticate(self.owner)
+
+    def comment(self, text, reply=None):
+        return Comment.objects.create(offer=self.offer, user=self.owner, text=text, reply=reply)
+
+    def thread(self, **params):
+        return self.client.get('/api/comments/thread/', params)
+
+    def shape(self, nodes):
+        return [(node['id'], node['depth'], self.shape(node['replies'])) for node in nodes]
+
+    def test_levels_are_limited_by_depth_and_siblings(self):
+        response = self.thread(offer=self.offer.id, depth=2, limit=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(self.shape(response.data['results']), [
+            (self.roots[0].id, 1, [(self.answers[0].id, 2, []), (self.answers[1].id, 2, [])]),
+            (self.roots[1].id, 1, []),
+        ])
+
+        response = self.thread(offer=self.offer.id, depth=1, limit=2, offset=1)
+        self.assertEqual(self.shape(response.data['results']), [(self.roots[1].id, 1, []), (self.roots[2].id, 1, [])])
+
+    def test_subtree_from_root(self):
+        response = self.thread(root=self.answers[0].id, depth=5)
+        self.assertEqual(response.data['count'], 1)
+        self.assertEqual(self.shape(response.data['results']), [(self.deep.id, 1, [(self.deeper.id, 2, [])])])
+
+    def test_query_count_does_not_grow_with_depth(self):
+        with CaptureQueriesContext(connection) as shallow:
+            self.thread(offer=self.offer.id, depth=1)
+        with CaptureQueriesContext(connection) as deep:
+            self.thread(offer=self.offer.id, depth=4)
+        self.assertEqual(len(deep), len(shallow))
+
+    def test_bad_params_and_private_offers(self):
+        for params in ({}, {'offer': 'x'}, {'root': 'x'}, {'offer': self.offer.id, 'depth': 0},
+                       {'offer': self.offer.id, 'limit': 'много'}):
+            self.assertEqual(self.thread(**params).status_code, 400, params)
+        self.assertEqual(self.thread(root=self.deeper.id + 100).status_code, 404)
+
+        RepairOffer.objects.filter(pk=self.offer.pk).update(private=True)
+        self.client.force_authenticate(self.stranger)
+        self.assertEqual(self.thread(offer=self.offer.id).status_code, 404)
+        self.assertEqual(self.thread(root=self.roots[0].id).status_code, 404)
+
+
+class SendGradeTest(APITestCase):
+    def setUp(self):
+        self.owner, self.master = create_user('owner@test.ru'), create_user('master@test.ru', role='master')
+        self.offer = RepairOffer.objects.create(owner=self.owner, master=self.master, title='Стук',
+                                                description='Стучит двигатель')
+        self.client.force_authenticate(self.owner)
+
+    def send_grade(self):
+        photo = SimpleUploadedFile('photo.png', b'\x89PNG\r\n\x1a\n' + b'0' * 16, content_type='image/png')
+        return self.client.post(f'/api/offers/{self.offer.id}/send_grade/',
+                                {'grade': 4, 'comment': 'Хорошо', 'photo': photo}, format='multipart')
+
+    def test_activity_published_after_uploads(self):
+        with mock.patch('api.uploads.write_file', return_value='grades/photo.png'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertEqual(self.send_grade().status_code, 200)
+        grade = Grade.objects.get()
+        self.assertEqual(grade.images.count(), 1)
+        self.assertEqual(list(Activity.objects.values_list('verb', 'user_id', 'object_id')),
+                         [('grade', self.master.id, grade.id)])
+
+    def test_failed_upload_publishes_nothing(self):
+        with mock.patch('api.uploads.write_file', side_effect=OSError('хранилище недоступно')):
+            with self.captureOnCommitCallbacks(execute=True):
+                with self.assertRaises(OSError):
+                    self.send_grade()
+        self.assertFalse(Grade.objects.exists())
+        self.assertFalse(Activity.objects.exists())
+
+
+class ReviewSummaryTest(APITestCase):
+    def setUp(self):
+        self.driver = create_user('driver@test.ru', name='Водитель')
+        self.masters = [create_user(f'master{i}@test.ru', role='master') for i in range(2)]
+
+    def grade(self, value, master=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Grade.objects.create(grade=value, rating_user=self.driver, valued_user=master or self.masters[0],
+                                        comment=f'Оценка {value}')
+
+    def summary(self, master=None):
+        return ReviewSummary.objects.get(user=master or self.masters[0])
+
+    def assertSummary(self, summary, count, total, histogram):
+        self.assertEqual((summary.count, summary.total, summary.histogram), (count, total, histogram))
+
+    def test_counters_follow_grades(self):
+        grades = [self.grade(5), self.grade(4), self.grade(5)]
+        summary = self.summary()
+        self.assertSummary(summary, 3, 14, {1: 0, 2: 0, 3: 0, 4: 1, 5: 2})
+        self.assertEqual(summary.average, 4.67)
+        self.assertEqual([review['id'] for review in summary.latest], [grade.id for grade in reversed(grades)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grades[0].grade = 1
+            grades[0].save()
+        self.assertSummary(self.summary(), 3, 10, {1: 1, 2: 0, 3: 0, 4: 1, 5: 1})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grades[1].valued_user = self.masters[1]
+            grades[1].save()
+        self.assertSummary(self.summary(), 2, 6, {1: 1, 2: 0, 3: 0, 4: 0, 5: 1})
+        self.assertSummary(self.summary(self.masters[1]), 1, 4, {1: 0, 2: 0, 3: 0, 4: 1, 5: 0})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            grades[2].delete()
+        self.assertSummary(self.summary(), 1, 1, {1: 1, 2: 0, 3: 0, 4: 0, 5: 0})
+        self.assertEqual([review['id'] for review in self.summary().latest], [grades[0].id])
+
+    def test_rebuild_matches_incremental_counters(self):
+        for value in (3, 5, 2):
+            self.grade(value)
+        incremental = self.summary()
+        ReviewSummary.objects.filter(user=self.masters[0]).update(count=0, total=0, grade_3=0)
+        ReviewSummary.rebuild(self.masters[0].id)
+        rebuilt = self.summary()
+        self.assertSummary(rebuilt, incremental.count, incremental.total, incremental.histogram)
+        self.assertEqual(rebuilt.latest, incremental.latest)
+
+    def test_summary_endpoint(self):
+        self.grade(4)
+        self.client.force_authenticate(self.driver)
+        response = self.client.get('/api/grades/summary/', {'valued_user': self.masters[0].id})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body['count'], body['average']), (1, 4.0))
+        self.assertEqual(body['histogram'], {'1': 0, '2': 0, '3': 0, '4': 1, '5': 0})
+        self.assertEqual(body['latest'][0]['rating_user']['name'], 'Водитель')
+
+        response = self.client.get('/api/grades/summary/', {'valued_user': self.masters[1].id})
+        self.assertEqual((response.json()['count'], response.json()['average']), (0, 0.0))
+
+    def test_author_changes_reach_summaries(self):
+        self.grade(5)
+        self.grade(4, self.masters[1])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.driver.name = 'Новое имя'
+            self.driver.save()
+        for master in self.masters:
+            self.assertEqual(self.summary(master).latest[0]['rating_user']['name'], 'Новое имя')
+
+        with self.assertNumQueries(1), self.captureOnCommitCallbacks(execute=True):
+            self.driver.save(update_fields=['last_login'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.driver.delete()
+        for master in self.masters:
+            self.assertIsNone(self.summary(master).latest[0]['rating_user'])
+
+
+@override_settings(WRITE_THROTTLE_RATES={})
+class CooperationRequestTest(APITestCase):
+    def setUp(self):
+        self.master, self.other = [create_user(f'master{i}@test.ru', role='master') for i in range(2)]
+        create_plan().actions.add(
+            SubscriptionAction.objects.create(name='Отклики', value='да', code='can_take_offers'))
+        self.client.force_authenticate(self.master)
+
+    def test_both_paths_publish_activity(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post(f'/api/masters/{self.other.id}/request_for_cooperation/').status_code,
+                             200)
+            response = self.client.post('/api/cooperation/', {'requesting': self.master.id,
+                                                              'responsible': self.other.id})
+            self.assertEqual(response.status_code, 201)
+        cooperation_ids = list(RequestForCooperation.objects.order_by('id').values_list('id', flat=True))
+        self.assertEqual(len(cooperation_ids), 2)
+        self.assertEqual(response.data['id'], cooperation_ids[1])
+        activities = Activity.objects.filter(verb='cooperation_request').order_by('object_id')
+        self.assertEqual(list(activities.values_list('user_id', 'actor_id', 'object_id')),
+                         [(self.other.id, self.master.id, cooperation_id) for cooperation_id in cooperation_ids])
+
+    def test_requesting_is_current_user(self):
+        stranger = create_user('stranger@test.ru', role='master')
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/cooperation/', {'requesting': stranger.id, 'responsible': self.other.id,
+                                                              'positive_response': True, 'responded': True})
+        self.assertEqual(response.status_code, 201)
+        cooperation = RequestForCooperation.objects.get(id=response.data['id'])
+        self.assertEqual((cooperation.requesting_id, cooperation.positive_response, cooperation.responded),
+                         (self.master.id, False, False))
+        activity = Activity.objects.get(verb='cooperation_request', object_id=cooperation.id)
+        self.assertEqual(activity.actor_id, self.master.id)
+
+
+class ActivityFeedTest(APITestCase):
+    def setUp(self):
+        self.user = create_user('feed@test.ru')
+        self.ids = [Activity.objects.create(user=self.user, verb='grade', object_id=i).id for i in range(7)]
+        self.client.force_authenticate(self.user)
+
+    def get_ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_before_pages_newest_first(self):
+        response = self.client.get('/api/activity/', {'limit': 3})
+        self.assertEqual(self.get_ids(response), self.ids[:-4:-1])
+        self.assertEqual((response.data['before'], response.data['after'], response.data['has_more']),
+                         (self.ids[4], self.ids[6], True))
+        response = self.client.get('/api/activity/', {'limit': 3, 'before': self.ids[1]})
+        self.assertEqual(self.get_ids(response), [self.ids[0]])
+        self.assertEqual((response.data['before'], response.data['has_more']), (None, False))
+
+    def test_after_catches_up_oldest_first(self):
+        # пропущено больше limit событий: догрузка идет от самых старых и без разрывов
+        response = self.client.get('/api/activity/', {'limit': 3, 'after': self.ids[0]})
+        self.assertEqual(self.get_ids(response), self.ids[1:4])
+        self.assertEqual((response.data['after'], response.data['has_more']), (self.ids[3], True))
+        response = self.client.get('/api/activity/', {'limit': 3, 'after': response.data['after']})
+        self.assertEqual(self.get_ids(response), self.ids[4:7])
+        self.assertEqual((response.data['after'], response.data['has_more']), (self.ids[6], False))
+        response = self.client.get('/api/activity/', {'limit': 3, 'after': response.data['after']})
+        self.assertEqual((self.get_ids(response), response.data['after']), ([], self.ids[6]))
+
+class VersionedCacheTest(APITestCase):
+    url = '/api/car_brands/'
+
+    def get(self, **headers):
+        # локальный кэш ответов пуст - как у другого процесса; общие у процессов только версии моделей
+        caches['default'].clear()
+        return self.client.get(self.url, **headers)
+
+    def test_versions_are_shared_between_processes(self):
+        self.client.force_authenticate(create_user('driver@test.ru'))
+        CarBrand.objects.create(name='Лада', img='brands/lada.png')
+        etag = self.get()['ETag']
+        self.assertEqual(self.get()['ETag'], etag)
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            CarBrand.objects.create(name='Москвич', img='brands/moskvich.png')
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+
+
+    def test_versions_checked_by_interval(self):
+        self.client.force_authenticate(create_user('driver@test.ru'))
+        CarBrand.objects.create(name='Лада', img='brands/lada.png')
+        etag = self.client.get(self.url)['ETag']
+        with self.assertNumQueries(0):
+            # ответ и версии в памяти процесса: ни базы, ни общего кэша
+            self.assertEqual(self.client.get(self.url)['ETag'], etag)
+
+        # другой процесс поменял версию: она видна после интервала сверки
+        caches['shared'].set(get_version_key(CarBrand), time.time_ns(), timeout=None)
+        self.assertEqual(self.client.get(self.url)['ETag'], etag)
+        with override_settings(RESPONSE_CACHE_VERSION_CHECK_INTERVAL=0):
+            self.assertNotEqual(self.client.get(self.url)['ETag'], etag)
+
+    def test_concurrent_bumps_change_version(self):
+        before = get_model_versions([CarBrand])
+        bump_model_version(CarBrand)
+        bump_model_version(CarBrand)
+        after = get_model_versions([CarBrand])
+        self.assertNotEqual(after, before)
+        self.assertEqual(caches['shared'].get(get_version_key(CarBrand)), after[0])
+
+class ConditionalOfferTest(APITestCase):
+    def setUp(self):
+        self.owner, self.master = create_user('owner@test.ru'), create_user('master@test.ru', role='master')
+        self.offers = [RepairOffer.objects.create(owner=self.owner, master=self.master, title=f'Оффер {i}',
+                                                  description='Описание') for i in range(2)]
+        # изменения минутной давности: секунда последнего изменения уже прошла, Last-Modified отдается
+        for minutes, offer in enumerate(self.offers):
+            updated = timezone.now() - datetime.timedelta(minutes=2 - minutes)
+            RepairOffer.objects.filter(pk=offer.pk).update(updated=updated)
+        self.client.force_authenticate(self.owner)
+
+    def validators(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return {'HTTP_IF_NONE_MATCH': response['ETag']}, {'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}
+
+    def assertStatuses(self, url, validators, status):
+        for headers in validators:
+            self.assertEqual(self.client.get(url, **headers).status_code, status, headers)
+
+    def test_list_not_modified_until_update(self):
+        url = '/api/offers/'
+        validators = self.validators(url)
+        self.assertStatuses(url, validators, 304)
+        # If-Modified-Since не проверяется, если есть If-None-Match
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH='"other"', **validators[1]).status_code, 200)
+
+        self.offers[0].title = 'Изменен'
+        self.offers[0].save()
+        self.assertStatuses(url, validators, 200)
+
+    def test_list_modified_after_delete(self):
+        url = '/api/offers/'
+        validators = self.validators(url)
+        # удаляется не последний измененный оффер: max(updated) оставшихся не меняется
+        with self.captureOnCommitCallbacks(execute=True):
+            self.offers[0].delete()
+        self.assertStatuses(url, validators, 200)
+
+    def test_filtered_list_modified_when_row_leaves_filter(self):
+        url = f'/api/public_offers/?master={self.master.id}'
+        validators = self.validators(url)
+        self.offers[0].private = True
+        self.offers[0].save()
+        self.assertStatuses(url, validators, 200)
+
+    def test_same_second_change_has_no_last_modified(self):
+        self.offers[1].save()
+        response = self.client.get('/api/offers/')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Last-Modified', response)
+        self.assertEqual(self.client.get('/api/offers/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+    def test_object_update_and_delete(self):
+        url = f'/api/offers/{self.offers[0].id}/'
+        validators = self.validators(url)
+        self.assertStatuses(url, validators, 304)
+        self.offers[0].description = 'Изменено'
+        self.offers[0].save()
+        self.assertStatuses(url, validators, 200)
+
+        etag = self.client.get(url)['ETag']
+        self.offers[0].delete()
+        self.assertStatuses(url, [{'HTTP_IF_NONE_MATCH': etag}, validators[1]], 404)
+
+
+class ChatMembershipTest(APITestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.user = create_user('member@example.com')
+        self.other = create_user('other@example.com')
+        self.chat = Chat.objects.create(object_id='1', object_type='offer')
+        self.chat.participants.add(self.user, self.other)
+        self.message = Message.objects.create(chat=self.chat, user=self.other, text='Привет')
+        self.client.force_authenticate(self.user)
+
+    def test_reconnects_skip_db(self):
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        with self.assertNumQueries(0):
+            # состав и версия в памяти процесса: ни participants, ни таблицы общего кэша
+            for _ in range(50):
+                self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+
+    def test_removed_user_loses_access(self):
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        self.assertEqual(chat_membership.get_participants(self.chat.id), {self.user.id, self.other.id})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.participants.remove(self.user)
+        self.assertFalse(chat_membership.is_participant(self.user.id, self.chat.id))
+        self.assertEqual(chat_membership.get_participants(self.chat.id), {self.other.id})
+
+        response = self.client.get('/api/messages/')
+        self.assertNotIn(self.message.id, [item['id'] for item in response.data['results']])
+        response = self.client.post('/api/messages/', {'chat': self.chat.id, 'text': 'Еще здесь?'})
+        self.assertEqual(response.status_code, 403)
+
+    def test_change_in_other_process(self):
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        # другой процесс удалил участника и сменил общую версию
+        Chat.participants.through.objects.filter(chat=self.chat, user=self.user).delete()
+        caches['shared'].set(ChatMembership.version_key, time.time_ns(), timeout=None)
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        with override_settings(CHAT_MEMBERSHIP_CHECK_INTERVAL=0):
+            self.assertFalse(chat_membership.is_participant(self.user.id, self.chat.id))
+
+    def test_reverse_remove_and_add(self):
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.chats.remove(self.chat)
+        self.assertFalse(chat_membership.is_participant(self.user.id, self.chat.id))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.participants.add(self.user)
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+
+    def test_chat_delete(self):
+        self.assertTrue(chat_membership.is_participant(self.user.id, self.chat.id))
+        chat_id = self.chat.id
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat.delete()
+        self.assertFalse(chat_membership.is_participant(self.user.id, chat_id))
+
+
+class OfferFeedTest(TestCase):
+    def setUp(self):
+        self.owner, self.master = create_user('owner@test.ru'), create_user('master@test.ru', role='master')
+        self.categories = [RepairCategory.objects.create(name=f'Категория {i}', color='#000000') for i in range(2)]
+        self.master.repair_categories.set(self.categories)
+        self.offer = RepairOffer.objects.create(owner=self.owner, title='Стук', description='Стучит двигатель')
+        self.offer.categories.set(self.categories)
+        self.layer = get_channel_layer()
+        patcher = mock.patch('api.consumers.Subscription.check_action', return_value=True)
+        self.check_action = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self, user):
+        consumer = OfferFeedConsumer()
+        consumer.scope = {'user': user}
+        consumer.channel_layer = self.layer
+        consumer.channel_name = async_to_sync(self.layer.new_channel)()
+        consumer.accept, consumer.close, consumer.send = mock.Mock(), mock.Mock(), mock.Mock()
+        consumer.connect()
+        self.addCleanup(consumer.disconnect, 1000)
+        return consumer
+
+    def deliver(self, consumer):
+        # события из слоя каналов в обработчик, как это делает диспетчер channels
+        async def receive_all():
+            events = []
+            while True:
+                try:
+                    events.append(await asyncio.wait_for(self.layer.receive(consumer.channel_name), 0.05))
+                except asyncio.TimeoutError:
+                    return events
+
+        events = async_to_sync(receive_all)()
+        for event in events:
+            consumer.new_offer(event)
+        return len(events)
+
+    def test_offer_from_several_categories_is_sent_once(self):
+        consumer = self.connect(self.master)
+        consumer.accept.assert_called_once()
+        broadcast_offer(self.offer, {'id': self.offer.id})
+        self.assertEqual(self.deliver(consumer), 2)
+        consumer.send.assert_called_once()
+        self.assertEqual(orjson.loads(consumer.send.call_args.kwargs['text_data']), {'id': self.offer.id})
+
+        self.offer.private = True
+        broadcast_offer(self.offer, {'id': self.offer.id})
+        self.assertEqual(self.deliver(consumer), 0)
+
+    def test_own_offer_is_skipped(self):
+        self.owner.role = 'master'
+        self.owner.save()
+        self.owner.repair_categories.set(self.categories)
+        consumer = self.connect(self.owner)
+        broadcast_offer(self.offer, {'id': self.offer.id})
+        self.assertEqual(self.deliver(consumer), 2)
+        consumer.send.assert_not_called()
+
+    @override_settings(OFFER_FEED_PERMISSION_TTL=60)
+    def test_permission_is_rechecked_after_ttl(self):
+        consumer = self.connect(self.master)
+        self.check_action.reset_mock()
+        broadcast_offer(self.offer, {'id': self.offer.id})
+        self.deliver(consumer)
+        self.check_action.assert_not_called()
+
+        consumer.permission_checked_at -= 61
+        self.check_action.return_value = False
+        other = RepairOffer.objects.create(owner=self.owner, title='Скрип', description='Скрипят тормоза')
+        other.categories.set(self.categories[:1])
+        broadcast_offer(other, {'id': other.id})
+        self.deliver(consumer)
+        self.check_action.assert_called_once()
+        consumer.close.assert_called_once()
+        self.assertEqual(consumer.send.call_count, 1)
+
+    def test_connect_requires_master_with_permission(self):
+        consumer = self.connect(self.owner)
+        consumer.close.assert_called_once()
+        consumer.accept.assert_not_called()
+
+        self.check_action.return_value = False
+        consumer = self.connect(self.master)
+        consumer.close.assert_called_once()
+        consumer.accept.assert_not_called()
+
+
+class MessageHistoryTest(APITestCase):
+    def setUp(self):
+        self.user = create_user('history@example.com')
+        self.chat = Chat.objects.create(object_id='1', object_type='offer')
+        self.chat.participants.add(self.user)
+        now = timezone.now()
+        self.messages = []
+        for months in (36, 12, 1, 0):
+            message = Message.objects.create(chat=self.chat, user=self.user, text=f'{months} мес. назад')
+            Message.objects.filter(id=message.id).update(created=now - datetime.timedelta(days=30 * months))
+            self.messages.append(message.id)
+        self.client.force_authenticate(self.user)
+
+    def get_ids(self, response):
+        return [item['id'] for item in response.data['results']]
+
+    def test_old_history_reachable_by_cursor(self):
+        response = self.client.get('/api/messages/', {'chat': self.chat.id, 'page_size': 3})
+        self.assertEqual(self.get_ids(response), self.messages[:0:-1])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(self.get_ids(response), [self.messages[0]])
+        self.assertIsNone(response.data['next'])
+
+    def test_since(self):
+        since = (timezone.now() - datetime.timedelta(days=60)).isoformat()
+        response = self.client.get('/api/messages/', {'chat': self.chat.id, 'since': since})
+        self.assertEqual(self.get_ids(response), self.messages[:1:-1])
+        response = self.client.get('/api/messages/', {'since': 'вчера'})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('since', response.data['detail'])
+
+
+class MessageSearchTest(APITestCase):
+    def setUp(self):
+        self.user, self.other = create_user('search@test.ru'), create_user('other@test.ru')
+        self.chats = [Chat.objects.create(object_id=str(i), object_type='offer') for i in range(3)]
+        for chat in self.chats[:2]:
+            chat.participants.add(self.user)
+        self.chats[2].participants.add(self.other)
+        self.first = [self.message(self.chats[0], text) for text in ('Скрипят тормоза', 'тормоза заменили')]
+        self.second = self.message(self.chats[1], 'Тормозные колодки')
+        self.message(self.chats[1], 'тормоза удалены', deleted=True)
+        self.message(self.chats[2], 'Чужие тормоза')
+        self.client.force_authenticate(self.user)
+
+    def message(self, chat, text, **fields):
+        return Message.objects.create(chat=chat, user=self.user, text=text, **fields).id
+
+    def search(self, **params):
+        return self.client.get('/api/messages/search/', params)
+
+    def test_results_grouped_by_member_chats(self):
+        response = self.search(q='тормоз')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 3)
+        groups = {group['chat']: group for group in response.data['chats']}
+        self.assertEqual(set(groups), {self.chats[0].id, self.chats[1].id})
+        self.assertEqual(groups[self.chats[0].id]['count'], 2)
+        self.assertEqual({hit['id'] for hit in groups[self.chats[0].id]['results']}, set(self.first))
+        self.assertEqual([hit['id'] for hit in groups[self.chats[1].id]['results']], [self.second])
+        self.assertEqual(groups[self.chats[1].id]['results'][0]['snippet'], '<mark>Тормоз</mark>ные колодки')
+
+        response = self.search(q='тормоз', chat=self.chats[0].id, limit=1)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([len(group['results']) for group in response.data['chats']], [1])
+        self.assertEqual(self.search(q='тормоз', chat=self.chats[2].id).data, {'count': 0, 'chats': []})
+
+    def test_bad_params(self):
+        for params in ({'q': 'то'}, {'q': 'тормоз', 'chat': 'x'}, {'q': 'тормоз', 'limit': 0}):
+            self.assertEqual(self.search(**params).status_code, 400, params)
+
+    def test_snippet_escapes_text_and_marks_match(self):
+        self.assertEqual(make_snippet('Итог: <b>ЗАМЕНА</b> масла & фильтра', 'замена', 3),
+                         '…&lt;b&gt;<mark>ЗАМЕНА</mark>&lt;/b…')
+        self.assertEqual(make_snippet('замена масла & фильтра', 'масла', 60),
+                         'замена <mark>масла</mark> &amp; фильтра')
+        self.assertEqual(make_snippet('цена 100$ (без скидки)', '(без', 60), 'цена 100$ <mark>(без</mark> скидки)')
+        # без совпадения - начало текста
+        self.assertEqual(make_snippet('a < b', 'xyz', 2), 'a &lt; …')
+
+
+class MessageArchiveTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.user = create_user('archive@example.com')
+        self.chat = Chat.objects.create(object_id='1', object_type='offer')
+        self.month = add_months(month_start(timezone.now()), -30)
+        self.old = Message.objects.create(chat=self.chat, user=self.user, text='Старое <b>')
+        Message.objects.filter(id=self.old.id).update(created=self.month + datetime.timedelta(days=3))
+        self.old.have_read.add(self.user)
+        self.reply = Message.objects.create(chat=self.chat, user=self.user, text='Ответ', reply_id=self.old.id)
+
+    def test_archive_and_restore_keep_replies(self):
+        with connection.cursor() as cursor:
+            # строки созданы в транзакции теста: отложенные проверки ключей мешают пересоздать таблицу
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        with override_settings(MESSAGE_ARCHIVE_DIR=self.directory):
+            partition_table(1)
+            counts = archive_partition(self.month)
+            self.assertEqual(counts, {'messages': 1, 'media': 0, 'have_read': 1, 'replies': 1})
+            self.assertFalse(Message.objects.filter(id=self.old.id).exists())
+            # ссылка на сообщение из архива не висит: reply обнулен, как при SET_NULL
+            self.assertIsNone(Message.objects.get(id=self.reply.id).reply_id)
+            self.assertEqual(archived_months(), [self.month])
+
+            archived = iter_archived_messages(self.month, self.chat.id)
+            self.assertEqual([(message['id'], message['text'], message['have_read']) for message in archived],
+                             [(self.old.id, 'Старое <b>', [self.user.id])])
+            self.assertEqual(iter_archived_messages(self.month, self.chat.id + 1), [])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                restore_partition(self.month)
+            self.assertEqual(Message.objects.get(id=self.reply.id).reply_id, self.old.id)
+            self.assertEqual(list(Message.objects.get(id=self.old.id).have_read.all()), [self.user])
+
+
+class MonthParsingTest(unittest.TestCase):
+    def test_parse_month(self):
+        self.assertEqual(parse_month('2024-02'), datetime.datetime(2024, 2, 1, tzinfo=datetime.timezone.utc))
+        for value in ('2024-13', '2024', 'февраль', None):
+            self.assertIsNone(parse_month(value))
+
+    def test_month_start_in_utc(self):
+        moscow = datetime.timezone(datetime.timedelta(hours=3))
+        # 1 марта 01:00 по Москве - еще февраль по UTC
+        value = datetime.datetime(2024, 3, 1, 1, 0, tzinfo=moscow)
+        utc = datetime.timezone.utc
+        self.assertEqual(month_start(value), datetime.datetime(2024, 2, 1, tzinfo=utc))
+        self.assertEqual(add_months(month_start(value), 11), datetime.datetime(2025, 1, 1, tzinfo=utc))
+
+
+@override_settings(PRESENCE_TTL=60, PRESENCE_TYPING_RATE=2, PRESENCE_TYPING_TTL=5)
+class PresenceRegistryTest(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('api.presence.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.registry = PresenceRegistry()
+
+    def test_join_and_leave(self):
+        self.assertTrue(self.registry.join('a1', 1, chat_id=10))
+        # второе соединение того же пользователя - не новый участник
+        self.assertFalse(self.registry.join('a2', 1, chat_id=10))
+        self.assertFalse(self.registry.join('inbox', 2))
+        self.assertEqual(self.registry.chat_online(10), [1])
+        self.assertEqual(self.registry.online({1, 2, 3}), {1, 2})
+        self.assertFalse(self.registry.leave('a1'))
+        self.assertTrue(self.registry.leave('a2'))
+        self.assertEqual(self.registry.chat_online(10), [])
+        self.assertFalse(self.registry.leave('a2'))
+
+    def test_heartbeat_expiry(self):
+        self.registry.join('a', 1, chat_id=10)
+        self.registry.join('b', 2, chat_id=10)
+        self.now += 50
+        self.assertTrue(self.registry.heartbeat('a'))
+        self.now += 20
+        # b молчит 70 секунд: выбывает, и чат попадает в рассылку
+        self.assertEqual(self.registry.sweep(), {10: [1]})
+        self.assertEqual(self.registry.sweep(), {})
+        self.assertFalse(self.registry.heartbeat('b'))
+        self.assertEqual(self.registry.online({1, 2}), {1})
+
+    def test_expiry_found_by_lazy_sweep_is_reported(self):
+        self.registry.join('a', 1, chat_id=10)
+        self.now += 61
+        self.assertEqual(self.registry.chat_online(10), [])
+        self.assertEqual(self.registry.sweep(), {10: []})
+
+    def test_typing_coalescing_and_flush(self):
+        self.registry.join('a', 1, chat_id=10)
+        self.registry.join('b', 2, chat_id=10)
+        self.assertEqual(self.registry.typing(10, 1), ([1], None))
+        self.now += 0.1
+        # внутри окна 0.5 с: первое событие получает время отложенной рассылки, следующие - ничего
+        users, flush_in = self.registry.typing(10, 2)
+        self.assertIsNone(users)
+        self.assertAlmostEqual(flush_in, 0.4)
+        self.assertEqual(self.registry.typing(10, 2), (None, None))
+        self.now += 0.4
+        self.assertEqual(self.registry.flush_typing(10), [1, 2])
+        self.assertIsNone(self.registry.flush_typing(10))
+
+        self.now += 6
+        # окно прошло: рассылка сразу, истекшие по PRESENCE_TYPING_TTL выбывают
+        self.assertEqual(self.registry.typing(10, 2), ([2], None))
+
+    def test_flush_after_leading_send_is_skipped(self):
+        self.registry.join('a', 1, chat_id=10)
+        self.registry.typing(10, 1)
+        self.now += 0.1
+        self.assertIsNotNone(self.registry.typing(10, 1)[1])
+        self.now += 1
+        self.assertEqual(self.registry.typing(10, 1), ([1], None))
+        self.assertIsNone(self.registry.flush_typing(10))
+
+    def test_flush_typing_later_broadcasts(self):
+        self.registry.join('a', 1, chat_id=10)
+        self.registry.typing(10, 1)
+        self.registry.typing(10, 1)
+
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(chat_group(10), channel)
+            with mock.patch('api.consumers.presence', self.registry):
+                await flush_typing_later(10, 0)
+            return await layer.receive(channel)
 
-# Create your tests here.
+        event = async_to_sync(run)()
+        self.assertEqual(event['type'], 'chat_typing')
+        self.assertEqual(orjson.loads(event['message']), {'type': 'typing', 'chat': 10, 'users': [1]})
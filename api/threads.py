@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+
+from .exceptions import BadRequest
+from .models import Comment
+
+# ветка целиком одним запросом: первый уровень - страница ответов корню (или корневых комментариев оффера),
+# каждый следующий - не больше limit первых ответов на каждый комментарий предыдущего уровня
+THREAD_SQL = '''
+    WITH RECURSIVE thread AS (
+        SELECT top.id, 1 AS depth FROM (
+            SELECT id FROM {table} WHERE {condition} ORDER BY created, id LIMIT %s OFFSET %s
+        ) top
+        UNION ALL
+        SELECT child.id, thread.depth + 1 FROM thread
+        CROSS JOIN LATERAL (
+            SELECT id FROM {table} WHERE reply_id = thread.id ORDER BY created, id LIMIT %s
+        ) child
+        WHERE thread.depth < %s
+    )
+    SELECT id FROM thread
+'''
+
+
+def get_int_param(request, name, default, maximum, minimum=0):
+    value = request.query_params.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        raise BadRequest(f'Параметр {name} должен быть целым числом')
+    if value < minimum:
+        raise BadRequest(f'Параметр {name} не может быть меньше {minimum}')
+    return min(value, maximum)
+
+
+def thread_ids_sql(offer_id=None, root_id=None, depth=1, limit=10, offset=0):
+    table = connection.ops.quote_name(Comment._meta.db_table)
+    if root_id is not None:
+        condition, params = 'reply_id = %s', [root_id]
+    else:
+        condition, params = 'offer_id = %s AND reply_id IS NULL', [offer_id]
+    sql = THREAD_SQL.format(table=table, condition=condition)
+    return RawSQL(sql, params + [limit, offset, limit, depth])
+
+
+def get_thread_params(request):
+    return {
+        'depth': get_int_param(request, 'depth', settings.COMMENT_THREAD_DEFAULT_DEPTH,
+                               settings.COMMENT_THREAD_MAX_DEPTH, minimum=1),
+        'limit': get_int_param(request, 'limit', settings.COMMENT_THREAD_DEFAULT_SIBLINGS,
+                               settings.COMMENT_THREAD_MAX_SIBLINGS, minimum=1),
+        'offset': get_int_param(request, 'offset', 0, float('inf')),
+    }
+
+
+def build_tree(items, parent_id):
+    # items - сериализованные комментарии ветки в порядке created, id
+    children = {}
+    for item in items:
+        item['replies'] = []
+        children.setdefault(item['reply'], []).append(item)
+
+    def attach(nodes, depth):
+        for node in nodes:
+            node['depth'] = depth
+            node['replies'] = children.get(node['id'], [])
+            attach(node['replies'], depth + 1)
+        return nodes
+
+    return attach(children.get(parent_id, []), 1)
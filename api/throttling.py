@@ -0,0 +1,131 @@
+import datetime
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connection
+from django.utils import timezone
+from rest_framework.throttling import BaseThrottle
+
+from fixithere import metrics
+
+from .models import ThrottleBucket
+
+logger = logging.getLogger(__name__)
+
+DURATIONS = {'s': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600, 'd': 86400, 'day': 86400}
+
+
+def parse_rate(rate):
+    # '10/min' -> токенов в секунду
+    count, period = rate.split('/')
+    return int(count) / DURATIONS[period]
+
+
+class MemoryBuckets:
+    # корзины токенов в памяти процесса, полные корзины периодически выбрасываются
+    max_buckets = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, rate):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated, _, _ = self._buckets.get(key, (capacity, now, capacity, rate))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now, capacity, rate)
+            if len(self._buckets) > self.max_buckets:
+                self.purge(now)
+        return allowed, tokens
+
+    def purge(self, now):
+        self._buckets = {
+            key: bucket for key, bucket in self._buckets.items()
+            if bucket[0] + (now - bucket[1]) * bucket[3] < bucket[2]
+        }
+
+
+memory_buckets = MemoryBuckets()
+
+# одно выражение на пополнение и списание токена, без отдельного SELECT и гонок между воркерами
+CONSUME_SQL = '''
+    INSERT INTO {table} (key, tokens, allowed, updated) VALUES (%(key)s, %(capacity)s - 1, TRUE, now())
+    ON CONFLICT (key) DO UPDATE SET
+        allowed = {refill} >= 1,
+        tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END,
+        updated = now()
+    RETURNING allowed, tokens
+'''
+REFILL_SQL = 'LEAST(%(capacity)s, {table}.tokens + EXTRACT(EPOCH FROM now() - {table}.updated) * %(rate)s)'
+
+
+def consume_shared(key, capacity, rate):
+    table = connection.ops.quote_name(ThrottleBucket._meta.db_table)
+    sql = CONSUME_SQL.format(table=table, refill=REFILL_SQL.format(table=table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, {'key': key, 'capacity': capacity, 'rate': rate})
+        return cursor.fetchone()
+
+
+def prune_shared_buckets():
+    # корзина, не тронутая дольше самого долгого пополнения из WRITE_THROTTLE_RATES, уже полная -
+    # такая строка ничем не отличается от отсутствующей и удаляется
+    refill = max((config['burst'] / parse_rate(config['rate']) for config in settings.WRITE_THROTTLE_RATES.values()),
+                 default=0)
+    border = timezone.now() - datetime.timedelta(seconds=refill)
+    return ThrottleBucket.objects.filter(updated__lt=border).delete()[0]
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Ограничение частоты записи по корзине токенов. Лимиты задаются в WRITE_THROTTLE_RATES
+    по ключу "<throttle_scope>.<action>", действия без лимита не ограничиваются.
+    Сначала проверяется корзина в памяти процесса: отказ по ней не обращается к базе.
+    Затем, если включен WRITE_THROTTLE_SHARED, общая корзина в базе - одна на все воркеры.
+    throttle_actions представления сводит несколько действий к одному ключу лимита.
+    """
+
+    def __init__(self):
+        self.tokens = None
+        self.rate = None
+
+    @staticmethod
+    def get_scope(view):
+        action = getattr(view, 'action', None)
+        action = getattr(view, 'throttle_actions', {}).get(action, action)
+        return f'{getattr(view, "throttle_scope", None)}.{action}'
+
+    def get_rate(self, view):
+        return settings.WRITE_THROTTLE_RATES.get(self.get_scope(view))
+
+    def get_key(self, request, view):
+        ident = request.user.pk if request.user and request.user.is_authenticated else self.get_ident(request)
+        return f'{self.get_scope(view)}:{ident}'
+
+    def allow_request(self, request, view):
+        config = self.get_rate(view)
+        if config is None:
+            return True
+        key = self.get_key(request, view)
+        capacity, self.rate = config['burst'], parse_rate(config['rate'])
+
+        allowed, self.tokens = memory_buckets.consume(key, capacity, self.rate)
+        if allowed and settings.WRITE_THROTTLE_SHARED:
+            try:
+                allowed, self.tokens = consume_shared(key, capacity, self.rate)
+            except DatabaseError:
+                # общая корзина недоступна - решаем по корзине процесса
+                logger.warning('Не удалось проверить общий лимит %s', key, exc_info=True)
+        if not allowed:
+            metrics.throttled_requests.inc(scope=view.throttle_scope)
+        return allowed
+
+    def wait(self):
+        if self.rate is None or self.tokens is None:
+            return None
+        return max(0.0, (1 - self.tokens) / self.rate)
@@ -0,0 +1,110 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import models
+from django.db import transaction
+
+from .exceptions import BadRequest
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ['png', 'jpg', 'jpeg']
+# первые байты файла для проверки содержимого по расширению
+SIGNATURES = {
+    'png': (b'\x89PNG\r\n\x1a\n',),
+    'jpg': (b'\xff\xd8\xff',),
+    'jpeg': (b'\xff\xd8\xff',),
+}
+
+# общий пул на процесс: запись файлов одного запроса идет параллельно, но не больше UPLOAD_WORKERS потоков
+executor = ThreadPoolExecutor(max_workers=settings.UPLOAD_WORKERS, thread_name_prefix='uploads')
+
+
+def get_extension(upload):
+    return upload.name.split('.')[-1].lower() if '.' in upload.name else ''
+
+
+def sniff(upload, extension):
+    signatures = SIGNATURES.get(extension)
+    if not signatures:
+        return True
+    head = upload.read(16)
+    upload.seek(0)
+    return head.startswith(signatures)
+
+
+def validate_uploads(files, max_size_mb, extensions=None, max_count=None):
+    # все проверки до записи в базу и хранилище: ошибка не оставляет ни строк, ни файлов
+    if max_count is not None and len(files) > max_count:
+        raise BadRequest(f'Нельзя прикрепить более {max_count} файлов')
+    for upload in files:
+        if upload.size / 1024 / 1024 > max_size_mb:
+            raise BadRequest(f'Размер загружаемых файлов не должен превышать {max_size_mb} Мб')
+        extension = get_extension(upload)
+        if extensions is not None and extension not in extensions:
+            raise BadRequest(f'Загружаемые файлы должны иметь один из перечисленных форматов: '
+                             f'{", ".join("." + e for e in extensions)}')
+        if not sniff(upload, extension):
+            raise BadRequest(f'Содержимое файла {upload.name} не соответствует формату .{extension}')
+    return files
+
+
+def get_file_field(model):
+    return next(f for f in model._meta.concrete_fields if isinstance(f, models.FileField))
+
+
+def write_file(field, instance, upload):
+    name = field.generate_filename(instance, upload.name)
+    return field.storage.save(name, upload, max_length=field.max_length)
+
+
+def save_uploads(parent, related_name, files):
+    """
+    Записывает файлы в хранилище параллельно и создает строки одним bulk_create.
+    Вызывается после коммита родителя, транзакция - только на вставку строк.
+    Родитель создан в этом же запросе: если файл или строку сохранить не удалось,
+    уже записанные файлы и сам родитель удаляются, исключение пробрасывается дальше.
+    """
+    try:
+        return write_uploads(parent, related_name, files)
+    except Exception:
+        parent.delete()
+        raise
+
+
+def write_uploads(parent, related_name, files):
+    if not files:
+        return []
+    manager = getattr(parent, related_name)
+    model, field = manager.model, get_file_field(manager.model)
+    # родитель подставлен объектом: upload_to не догружает его из базы на каждый файл
+    instances = [model(**{manager.field.name: parent}) for _ in files]
+    futures = [executor.submit(write_file, field, instance, upload) for instance, upload in zip(instances, files)]
+
+    names, error = [], None
+    for future in futures:
+        try:
+            names.append(future.result())
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        delete_files(field.storage, names)
+        raise error
+
+    for instance, name in zip(instances, names):
+        setattr(instance, field.attname, name)
+    try:
+        with transaction.atomic():
+            return model.objects.bulk_create(instances)
+    except Exception:
+        delete_files(field.storage, names)
+        raise
+
+
+def delete_files(storage, names):
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.warning('Не удалось удалить файл %s', name, exc_info=True)
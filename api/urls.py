@@ -30,6 +30,7 @@ from .views import MessageViewSet
 from .views import FAQReadOnlyViewSet
 from .views import FAQTopicReadOnlyViewSet
 from .views import FAQContentReadOnlyViewSet
+from .views import ActivityViewSet
 
 router = DefaultRouter()
 
@@ -52,6 +53,7 @@ router.register('messages', MessageViewSet)
 router.register('faq', FAQReadOnlyViewSet)
 router.register('faq_topics', FAQTopicReadOnlyViewSet)
 router.register('faq_content', FAQContentReadOnlyViewSet)
+router.register('activity', ActivityViewSet)
 
 urlpatterns = [
     path('registration/', EmailRegistration.as_view()),
@@ -3,6 +3,7 @@ import typing
 
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet, GenericViewSet
 from rest_framework.mixins import CreateModelMixin
+from rest_framework.mixins import ListModelMixin
 from rest_framework.decorators import action
 from rest_framework.generics import GenericAPIView
 from rest_framework.response import Response
@@ -14,6 +15,7 @@ from django.contrib.auth import authenticate
 from django.conf import settings
 from django.db import transaction
 from django.db.models import Q
+from django.db.models import Prefetch
 from django.utils import timezone
 
 from dateutil.relativedelta import relativedelta
@@ -21,16 +23,18 @@ from dateutil.relativedelta import relativedelta
 from asgiref.sync import async_to_sync
 
 from .aggregations import annotate_comments_likes_count
+from .aggregations import annotate_comments_replies_count
 from .aggregations import annotate_repair_offers_views_count
 from .aggregations import annotate_repair_offers_my_my_accept_free
 from .aggregations import annotate_repair_offers_completed
 from .aggregations import annotate_masters_statistic
 from .aggregations import annotate_masters_is_trusted
-from .aggregations import annotate_comment_is_liked
 from .aggregations import annotate_user_subscription_action_permitted
 
 from channels.layers import get_channel_layer
 
+from fixithere.metrics import instrument_serializer
+
 from .models import User
 from .models import UserReport
 from .models import RequestForCooperation
@@ -40,12 +44,15 @@ from .models import RepairCategory
 from .models import OfferImage
 from .models import Grade
 from .models import GradePhoto
+from .models import ReviewSummary
+from .models import Activity
 from .models import Comment
 from .models import CommentMedia
 from .models import RepairOffer
 from .models import Chat
 from .models import Message
 from .models import SubscriptionPlan
+from .models import SubscriptionAction
 from .models import Subscription
 from .models import FAQ
 from .models import FAQTopic
@@ -54,14 +61,18 @@ from .models import FAQContent
 from .serializers import CarBrandSerializer
 from .serializers import CarSerializer
 from .serializers import UserProfileSerializer
+from .serializers import MatchedMasterSerializer
 from .serializers import UserReportSerializer
 from .serializers import RequestForCooperationSerializer
 from .serializers import RepairCategorySerializer
 from .serializers import OfferImageSerializer
 from .serializers import GradeSerializer
 from .serializers import SendGradeSerializer
+from .serializers import ReviewSummarySerializer
+from .serializers import ActivitySerializer
 from .serializers import GradePhotoSerializer
 from .serializers import CommentSerializer
+from .serializers import CommentThreadSerializer
 from .serializers import CommentMediaSerializer
 from .serializers import RepairOfferSerializer
 from .serializers import SubscriptionPlanSerializer
@@ -70,6 +81,8 @@ from .serializers import MessageSerializer
 from .serializers import FAQSerializer
 from .serializers import FAQContentSerializer
 from .serializers import FAQTopicSerializer
+from .serializers import FAQDocumentSerializer
+from .serializers import FAQTopicDocumentSerializer
 
 from .services import validate_registration_data
 from .services import register_user
@@ -82,11 +95,16 @@ from .services import recovery_password
 from .services import query_params_filter
 from .services import exclude_words
 from .services import set_master
+from .services import request_cooperation
 from .services import offers_base_filter
 from .services import subscription_plans_base_filter
 from .services import has_offer_chat
+from .services import get_liked_comment_ids
 from .services import create_helpdesk_chat_for_user
-# from .services import get_user_subscription_plan
+from .services import get_user_subscription_plan
+
+from .catalog import subscription_catalog
+from .matching import MasterMatcher
 
 from .exceptions import AuthenticationFailed
 from .exceptions import Forbidden
@@ -94,6 +112,32 @@ from .exceptions import MasterRoleRequired
 from .exceptions import BadRequest
 
 from .paginations import StandardPagination
+from .paginations import KeysetPagination
+from .paginations import MessagePagination
+
+from .caching import VersionedCacheMixin
+from .caching import ChangeTrackingMixin
+from .caching import get_datetime_param
+from .fast_serializers import FastListMixin
+from .exports import ExportMixin
+from .throttling import TokenBucketThrottle
+from .uploads import IMAGE_EXTENSIONS
+from .uploads import validate_uploads
+from .uploads import save_uploads
+from .activity import publish
+from .offer_feed import broadcast_offer
+from .threads import thread_ids_sql
+from .threads import get_thread_params
+from .threads import build_tree
+from .threads import get_int_param
+from .message_search import search_messages
+from .membership import chat_membership
+from .partitions import parse_month
+from .partitions import archived_months
+from .partitions import iter_archived_messages
+from .exports import OFFER_EXPORT_FIELDS
+from .exports import GRADE_EXPORT_FIELDS
+from .exports import MESSAGE_EXPORT_FIELDS
 
 from yookassa import Configuration, Payment
 
@@ -103,7 +147,9 @@ Configuration.secret_key = settings.YOOKASSA["secret_key"]
 
 # custom views
 class CustomApiView(GenericAPIView):
-    pass
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(CustomApiView, self).get_serializer(*args, **kwargs)
+        return instrument_serializer(serializer)
 
 
 class CustomReadOnlyModelViewSet(ReadOnlyModelViewSet):
@@ -116,6 +162,10 @@ class CustomReadOnlyModelViewSet(ReadOnlyModelViewSet):
         queryset = exclude_words(self.request, queryset, self.filterset_char_fields)
         return queryset
 
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(CustomReadOnlyModelViewSet, self).get_serializer(*args, **kwargs)
+        return instrument_serializer(serializer)
+
 
 class CustomModelViewSet(ModelViewSet):
     filterset_key_fields = list()
@@ -127,6 +177,10 @@ class CustomModelViewSet(ModelViewSet):
         queryset = exclude_words(self.request, queryset, self.filterset_char_fields)
         return queryset
 
+    def get_serializer(self, *args, **kwargs):
+        serializer = super(CustomModelViewSet, self).get_serializer(*args, **kwargs)
+        return instrument_serializer(serializer)
+
 
 # authorization
 class EmailRegistration(CustomApiView):
@@ -205,11 +259,16 @@ class ProfileCarsAPIView(CustomApiView):
         return Response({'detail': 'Список машин успешно обновлен'}, status=200)
 
 
-class MastersViewSet(CustomReadOnlyModelViewSet):
+class MastersViewSet(FastListMixin, CustomReadOnlyModelViewSet):
     queryset = User.objects.filter(role='master')
     serializer_class = UserProfileSerializer
+    fast_list = True
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'cooperation'
+    # запрос из профиля мастера расходует ту же корзину, что и создание через /cooperation/
+    throttle_actions = {'request_for_cooperation': 'create'}
     filter_backends = [SearchFilter, OrderingFilter]
     filterset_key_fields = ['is_trusted']
     search_fields = ['name', 'repair_categories']
@@ -228,7 +287,7 @@ class MastersViewSet(CustomReadOnlyModelViewSet):
         if self.request.user.role != 'master':
             raise MasterRoleRequired
         instance = self.get_object()
-        RequestForCooperation.objects.create(requesting=request.user, responsible=instance)
+        request_cooperation(request.user, instance, request=request)
         return Response({'detail': 'Запрос на сотрудничество успешно отправлен'}, status=200)
 
     @action(methods=['post'], detail=True)
@@ -249,6 +308,8 @@ class RequestForCooperationViewSet(CustomModelViewSet):
     serializer_class = RequestForCooperationSerializer
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'cooperation'
     filter_backends = [SearchFilter, OrderingFilter]
     filterset_key_fields = ['positive_response', 'responded']
     search_fields = ['requesting__name', 'responsible__name']
@@ -258,41 +319,65 @@ class RequestForCooperationViewSet(CustomModelViewSet):
         queryset = self.queryset.filter(Q(requesting=self.request.user) | Q(responsible=self.request.user))
         return queryset
 
+    def perform_create(self, serializer):
+        serializer.instance = request_cooperation(self.request.user, serializer.validated_data['responsible'],
+                                                  request=self.request)
+
+    @transaction.atomic
     @action(methods=['post'], detail=True)
     def approve_cooperation(self, request, pk):
         instance = self.get_object()
         instance.positive_response = True
         instance.responded = True
         instance.save()
+        publish('cooperation_approved', [instance.requesting_id], actor=request.user, object_id=instance.id,
+                request=request)
         return Response({'detail': 'Сотрудничество подтверждено'})
 
+    @transaction.atomic
     @action(methods=['post'], detail=True)
     def reject_cooperation(self, request, pk):
         instance = self.get_object()
         instance.responded = True
         instance.save()
+        publish('cooperation_rejected', [instance.requesting_id], actor=request.user, object_id=instance.id,
+                request=request)
         return Response({'detail': 'Сотрудничество отклонено'})
 
 
+class ActivityViewSet(GenericViewSet, ListModelMixin):
+    # лента событий текущего пользователя, новые события приходят в сокет messages-<id>
+    queryset = Activity.objects.all()
+    serializer_class = ActivitySerializer
+    pagination_class = KeysetPagination
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user).select_related('actor')
+
+
 class UserReportViewSet(GenericViewSet, CreateModelMixin):
     queryset = UserReport.objects.all()
     serializer_class = UserReportSerializer
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'reports'
 
-    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save()
+        # проверяем до вставки: отклоненная жалоба не пишет строку в базу
         if self.get_queryset().filter(
                 from_user=self.request.user,
-                to_user=serializer.instance.to_user,
+                to_user=serializer.validated_data['to_user'],
                 created__gte=timezone.now() - datetime.timedelta(hours=12)).exists():
             raise BadRequest('На одного пользователя можно отправлять только одну жалобу раз в 12 часов')
+        serializer.save()
 
 
-class CarBrandReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class CarBrandReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = CarBrand.objects.all()
     serializer_class = CarBrandSerializer
+    cache_models = [CarBrand]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -300,9 +385,10 @@ class CarBrandReadOnlyViewSet(CustomReadOnlyModelViewSet):
     ordering_fields = ['id', 'name']
 
 
-class CarReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class CarReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = Car.objects.all()
     serializer_class = CarSerializer
+    cache_models = [Car, CarBrand]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -312,9 +398,10 @@ class CarReadOnlyViewSet(CustomReadOnlyModelViewSet):
     filterset_char_fields = ['brand__name', 'model_name']
 
 
-class RepairCategoryReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class RepairCategoryReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = RepairCategory.objects.all()
     serializer_class = RepairCategorySerializer
+    cache_models = [RepairCategory]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -354,9 +441,11 @@ class OfferImageReadOnlyViewSet(CustomModelViewSet):
             raise Forbidden('Вы не можете добавить картинку в чужой оффер')
 
 
-class GradeReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class GradeReadOnlyViewSet(FastListMixin, ExportMixin, CustomReadOnlyModelViewSet):
     queryset = Grade.objects.all()
     serializer_class = GradeSerializer
+    fast_list = True
+    export_fields = GRADE_EXPORT_FIELDS
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -364,6 +453,15 @@ class GradeReadOnlyViewSet(CustomReadOnlyModelViewSet):
     ordering_fields = ['grade', 'created']
     filterset_key_fields = ['rating_user', 'valued_user', 'order']
 
+    @action(methods=['get'], detail=False)
+    def summary(self, request):
+        # сводка для профиля: гистограмма, средняя оценка и последние отзывы одной строкой по pk
+        user_id = request.query_params.get('valued_user', '')
+        if not user_id.isdigit():
+            raise BadRequest('Укажите пользователя (valued_user)')
+        summary = ReviewSummary.objects.filter(user_id=user_id).first() or ReviewSummary(user_id=int(user_id))
+        return Response(ReviewSummarySerializer(summary, context=self.get_serializer_context()).data)
+
 
 class GradePhotoReadOnlyViewSet(CustomReadOnlyModelViewSet):
     queryset = GradePhoto.objects.all()
@@ -380,6 +478,8 @@ class CommentViewSet(CustomModelViewSet):
     serializer_class = CommentSerializer
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'comments'
     filter_backends = [SearchFilter, OrderingFilter]
     ordering_fields = ['created', 'users_liked_count']
     search_fields = ['text']
@@ -388,9 +488,46 @@ class CommentViewSet(CustomModelViewSet):
     def get_queryset(self):
         queryset = self.queryset
         queryset = annotate_comments_likes_count(queryset)  # annotate 'users_liked_count' variable
-        queryset = annotate_comment_is_liked(queryset, self.request.user)  # annotate 'is_liked' variable
         return queryset
 
+    def get_serializer(self, *args, **kwargs):
+        # is_liked для всей страницы (или одного комментария) одним запросом
+        if args and args[0] is not None:
+            comments = args[0] if kwargs.get('many') else [args[0]]
+            kwargs['context'] = dict(self.get_serializer_context(),
+                                     liked_ids=get_liked_comment_ids(self.request.user, comments))
+        return super(CommentViewSet, self).get_serializer(*args, **kwargs)
+
+    def get_serializer_class(self):
+        if self.action == 'thread':
+            return CommentThreadSerializer
+        return super(CommentViewSet, self).get_serializer_class()
+
+    @action(methods=['get'], detail=False)
+    def thread(self, request):
+        # дерево комментариев оффера (?offer=) или поддерево ответов на комментарий (?root=)
+        # параметры: depth - число уровней, limit - ответов на каждый комментарий, offset - сдвиг первого уровня
+        params = get_thread_params(request)
+        root_id, offer_id = request.query_params.get('root'), request.query_params.get('offer')
+        if root_id is not None:
+            if not root_id.isdigit():
+                raise BadRequest('Параметр root должен быть целым числом')
+            offer_id = Comment.objects.filter(id=root_id).values_list('offer_id', flat=True).first()
+            count = Comment.objects.filter(reply_id=root_id).count()
+        elif offer_id is not None and offer_id.isdigit():
+            count = Comment.objects.filter(offer_id=offer_id, reply__isnull=True).count()
+        else:
+            raise BadRequest('Укажите оффер (offer) или комментарий (root)')
+        if offer_id is None or not offers_base_filter(RepairOffer.objects.filter(id=offer_id), request.user.id).exists():
+            return Response({'detail': 'Комментарии не найдены'}, status=404)
+
+        queryset = annotate_comments_replies_count(self.get_queryset())  # annotate 'replies_count' variable
+        queryset = queryset.filter(id__in=thread_ids_sql(offer_id=offer_id, root_id=root_id, **params))
+        queryset = queryset.select_related('user', 'reply').prefetch_related('media').order_by('created', 'id')
+        items = self.get_serializer(list(queryset), many=True).data
+        parent_id = int(root_id) if root_id is not None else None
+        return Response({'count': count, 'results': build_tree(items, parent_id)})
+
     def perform_destroy(self, instance):
         if instance.user_id != self.request.user.id:
             raise Forbidden('Вы не можете удалить чужой комментарий')
@@ -403,30 +540,23 @@ class CommentViewSet(CustomModelViewSet):
 
     @action(methods=['post'], detail=True)
     def like(self, request, pk):
-        instance = self.get_object()
-        if instance.users_liked.filter(id=request.user.id).exists():
-            instance.users_liked.remove(request.user.id)
-            return Response({'like': False}, status=200)
-        else:
-            instance.users_liked.add(request.user.id)
-            return Response({'like': True}, status=200)
+        # повторный запрос не меняет ни лайк, ни счетчик
+        self.get_object().like(request.user.id)
+        return Response({'like': True}, status=200)
+
+    @action(methods=['post'], detail=True)
+    def unlike(self, request, pk):
+        self.get_object().unlike(request.user.id)
+        return Response({'like': False}, status=200)
 
-    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save()
-        if serializer.instance.offer.private:
-            raise BadRequest('На приватный оффер нельзя оставить комментарий')
-        media_list = self.request.FILES.getlist('media')
-        if len(media_list) > 10:
-            raise BadRequest('К комментарию нельзя прикрепить более 10 файлов')
-        for media in media_list:
-            size_mb = media.size / 1024 / 1024
-            if size_mb > settings.MAX_COMMENT_MEDIA_SIZE_MB:
-                raise BadRequest('Размер загружаемых фотографий не должен превышать 5 Мб')
-            ext = media.name.split('.')[-1]
-            if ext not in ['png', 'jpg', 'jpeg']:
-                raise BadRequest('Загружаемые файлы должны иметь один из перечисленных форматов: .png, .jpg, .jpeg')
-            serializer.instance.media.create(file=media)
+        media_list = validate_uploads(self.request.FILES.getlist('media'), settings.MAX_COMMENT_MEDIA_SIZE_MB,
+                                      IMAGE_EXTENSIONS, max_count=10)
+        with transaction.atomic():
+            serializer.save()
+            if serializer.instance.offer.private:
+                raise BadRequest('На приватный оффер нельзя оставить комментарий')
+        save_uploads(serializer.instance, 'media', media_list)
 
 
 class CommentMediaReadOnlyViewSet(CustomReadOnlyModelViewSet):
@@ -439,14 +569,16 @@ class CommentMediaReadOnlyViewSet(CustomReadOnlyModelViewSet):
     filterset_key_fields = ['comment']
 
 
-class RepairOfferViewSet(CustomModelViewSet):
+class RepairOfferViewSet(ChangeTrackingMixin, FastListMixin, ExportMixin, CustomModelViewSet):
     queryset = RepairOffer.objects.all()
     serializer_class = RepairOfferSerializer
+    fast_list = True
+    export_fields = OFFER_EXPORT_FIELDS
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ['title', 'description', 'categories__name']
-    ordering_fields = ['created', 'private', 'views_count']
+    ordering_fields = ['created', 'updated', 'private', 'views_count']
     filterset_key_fields = [
         'owner', 'master', 'categories', 'private', 'my', 'my_accept', 'free', 'completed'
     ]
@@ -467,6 +599,16 @@ class RepairOfferViewSet(CustomModelViewSet):
         queryset = annotate_repair_offers_completed(queryset)  # annotate 'completed' boolean variable
         return queryset
 
+    def get_export_queryset(self):
+        # без views_count: агрегат по просмотрам сделал бы выгрузку GROUP BY по всей таблице
+        queryset = offers_base_filter(self.queryset, self.request.user.id)
+        queryset = annotate_repair_offers_my_my_accept_free(queryset, self.request.user.id)
+        queryset = annotate_repair_offers_completed(queryset)
+        return queryset
+
+    def get_conditional_queryset(self):
+        return self.get_export_queryset()
+
     def perform_destroy(self, instance):
         if not self.is_owner(instance):
             raise Forbidden('Вы не можете удалить чужой оффер')
@@ -477,27 +619,47 @@ class RepairOfferViewSet(CustomModelViewSet):
             raise Forbidden
         return super(RepairOfferViewSet, self).perform_update(serializer)
 
-    @transaction.atomic
     def perform_create(self, serializer):
-        serializer.save()
-        for img in self.request.FILES.getlist('images'):
-            size_mb = img.size / 1024 / 1024
-            if size_mb > settings.MAX_OFFER_PHOTO_SIZE_MB:
-                raise BadRequest('Размер загружаемых фотографий не должен превышать 5 Мб')
-            ext = img.name.split('.')[-1]
-            if ext not in ['png', 'jpg', 'jpeg']:
-                raise BadRequest('Загружаемые файлы должны иметь один из перечисленных форматов: .png, .jpg, .jpeg')
-            serializer.instance.images.create(img=img)
+        images = validate_uploads(self.request.FILES.getlist('images'), settings.MAX_OFFER_PHOTO_SIZE_MB,
+                                  IMAGE_EXTENSIONS)
+        with transaction.atomic():
+            serializer.save()
+        if save_uploads(serializer.instance, 'images', images):
+            RepairOffer.touch([serializer.instance.pk])
+        broadcast_offer(serializer.instance, serializer.data)
 
     @action(methods=['post'], detail=True)
     def set_master(self, request, pk):
         instance = self.get_object()
         if not self.is_owner(instance):
             raise Forbidden
-        set_master(instance, request.data.get('master_id'))
+        previous_master_id = instance.master_id
+        with transaction.atomic():
+            set_master(instance, request.data.get('master_id'))
+            if instance.master_id != previous_master_id:
+                publish('master_assigned', [instance.master_id], actor=request.user, offer=instance, request=request)
+                publish('master_removed', [previous_master_id], actor=request.user, offer=instance, request=request)
         return Response({'detail': 'Мастер успешно изменен'}, status=200)
 
-    @transaction.atomic
+    @action(methods=['get'], detail=True)
+    def matching_masters(self, request, pk):
+        instance = self.get_object()
+        if not self.is_owner(instance):
+            raise Forbidden('Подбирать мастеров можно только для своих офферов')
+        limit = get_int_param(request, 'limit', 10, settings.MAX_MATCHING_MASTERS, minimum=1)
+        ranked = MasterMatcher(instance, request.user).top(limit)
+        masters = User.objects.filter(id__in=[master_id for _, master_id in ranked])
+        masters = annotate_masters_statistic(masters)
+        masters = annotate_masters_is_trusted(masters, request.user)
+        masters = {master.id: master for master in masters.prefetch_related('repair_categories')}
+        result = []
+        for score, master_id in ranked:
+            master = masters[master_id]
+            master.score = score
+            result.append(master)
+        serializer = MatchedMasterSerializer(result, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
     @action(methods=['post'], detail=True)
     def send_grade(self, request, pk):
         instance = self.get_object()
@@ -505,30 +667,36 @@ class RepairOfferViewSet(CustomModelViewSet):
         grade_serializer.is_valid(raise_exception=True)
         grade_data = grade_serializer.data
         grade_value, comment = grade_data.get('grade'), grade_data.get('comment')
-
-        if self.is_owner(instance):
-            if instance.owner_grade:
-                raise BadRequest('Нельзя оставлять более одного отзыва на оффер')
-            grade = Grade.objects.create(
-                grade=grade_value, comment=comment, rating_user=instance.owner, valued_user=instance.master,
-                offer=instance
-            )
-            instance.owner_grade = grade
-            instance.save()
-        elif self.is_master(instance):
-            if instance.master_grade:
-                raise BadRequest('Нельзя оставлять более одного отзыва на оффер')
-            grade = Grade.objects.create(
-                grade=grade_value, comment=comment, rating_user=instance.master, valued_user=instance.owner,
-                offer=instance
-            )
-            instance.master_grade = grade
-            instance.save()
-        else:
-            raise Forbidden('Отзыв можно оставлять только своим офферам')
-
-        for photo in request.FILES.getlist('photo'):
-            grade.images.create(img=photo)
+        photos = validate_uploads(request.FILES.getlist('photo'), settings.MAX_GRADE_PHOTO_SIZE_MB, IMAGE_EXTENSIONS)
+
+        with transaction.atomic():
+            if self.is_owner(instance):
+                if instance.owner_grade:
+                    raise BadRequest('Нельзя оставлять более одного отзыва на оффер')
+                grade = Grade.objects.create(
+                    grade=grade_value, comment=comment, rating_user=instance.owner, valued_user=instance.master,
+                    offer=instance
+                )
+                instance.owner_grade = grade
+                instance.save()
+            elif self.is_master(instance):
+                if instance.master_grade:
+                    raise BadRequest('Нельзя оставлять более одного отзыва на оффер')
+                grade = Grade.objects.create(
+                    grade=grade_value, comment=comment, rating_user=instance.master, valued_user=instance.owner,
+                    offer=instance
+                )
+                instance.master_grade = grade
+                instance.save()
+            else:
+                raise Forbidden('Отзыв можно оставлять только своим офферам')
+
+        # если фото сохранить не удалось, отзыв удаляется: событие публикуем только после загрузки
+        save_uploads(grade, 'images', photos)
+        if photos and grade.valued_user_id is not None:
+            ReviewSummary.refresh_latest(grade.valued_user_id)
+        publish('grade', [grade.valued_user_id], actor=request.user, offer=instance, object_id=grade.id,
+                data={'grade': grade.grade}, request=request)
 
         return Response({'detail': 'Отзыв отправлен'}, status=200)
 
@@ -552,6 +720,8 @@ class RepairOfferViewSet(CustomModelViewSet):
         if not text:
             text = '👋'
         chat.message_set.create(user=request.user, text=text)
+        publish('offer_response', [instance.owner_id], actor=request.user, offer=instance, object_id=chat.id,
+                request=request)
         return Response({'detail': 'Чат успешно создан'}, status=200)
 
     @transaction.atomic
@@ -578,6 +748,8 @@ class RepairOfferViewSet(CustomModelViewSet):
         if not text:
             text = '👋'
         chat.message_set.create(user=request.user, text=text)
+        publish('offer_suggested', [int(master_id)], actor=request.user, offer=instance, object_id=chat.id,
+                request=request)
         return Response({'detail': 'Чат успешно создан'}, status=200)
 
     @transaction.atomic
@@ -588,18 +760,20 @@ class RepairOfferViewSet(CustomModelViewSet):
             instance.canceled_masters.add(request.user.id)
             instance.master = None
             instance.save()
+            publish('master_refused', [instance.owner_id], actor=request.user, offer=instance, request=request)
             return Response({'detail': 'Отказ от оффера успешно выполнен'}, status=200)
         raise BadRequest('Вы не назначены мастером на данный оффер')
 
 
-class PublicRepairOfferViewSet(CustomReadOnlyModelViewSet):
+class PublicRepairOfferViewSet(ChangeTrackingMixin, FastListMixin, CustomReadOnlyModelViewSet):
     queryset = RepairOffer.objects.filter(private=False)
     serializer_class = RepairOfferSerializer
+    fast_list = True
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ['title', 'description', 'categories__name']
-    ordering_fields = ['created']
+    ordering_fields = ['created', 'updated']
     filterset_key_fields = ['owner', 'master', 'categories']
     filterset_char_fields = ['title', 'description']
 
@@ -609,9 +783,10 @@ class PublicRepairOfferViewSet(CustomReadOnlyModelViewSet):
         return self.queryset.none()
 
 
-class SubscriptionViewSet(CustomReadOnlyModelViewSet):
+class SubscriptionViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = SubscriptionPlan.objects.all()
     serializer_class = SubscriptionPlanSerializer
+    cache_models = [SubscriptionPlan, SubscriptionAction]
     permission_classes = [IsAuthenticated]
     actions_permission_classes = {
         'default': [AllowAny],
@@ -623,6 +798,10 @@ class SubscriptionViewSet(CustomReadOnlyModelViewSet):
         queryset = subscription_plans_base_filter(self.queryset)
         return queryset
 
+    def get_cache_key_extra(self, request):
+        # список тарифов зависит от текущей даты
+        return [str(timezone.now().date())]
+
     def get_permissions(self):
         if self.action in self.actions_permission_classes:
             return [permission() for permission in self.actions_permission_classes[self.action]]
@@ -631,11 +810,7 @@ class SubscriptionViewSet(CustomReadOnlyModelViewSet):
     @action(methods=['get'], detail=False)
     def active(self, request):
         sub = Subscription.get_active(request.user)
-        if sub:
-            plan = sub.plan
-        else:
-            plan = self.get_queryset().get(default=True)
-        serializer = self.get_serializer(plan)
+        serializer = self.get_serializer(get_user_subscription_plan(request.user, sub))
         return Response({
             'plan': serializer.data,
             'expirate': sub.expiration_date.strftime("%d.%m.%Y") if sub else None
@@ -692,11 +867,14 @@ class SubscriptionViewSet(CustomReadOnlyModelViewSet):
     def pay_notifications(self, request):
         payment = request.data.get("object")
         if payment["status"] == "succeeded":
-            sub = Subscription.objects.filter(payment_id=payment["id"])
+            sub = Subscription.objects.filter(payment_id=payment["id"]).first()
+            if sub is None:
+                # платеж неизвестен или подписка уже удалена: 200, чтобы провайдер не повторял уведомление
+                return Response(status=200)
             sub.active = True
             sub.save()
             channel_layer = get_channel_layer()
-            permissions = sub.plan.get_permissions()
+            permissions = subscription_catalog.get_permissions(sub.plan_id)
             permissions_text_data = json.dumps(permissions, cls=encoders.JSONEncoder, ensure_ascii=False)
             async_to_sync(channel_layer.group_send)(
                 f"subscription-permissions-{sub.user_id}",
@@ -709,12 +887,7 @@ class SubscriptionViewSet(CustomReadOnlyModelViewSet):
 
     @action(methods=['get'], detail=False)
     def subscription_permissions(self, request):
-        sub = Subscription.get_active(request.user)
-        if sub:
-            permissions = sub.plan.get_permissions()
-        else:
-            permissions = self.get_queryset().get(default=True).get_permissions()
-        return Response(permissions)
+        return Response(get_user_subscription_plan(request.user).get_permissions())
 
 
 class ChatReadOnlyViewSet(CustomReadOnlyModelViewSet):
@@ -740,38 +913,79 @@ class ChatReadOnlyViewSet(CustomReadOnlyModelViewSet):
         return Response(serializer.data)
 
 
-class MessageViewSet(CustomModelViewSet):
+class MessageViewSet(ExportMixin, CustomModelViewSet):
     queryset = Message.objects.filter(deleted=False)
     serializer_class = MessageSerializer
-    pagination_class = StandardPagination
+    export_fields = MESSAGE_EXPORT_FIELDS
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'messages'
+    pagination_class = MessagePagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ['text']
     ordering_fields = ['created', 'changed']
+    # по умолчанию от новых к старым: от этого порядка строит курсор MessagePagination
+    ordering = ['-created']
     filterset_key_fields = ['chat', 'user', 'reply', 'have_read']
 
     def get_queryset(self):
-        return self.queryset.filter(chat__participants=self.request.user)
+        # чаты пользователя из кэша участников вместо join по participants
+        queryset = self.queryset.filter(chat_id__in=chat_membership.get_user_chats(self.request.user.id))
+        since = get_datetime_param(self.request, 'since')
+        if self.action == 'list' and since is not None:
+            queryset = queryset.filter(created__gte=since)
+        return queryset
 
     def filter_queryset(self, queryset):
         queryset = super(MessageViewSet, self).filter_queryset(queryset)
         return queryset
 
-    @transaction.atomic
+    @action(methods=['get'], detail=False)
+    def archive(self, request):
+        # история чата из архивных партиций: без month - список архивных месяцев, с month=ГГГГ-ММ - сообщения
+        chat_id = request.query_params.get('chat', '')
+        if not chat_id.isdigit():
+            raise BadRequest('Параметр chat должен быть целым числом')
+        if not chat_membership.is_participant(request.user.id, chat_id):
+            return Response({'detail': 'Чат не найден'}, status=404)
+        months = archived_months()
+        if 'month' not in request.query_params:
+            return Response({'months': [f'{month:%Y-%m}' for month in months]})
+        month = parse_month(request.query_params['month'])
+        if month is None:
+            raise BadRequest('Параметр month должен быть в формате ГГГГ-ММ')
+        if month not in months:
+            return Response({'detail': 'Архив за этот месяц не найден'}, status=404)
+        return Response({'month': f'{month:%Y-%m}', 'results': iter_archived_messages(month, chat_id)})
+
+    @action(methods=['get'], detail=False)
+    def search(self, request):
+        # поиск по сообщениям чатов пользователя: q - подстрока, chat - один чат, limit - число найденных сообщений
+        query = request.query_params.get('q', '').strip()
+        if len(query) < settings.MESSAGE_SEARCH_MIN_LENGTH:
+            raise BadRequest(f'Поисковый запрос должен содержать не менее {settings.MESSAGE_SEARCH_MIN_LENGTH} символов')
+        chat_id = request.query_params.get('chat')
+        if chat_id is not None and not chat_id.isdigit():
+            raise BadRequest('Параметр chat должен быть целым числом')
+        limit = get_int_param(request, 'limit', settings.MESSAGE_SEARCH_DEFAULT_LIMIT,
+                              settings.MESSAGE_SEARCH_MAX_LIMIT, minimum=1)
+        return Response(search_messages(request.user.id, query, chat_id, limit))
+
     def perform_create(self, serializer):
-        serializer.save()
+        media_list = validate_uploads(self.request.FILES.getlist('media'), settings.MAX_MESSAGE_MEDIA_SIZE_MB)
+        if not chat_membership.is_participant(self.request.user.id, serializer.validated_data['chat'].id):
+            raise Forbidden('Вы не можете писать в чат, участником которого не являетесь')
+
+        with transaction.atomic():
+            serializer.save()
+
+            # указываем на изменение чата
+            chat = serializer.instance.chat
+            chat.changed = timezone.now()
+            chat.save()
 
         # сохраняем медиафайлы
-        for media in self.request.FILES.getlist('media'):
-            size_mb = media.size / 1024 / 1024
-            if size_mb > settings.MAX_MESSAGE_MEDIA_SIZE_MB:
-                raise BadRequest('Размер загружаемых файлов не должен превышать 5 Мб')
-            serializer.instance.media.create(file=media)
-
-        # указываем на изменение чата
-        chat = serializer.instance.chat
-        chat.changed = timezone.now()
-        chat.save()
+        save_uploads(serializer.instance, 'media', media_list)
 
         # отправляем сообщение в сокет
         send_serializer = self.get_serializer(serializer.instance)
@@ -782,7 +996,7 @@ class MessageViewSet(CustomModelViewSet):
         )
 
         # отправляем пуш-уведомления
-        for p_id in serializer.instance.chat.participants.exclude(id=self.request.user.id).values_list('id', flat=True):
+        for p_id in chat_membership.get_participants(serializer.instance.chat_id) - {self.request.user.id}:
             async_to_sync(channel_layer.group_send)(
                 f"messages-{p_id}", {"type": "new_message", "message": message_text_data}
             )
@@ -799,9 +1013,10 @@ class MessageViewSet(CustomModelViewSet):
         return super(MessageViewSet, self).perform_update(serializer)
 
 
-class FAQReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class FAQReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = FAQ.objects.filter(actual=True)
     serializer_class = FAQSerializer
+    cache_models = [FAQ, FAQTopic]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -809,6 +1024,27 @@ class FAQReadOnlyViewSet(CustomReadOnlyModelViewSet):
     ordering_fields = []
     filterset_key_fields = ['topic']
 
+    def get_serializer_class(self):
+        if self.action == 'document':
+            return FAQDocumentSerializer
+        return super(FAQReadOnlyViewSet, self).get_serializer_class()
+
+    def get_cache_models(self):
+        if self.action == 'document':
+            return [FAQ, FAQContent]
+        return super(FAQReadOnlyViewSet, self).get_cache_models()
+
+    @action(methods=['get'], detail=False)
+    def document(self, request):
+        # FAQ целиком вместе со всеми блоками контента, кэшируется до изменения FAQ или контента
+        return self.cached_response(self.get_document, request)
+
+    def get_document(self, request):
+        faq = self.get_queryset().prefetch_related('content').filter(key=request.query_params.get('key')).first()
+        if faq is None:
+            return Response({'detail': 'FAQ не найден'}, status=404)
+        return Response(self.get_serializer(faq).data)
+
     @action(methods=['get'], detail=False)
     def get_by_key(self, request):
         try:
@@ -818,19 +1054,46 @@ class FAQReadOnlyViewSet(CustomReadOnlyModelViewSet):
             return Response({'detail': 'FAQ не найден'}, status=404)
 
 
-class FAQTopicReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class FAQTopicReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = FAQTopic.objects.all()
     serializer_class = FAQTopicSerializer
+    cache_models = [FAQTopic]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
     search_fields = ['name']
     ordering_fields = []
 
+    def get_serializer_class(self):
+        if self.action == 'document':
+            return FAQTopicDocumentSerializer
+        return super(FAQTopicReadOnlyViewSet, self).get_serializer_class()
+
+    def get_cache_models(self):
+        if self.action == 'document':
+            return [FAQTopic, FAQ, FAQContent]
+        return super(FAQTopicReadOnlyViewSet, self).get_cache_models()
+
+    def get_queryset(self):
+        queryset = super(FAQTopicReadOnlyViewSet, self).get_queryset()
+        if self.action == 'document':
+            faqs = FAQ.objects.filter(actual=True).order_by('id').prefetch_related('content')
+            queryset = queryset.prefetch_related(Prefetch('faq_set', queryset=faqs, to_attr='actual_faqs'))
+        return queryset
+
+    @action(methods=['get'], detail=True)
+    def document(self, request, pk=None):
+        # тема со всеми актуальными FAQ и их контентом одним ответом
+        return self.cached_response(self.get_document, request, pk=pk)
+
+    def get_document(self, request, pk=None):
+        return Response(self.get_serializer(self.get_object()).data)
+
 
-class FAQContentReadOnlyViewSet(CustomReadOnlyModelViewSet):
+class FAQContentReadOnlyViewSet(VersionedCacheMixin, CustomReadOnlyModelViewSet):
     queryset = FAQContent.objects.all()
     serializer_class = FAQContentSerializer
+    cache_models = [FAQContent]
     pagination_class = StandardPagination
     permission_classes = [IsAuthenticated]
     filter_backends = [SearchFilter, OrderingFilter]
@@ -10,18 +10,19 @@ if not settings.configured:
     django.setup()
 
 from .middleware import TokenAuthMiddleware
+from .handlers import StreamingASGIHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
-from django.core.asgi import get_asgi_application
 
 from api import consumers
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": StreamingASGIHandler(),
     "websocket": TokenAuthMiddleware(
         URLRouter([
             path('ws/chats/<int:pk>/', consumers.ChatConsumer.as_asgi()),
             path('ws/messages/', consumers.UserMessagesConsumer.as_asgi()),
             path('ws/subscription_permissions/', consumers.SubscriptionPermissionsConsumer.as_asgi()),
+            path('ws/offers/', consumers.OfferFeedConsumer.as_asgi()),
         ])
     ),
 })
@@ -0,0 +1,34 @@
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.creation import DatabaseCreation as PostgresDatabaseCreation
+
+from .pool import get_pool
+from .pool import close_pools
+
+
+class DatabaseCreation(PostgresDatabaseCreation):
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # DROP DATABASE не пройдет, пока в пуле висят соединения к тестовой базе
+        close_pools(test_database_name)
+        return super(DatabaseCreation, self)._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    Бэкенд postgresql с пулом соединений на процесс. Настройки пула - ключ POOL в DATABASES,
+    см. pool.DEFAULT_OPTIONS. CONN_MAX_AGE оставляем 0: соединение возвращается в пул после каждого запроса.
+    """
+    creation_class = DatabaseCreation
+
+    def get_new_connection(self, conn_params):
+        self.pool = get_pool(self.alias, conn_params, self.settings_dict.get('POOL', {}))
+        return self.pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.in_atomic_block:
+            # Django оставляет ссылку на соединение, закрытое внутри транзакции, поэтому в пул его не отдаем
+            with self.wrap_database_errors:
+                return self.pool.discard(self.connection)
+        with self.wrap_database_errors:
+            return self.pool.putconn(self.connection)
@@ -0,0 +1,190 @@
+import collections
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+
+from fixithere import metrics
+
+DEFAULT_OPTIONS = {
+    # размеры на один процесс-воркер: всего соединений к базе = воркеры * MAX_SIZE
+    'MIN_SIZE': 1,
+    'MAX_SIZE': 10,
+    # сколько ждать свободного соединения, прежде чем отдать ошибку
+    'TIMEOUT': 5,
+    # простаивающие дольше соединения сверх MIN_SIZE закрываются
+    'MAX_IDLE': 300,
+    # соединение, простоявшее дольше, проверяется SELECT 1 перед выдачей
+    'CHECK_AFTER': 30,
+}
+
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+    """
+    Потокобезопасный пул соединений psycopg2 внутри процесса.
+    Потоки sync-view и database_sync_to_async берут соединение на время запроса
+    и возвращают его при close() вместо настоящего закрытия.
+    """
+
+    def __init__(self, alias, options):
+        options = dict(DEFAULT_OPTIONS, **options)
+        self.alias = alias
+        self.min_size = options['MIN_SIZE']
+        self.max_size = options['MAX_SIZE']
+        self.timeout = options['TIMEOUT']
+        self.max_idle = options['MAX_IDLE']
+        self.check_after = options['CHECK_AFTER']
+        self._idle = collections.deque()
+        self._size = 0
+        self._cond = threading.Condition()
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        # после fork соединения родителя не трогаем: их сокеты общие с родителем
+        if self._pid != os.getpid():
+            self._idle.clear()
+            self._size = 0
+            self._pid = os.getpid()
+
+    def getconn(self, connect):
+        started = time.monotonic()
+        with self._cond:
+            self._check_fork()
+            while True:
+                if self._idle:
+                    # LIFO: берем самое свежее соединение, старые успевают закрыться по MAX_IDLE
+                    conn, returned_at = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    conn, returned_at = None, None
+                    break
+                remaining = self.timeout - (time.monotonic() - started)
+                if remaining <= 0:
+                    metrics.db_pool_timeouts.inc(alias=self.alias)
+                    raise PoolTimeout(f'Нет свободного соединения с базой "{self.alias}" за {self.timeout} с')
+                self._cond.wait(remaining)
+        metrics.db_pool_wait.observe(time.monotonic() - started, alias=self.alias)
+
+        if conn is not None:
+            if time.monotonic() - returned_at < self.check_after or self.is_alive(conn):
+                return conn
+            metrics.db_pool_health_check_failures.inc(alias=self.alias)
+            self.close_connection(conn)
+        try:
+            conn = connect()
+        except Exception:
+            self.release_slot()
+            raise
+        metrics.db_pool_connects.inc(alias=self.alias)
+        return conn
+
+    def putconn(self, conn):
+        if not self.reset(conn):
+            self.discard(conn)
+            return
+        expired = []
+        with self._cond:
+            if self._pid != os.getpid():
+                return
+            now = time.monotonic()
+            self._idle.append((conn, now))
+            while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+                expired.append(self._idle.popleft()[0])
+                self._size -= 1
+            self._cond.notify()
+        for conn in expired:
+            self.close_connection(conn)
+
+    def discard(self, conn):
+        self.close_connection(conn)
+        self.release_slot()
+
+    def release_slot(self):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def close_idle(self):
+        with self._cond:
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self.close_connection(conn)
+
+    @staticmethod
+    def reset(conn):
+        # соединение возвращается в пул только без открытой транзакции
+        if conn.closed:
+            return False
+        status = conn.get_transaction_status()
+        if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def close_connection(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def stats(self):
+        with self._cond:
+            return {'idle': len(self._idle), 'in_use': self._size - len(self._idle)}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, options):
+    # ключ по параметрам соединения: у тестовой и служебной базы "postgres" свои пулы
+    key = (alias, tuple(sorted((k, str(v)) for k, v in conn_params.items())))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(alias, options)
+    return pool
+
+
+def close_pools(database_name=None):
+    for (alias, params), pool in list(_pools.items()):
+        if database_name is None or dict(params).get('database') == database_name:
+            pool.close_idle()
+
+
+def collect():
+    metrics.db_pool_connections.clear()
+    for (alias, params), pool in list(_pools.items()):
+        for state, value in pool.stats().items():
+            metrics.db_pool_connections.inc(value, alias=alias, state=state)
+
+
+metrics.registry.add_collector(collect)
@@ -0,0 +1,35 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+
+STREAM_END = object()
+
+
+class StreamingASGIHandler(ASGIHandler):
+    """
+    ASGIHandler из Django 4.0 перебирает StreamingHttpResponse прямо в event loop,
+    поэтому итератор с запросами к БД (выгрузки через серверный курсор) падает с SynchronousOnlyOperation.
+    Здесь каждая часть читается в потоке запроса, где открыто соединение с БД.
+    """
+
+    async def send_response(self, response, send):
+        if not response.streaming:
+            return await super(StreamingASGIHandler, self).send_response(response, send)
+
+        headers = [
+            (header.encode('ascii') if isinstance(header, str) else header,
+             value.encode('latin1') if isinstance(value, str) else value)
+            for header, value in response.items()
+        ]
+        headers += [(b'Set-Cookie', c.output(header='').encode('ascii').strip()) for c in response.cookies.values()]
+        await send({'type': 'http.response.start', 'status': response.status_code, 'headers': headers})
+
+        iterator = iter(response)
+        next_part = sync_to_async(next, thread_sensitive=True)
+        while True:
+            part = await next_part(iterator, STREAM_END)
+            if part is STREAM_END:
+                break
+            for chunk, _ in self.chunk_bytes(part):
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+        await sync_to_async(response.close, thread_sensitive=True)()
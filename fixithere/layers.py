@@ -0,0 +1,73 @@
+import re
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+from . import metrics
+
+
+def group_type(group):
+    return re.sub(r'-\d+$', '', group)
+
+
+class ChannelLayerMetricsMixin:
+    # отметка времени постановки в очередь, по ней консьюмер считает задержку доставки
+    sent_at_key = 'sent_at'
+
+    async def send(self, channel, message):
+        if self.sent_at_key not in message:
+            message = dict(message, **{self.sent_at_key: time.time()})
+        try:
+            return await super(ChannelLayerMetricsMixin, self).send(channel, message)
+        except ChannelFull:
+            metrics.channel_layer_dropped_messages.inc()
+            raise
+
+    async def group_send(self, group, message):
+        metrics.channel_layer_group_send_fanout.observe(self.get_group_size(group), group_type=group_type(group))
+        message = dict(message, **{self.sent_at_key: time.time()})
+        return await super(ChannelLayerMetricsMixin, self).group_send(group, message)
+
+    def get_group_size(self, group):
+        return 0
+
+
+class InstrumentedInMemoryChannelLayer(ChannelLayerMetricsMixin, InMemoryChannelLayer):
+    # штатная очистка обходит все очереди и группы на каждый send/receive/group_send:
+    # после рассылки на тысячи соединений каждый receive стоил O(число соединений)
+    clean_interval = 1.0
+
+    def __init__(self, *args, **kwargs):
+        super(InstrumentedInMemoryChannelLayer, self).__init__(*args, **kwargs)
+        self._cleaned_at = float('-inf')
+        metrics.registry.add_collector(self.collect)
+
+    def _clean_expired(self):
+        # сообщения живут expiry (60 с), чистить их чаще раза в секунду незачем
+        now = time.monotonic()
+        if now - self._cleaned_at < self.clean_interval:
+            return
+        self._cleaned_at = now
+        super(InstrumentedInMemoryChannelLayer, self)._clean_expired()
+
+    def get_group_size(self, group):
+        return len(self.groups.get(group, ()))
+
+    def collect(self):
+        groups, members = {}, {}
+        for group, channels in list(self.groups.items()):
+            if not channels:
+                continue
+            key = group_type(group)
+            groups[key] = groups.get(key, 0) + 1
+            members[key] = members.get(key, 0) + len(channels)
+        metrics.channel_layer_groups.clear()
+        metrics.channel_layer_group_members.clear()
+        for key in groups:
+            metrics.channel_layer_groups.set(groups[key], group_type=key)
+            metrics.channel_layer_group_members.set(members[key], group_type=key)
+
+        depths = [queue.qsize() for queue in list(self.channels.values())]
+        metrics.channel_layer_queue_depth_max.set(max(depths, default=0))
+        metrics.channel_layer_queued_messages.set(sum(depths))
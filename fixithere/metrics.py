@@ -0,0 +1,264 @@
+import bisect
+import contextvars
+import sys
+import threading
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.http import HttpResponseForbidden
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.label_names)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def samples(self):
+        raise NotImplementedError
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [f'{name}{labels} {value}' for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, format_labels(self.label_names, key), value) for key, value in values]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, format_labels(self.label_names, key), value) for key, value in values]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', format_labels(self.label_names, key, [('le', bound)]),
+                                cumulative))
+            samples.append((self.name + '_sum', format_labels(self.label_names, key), total))
+            samples.append((self.name + '_count', format_labels(self.label_names, key), cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def register(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def add_collector(self, collector):
+        # collector вызывается перед выгрузкой, чтобы обновить вычисляемые метрики
+        self._collectors.append(collector)
+
+    def expose(self):
+        for collector in self._collectors:
+            collector()
+        return '\n'.join(metric.expose() for metric in self._metrics.values()) + '\n'
+
+
+# реестр в памяти процесса: как InMemoryChannelLayer и реестр присутствия, он рассчитан на один процесс.
+# при нескольких воркерах каждый /metrics/ отдает счетчики того воркера, которому достался запрос
+registry = Registry()
+
+http_requests = registry.counter(
+    'http_requests_total', 'HTTP requests', ['view', 'method', 'status'])
+http_request_duration = registry.histogram(
+    'http_request_duration_seconds', 'HTTP request duration', ['view'])
+http_response_size = registry.histogram(
+    'http_response_size_bytes', 'HTTP response body size', ['view'], SIZE_BUCKETS)
+http_db_queries = registry.histogram(
+    'http_request_db_queries', 'SQL queries per sampled request', ['view'], COUNT_BUCKETS)
+http_db_duration = registry.histogram(
+    'http_request_db_duration_seconds', 'Total SQL time per sampled request', ['view'])
+http_serialization_duration = registry.histogram(
+    'http_request_serialization_duration_seconds', 'Serializer time per sampled request', ['view'])
+http_repeated_queries = registry.counter(
+    'http_repeated_queries_total', 'Repeated identical SQL queries (N+1 patterns)', ['view', 'serializer', 'field'])
+
+websocket_connections = registry.gauge(
+    'websocket_connections', 'Open websocket connections', ['consumer'])
+websocket_delivery_latency = registry.histogram(
+    'websocket_delivery_latency_seconds', 'Time from channel layer enqueue to websocket send', ['consumer'])
+channel_layer_group_send_fanout = registry.histogram(
+    'channel_layer_group_send_fanout', 'Group members per group_send', ['group_type'], COUNT_BUCKETS)
+channel_layer_dropped_messages = registry.counter(
+    'channel_layer_dropped_messages_total', 'Messages dropped because the channel was at capacity')
+channel_layer_groups = registry.gauge(
+    'channel_layer_groups', 'Non-empty channel layer groups', ['group_type'])
+channel_layer_group_members = registry.gauge(
+    'channel_layer_group_members', 'Channels subscribed to channel layer groups', ['group_type'])
+channel_layer_queue_depth_max = registry.gauge(
+    'channel_layer_queue_depth_max', 'Largest per-connection queue of undelivered messages')
+channel_layer_queued_messages = registry.gauge(
+    'channel_layer_queued_messages', 'Undelivered messages across all connections')
+presence_online = registry.gauge(
+    'presence_online', 'Users, connections and chats tracked by the in-memory presence registry', ['kind'])
+presence_typing_events = registry.counter(
+    'presence_typing_events_total', 'Typing events broadcast at once, coalesced, or flushed at the end of the window',
+    ['result'])
+
+db_pool_wait = registry.histogram(
+    'db_pool_wait_seconds', 'Time spent waiting for a pooled database connection', ['alias'])
+db_pool_timeouts = registry.counter(
+    'db_pool_timeouts_total', 'Checkouts that gave up waiting for a pooled connection', ['alias'])
+db_pool_connects = registry.counter(
+    'db_pool_connects_total', 'New physical database connections opened by the pool', ['alias'])
+db_pool_health_check_failures = registry.counter(
+    'db_pool_health_check_failures_total', 'Idle pooled connections that failed the health check', ['alias'])
+db_pool_connections = registry.gauge(
+    'db_pool_connections', 'Pooled database connections per process', ['alias', 'state'])
+
+throttled_requests = registry.counter(
+    'throttled_requests_total', 'Write requests rejected by the token bucket throttle', ['scope'])
+
+
+class RequestRecord:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialization_time = 0.0
+        self.seen_sql = set()
+        self.repeated = {}
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            if sql in self.seen_sql:
+                key = find_serializer_field()
+                self.repeated[key] = self.repeated.get(key, 0) + 1
+            else:
+                self.seen_sql.add(sql)
+
+
+current_record = contextvars.ContextVar('current_request_record', default=None)
+
+
+def find_serializer_field():
+    # ищем в стеке поле сериализатора, во время отрисовки которого выполняется запрос
+    from rest_framework.serializers import Serializer
+    frame = sys._getframe(2)
+    while frame is not None:
+        if frame.f_code.co_name == 'to_representation':
+            serializer, field = frame.f_locals.get('self'), frame.f_locals.get('field')
+            if isinstance(serializer, Serializer) and field is not None:
+                return serializer.__class__.__name__, field.field_name
+        frame = frame.f_back
+    return '', ''
+
+
+def instrument_serializer(serializer):
+    record = current_record.get()
+    if record is None:
+        return serializer
+    to_representation = serializer.to_representation
+
+    def timed_to_representation(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return to_representation(*args, **kwargs)
+        finally:
+            record.serialization_time += time.perf_counter() - started
+
+    serializer.to_representation = timed_to_representation
+    return serializer
+
+
+def metrics_view(request):
+    """
+    Метрики в текстовом формате Prometheus для адресов из METRICS_ALLOWED_IPS.
+    Значения только текущего процесса: сервер должен работать одним процессом,
+    иначе счетчики и гистограммы разных воркеров не суммируются и скрейпы видят случайный воркер.
+    """
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8')
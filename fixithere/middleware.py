@@ -1,9 +1,20 @@
+import contextlib
+import hashlib
+import random
+import time
+
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.db import connections
 from channels.db import database_sync_to_async
 from channels.middleware import BaseMiddleware
 from jwt.exceptions import InvalidSignatureError
 
 from api.services import get_user_by_token
+
+from . import metrics
+from . import routers
 # from rest_framework_jwt.authentication import jwt_decode_handler
 # from accounts.models import User
 
@@ -40,3 +51,97 @@ class TokenAuthMiddleware(BaseMiddleware):
             token_key = None
         scope['user'] = AnonymousUser() if token_key is None else await get_user(token_key)
         return await super().__call__(scope, receive, send)
+
+
+class RequestMetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= settings.METRICS_SAMPLE_RATE:
+            record = None
+            started = time.perf_counter()
+            response = self.get_response(request)
+        else:
+            record = metrics.RequestRecord()
+            token = metrics.current_record.set(record)
+            started = time.perf_counter()
+            try:
+                with contextlib.ExitStack() as stack:
+                    for conn in connections.all():
+                        stack.enter_context(conn.execute_wrapper(record))
+                    response = self.get_response(request)
+            finally:
+                metrics.current_record.reset(token)
+        duration = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+        metrics.http_requests.inc(view=view, method=request.method, status=response.status_code)
+        metrics.http_request_duration.observe(duration, view=view)
+        if not response.streaming:
+            metrics.http_response_size.observe(len(response.content), view=view)
+        if record is not None:
+            metrics.http_db_queries.observe(record.queries, view=view)
+            metrics.http_db_duration.observe(record.db_time, view=view)
+            metrics.http_serialization_duration.observe(record.serialization_time, view=view)
+            for (serializer, field), count in record.repeated.items():
+                metrics.http_repeated_queries.inc(count, view=view, serializer=serializer, field=field)
+        return response
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Закрепляет клиента за основной базой на REPLICA_PIN_SECONDS после записи,
+    чтобы следующие чтения не попали на отстающую реплику.
+    Метка - подписанная cookie со временем окончания закрепления: чтения с ней не ходят в базу.
+    Cookie живет REPLICA_PIN_COOKIE_AGE и после окончания закрепления, ее наличие показывает, что клиент хранит cookie.
+    Клиентам без нее (JWT-приложения) метка пишется в общий кэш: следующий запрос может попасть в другой процесс,
+    и пока общий кэш на DatabaseCache, каждое их чтение стоит одного запроса к основной базе.
+    """
+    safe_methods = ('GET', 'HEAD', 'OPTIONS')
+    pin_cookie = 'db_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    @staticmethod
+    def get_pin_key(request):
+        # JWT-клиенты различаются по заголовку Authorization, админка - по сессии
+        client = request.META.get('HTTP_AUTHORIZATION') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        if not client:
+            return None
+        return 'db_pin:' + hashlib.md5(client.encode()).hexdigest()
+
+    def get_cookie_pin(self, request):
+        # время окончания закрепления из cookie; None - cookie нет или подпись не сошлась
+        value = request.get_signed_cookie(self.pin_cookie, default=None, salt=self.pin_cookie)
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        pin_key = self.get_pin_key(request)
+        pin_until = self.get_cookie_pin(request)
+        if request.method not in self.safe_methods:
+            pinned = True
+        elif pin_until is not None:
+            pinned = time.time() < pin_until
+        else:
+            pinned = pin_key is not None and caches['shared'].get(pin_key, False)
+        state = routers.RoutingState(pinned=pinned)
+        token = routers.current_state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            routers.current_state.reset(token)
+        if state.written:
+            response.set_signed_cookie(self.pin_cookie, str(time.time() + settings.REPLICA_PIN_SECONDS),
+                                       salt=self.pin_cookie, max_age=settings.REPLICA_PIN_COOKIE_AGE,
+                                       httponly=True, samesite='Lax')
+            if pin_until is None and pin_key is not None:
+                caches['shared'].set(pin_key, True, timeout=settings.REPLICA_PIN_SECONDS)
+        return response
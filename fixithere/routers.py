@@ -0,0 +1,106 @@
+import contextvars
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.db import DatabaseError
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+REPLICA_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+'''
+
+
+class RoutingState:
+    # состояние маршрутизации на время одного запроса
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.written = False
+
+
+current_state = contextvars.ContextVar('db_routing_state', default=None)
+
+
+class ReplicaHealth:
+    """
+    Кэш состояния реплик в процессе: реплика с отставанием больше REPLICA_MAX_LAG_SECONDS
+    или с ошибкой соединения исключается до следующей проверки.
+    """
+
+    def __init__(self):
+        self._checked = {}
+        self._healthy = {}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, alias):
+        if time.monotonic() - self._checked.get(alias, float('-inf')) >= settings.REPLICA_CHECK_INTERVAL:
+            with self._lock:
+                if time.monotonic() - self._checked.get(alias, float('-inf')) >= settings.REPLICA_CHECK_INTERVAL:
+                    self._healthy[alias] = self.check(alias)
+                    self._checked[alias] = time.monotonic()
+        return self._healthy[alias]
+
+    def check(self, alias):
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute(REPLICA_LAG_SQL)
+                lag = cursor.fetchone()[0]
+        except DatabaseError:
+            logger.warning('Реплика %s недоступна, чтение идет в основную базу', alias, exc_info=True)
+            connections[alias].close()
+            return False
+        if lag is None or lag > settings.REPLICA_MAX_LAG_SECONDS:
+            logger.warning('Реплика %s отстает на %s с, чтение идет в основную базу', alias, lag)
+            return False
+        return True
+
+    def reset(self):
+        with self._lock:
+            self._checked = {}
+            self._healthy = {}
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaRouter:
+    """
+    Чтение в HTTP-запросах идет в реплики из DATABASE_REPLICAS, запись - в default.
+    В основную базу читают: небезопасные запросы, запросы после записи (read-your-writes),
+    открытые транзакции, код вне HTTP-запроса и запросы при недоступных репликах.
+    """
+
+    def db_for_read(self, model, **hints):
+        state = current_state.get()
+        # общий кэш на DatabaseCache читается только из основной базы
+        if model._meta.app_label == 'django_cache':
+            return DEFAULT_DB_ALIAS
+        if state is None or state.pinned or state.written or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = [alias for alias in settings.DATABASE_REPLICAS if replica_health.is_healthy(alias)]
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = current_state.get()
+        # запись в общий кэш (заполнение, удаление просроченного ключа внутри get) - не запись данных клиента
+        if state is not None and model._meta.app_label != 'django_cache':
+            state.written = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # реплики получают схему через репликацию
+        return db not in settings.DATABASE_REPLICAS
@@ -42,6 +42,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'rest_framework',
     'rest_framework_simplejwt',
@@ -52,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'fixithere.middleware.RequestMetricsMiddleware',
+    'fixithere.middleware.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -87,15 +90,42 @@ ASGI_APPLICATION = 'fixithere.asgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        # postgresql с пулом соединений на процесс, см. fixithere/db_pool
+        'ENGINE': 'fixithere.db_pool',
         'NAME': 'fixithere',
         'USER': 'dbadmin',
         'PASSWORD': 'root',
         'HOST': 'localhost',
         'PORT': '',
-    }
+        'POOL': {
+            'MIN_SIZE': 2,
+            'MAX_SIZE': 10,
+            'TIMEOUT': 5,
+        },
+    },
+    # реплики только для чтения, например:
+    # 'replica': {
+    #     'ENGINE': 'fixithere.db_pool',
+    #     'NAME': 'fixithere',
+    #     'USER': 'dbadmin',
+    #     'PASSWORD': 'root',
+    #     'HOST': 'localhost',
+    #     'PORT': '5433',
+    #     'OPTIONS': {'connect_timeout': 2},
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['fixithere.routers.ReplicaRouter']
+
+# сколько секунд после записи клиент читает из основной базы
+REPLICA_PIN_SECONDS = 10
+# сколько хранится cookie закрепления: пока она есть, метка не читается из общего кэша
+REPLICA_PIN_COOKIE_AGE = 60 * 60 * 24 * 30
+REPLICA_MAX_LAG_SECONDS = 5
+REPLICA_CHECK_INTERVAL = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -163,9 +193,8 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
-    ],
+        'api.renderers.FastJSONRenderer',
+    ] + (['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
     # 'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
     # 'DATE_INPUT_FORMATS': ["%d.%m.%Y"],
     # 'DATETIME_INPUT_FORMATS': ["%d.%m.%Y %H:%M"],
@@ -351,13 +380,104 @@ YOOKASSA = {
 
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'fixithere.layers.InstrumentedInMemoryChannelLayer',
         # 'CONFIG': {
         #     "hosts": [('0.0.0.0', 6379)],
         # },
     },
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        # 'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        # 'LOCATION': 'redis://0.0.0.0:6379',
+    },
+    # общий для всех процессов кэш: то, что один воркер меняет, а другие должны увидеть сразу.
+    # таблица создается командой createcachetable
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'fixithere_shared_cache',
+        # 'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        # 'LOCATION': 'redis://0.0.0.0:6379/1',
+    },
+}
+
+# как часто процесс сверяет версию каталога подписок с общим кэшем, секунды
+SUBSCRIPTION_CATALOG_CHECK_INTERVAL = 2
+
+FAST_LIST_SERIALIZERS = True
+
+RESPONSE_CACHE_TIMEOUT = 60 * 60 * 24
+# как часто процесс сверяет версии моделей для кэша ответов с общим кэшем, секунды
+RESPONSE_CACHE_VERSION_CHECK_INTERVAL = 2
+
+EXPORT_CHUNK_SIZE = 2000
+
+ADMIN_EXACT_COUNT_LIMIT = 10000
+
+# ветки комментариев: глубина и число ответов на каждый комментарий в одном ответе
+COMMENT_THREAD_DEFAULT_DEPTH = 3
+COMMENT_THREAD_MAX_DEPTH = 10
+COMMENT_THREAD_DEFAULT_SIBLINGS = 10
+COMMENT_THREAD_MAX_SIBLINGS = 50
+
+# поиск по сообщениям: триграммный индекс работает с запросами от 3 символов
+MESSAGE_SEARCH_MIN_LENGTH = 3
+MESSAGE_SEARCH_DEFAULT_LIMIT = 20
+MESSAGE_SEARCH_MAX_LIMIT = 100
+# символов контекста с каждой стороны совпадения в сниппете
+MESSAGE_SEARCH_SNIPPET_WIDTH = 60
+
+# секционирование сообщений по месяцам: сколько партиций держать впереди,
+# через сколько месяцев партиция уходит в архив
+MESSAGE_PARTITIONS_AHEAD = 3
+MESSAGE_ARCHIVE_AFTER_MONTHS = 24
+MESSAGE_ARCHIVE_DIR = Path(BASE_DIR, 'archive', 'messages')
+
+# сколько последних отзывов хранится в сводке отзывов пользователя
+REVIEW_SUMMARY_LATEST = 5
+
+# лимиты записи "<throttle_scope>.<action>": rate - скорость пополнения, burst - размер корзины
+WRITE_THROTTLE_RATES = {
+    'comments.create': {'rate': '10/min', 'burst': 5},
+    'comments.like': {'rate': '60/min', 'burst': 20},
+    'comments.unlike': {'rate': '60/min', 'burst': 20},
+    'messages.create': {'rate': '60/min', 'burst': 20},
+    'messages.update': {'rate': '30/min', 'burst': 10},
+    'messages.partial_update': {'rate': '30/min', 'burst': 10},
+    'messages.archive': {'rate': '10/min', 'burst': 5},
+    'cooperation.create': {'rate': '10/hour', 'burst': 3},
+    'reports.create': {'rate': '5/hour', 'burst': 2},
+}
+# общая корзина в базе для нескольких воркеров, без нее лимит действует на каждый процесс отдельно.
+# полные корзины удаляет команда prune_throttle_buckets, ее нужно запускать периодически (cron)
+WRITE_THROTTLE_SHARED = True
+
 MAX_OFFER_PHOTO_SIZE_MB = 5
 MAX_MESSAGE_MEDIA_SIZE_MB = 35
 MAX_COMMENT_MEDIA_SIZE_MB = 35
+MAX_GRADE_PHOTO_SIZE_MB = 5
+# потоков на процесс для параллельной записи загруженных файлов в хранилище
+UPLOAD_WORKERS = 4
+
+# присутствие в чатах: клиент шлет heartbeat чаще PRESENCE_TTL секунд, иначе соединение считается оборванным;
+# события "печатает" рассылаются в чат не чаще PRESENCE_TYPING_RATE раз в секунду и действуют PRESENCE_TYPING_TTL секунд
+PRESENCE_TTL = 60
+PRESENCE_TYPING_RATE = 2
+PRESENCE_TYPING_TTL = 5
+
+# участники чатов в памяти процесса: записи сбрасываются сменой общей версии при изменении participants,
+# версия сверяется не чаще CHAT_MEMBERSHIP_CHECK_INTERVAL секунд, TTL - страховка
+CHAT_MEMBERSHIP_TTL = 300
+CHAT_MEMBERSHIP_CHECK_INTERVAL = 2
+
+MASTER_INDEX_TTL = 300
+# как часто соединение ленты офферов перепроверяет право can_take_offers
+OFFER_FEED_PERMISSION_TTL = 300
+MAX_MATCHING_MASTERS = 50
+
+# метрики /metrics/ хранятся в памяти процесса и не объединяются между воркерами:
+# при запуске в несколько процессов каждый скрейп видит только один из них
+METRICS_SAMPLE_RATE = 0.1
+METRICS_ALLOWED_IPS = ['127.0.0.1']